@@ -13,8 +13,12 @@ os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 import tensorflow as tf
 
 sys.path.append('../../.')
-from ams.utils.graph_utils import create_student_v3, trim_graph_frozen
-from ams.utils.utils import SaveHelper, calculate_miou, colormap, mini_batch
+from ams.utils.graph_utils import create_student_v3, create_device_input, reduce_labels, trim_graph_frozen
+from ams.utils.utils import SaveHelper, colormap, mini_batch
+from ams.utils.metrics import confusion_matrix, cross_miou_series, iou_from_confusion, label_lookup, \
+    reduce_labels as reduce_labels_np
+from ams.utils.tracing import tracer, save_run_metadata
+from ams.utils.checkpoint import load_checkpoint
 
 tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
 
@@ -30,8 +34,8 @@ class SemanticNetwork(object):
     BLACK = np.array([0, 0, 0], dtype=np.uint8)
 
     def __init__(self, meta_dir, class_weights_exp=None, height=None, gpu_id='0', frozen=False,
-                 scale=None, mini_batch_size=None, lr=None, mem_frac=1, coord_frac=0.1, cross_miou_compat=False,
-                 filter_out=None, over_ride_total_classes=None, **kwargs):
+                 scale=None, mini_batch_size=None, lr=None, mem_frac=1, coord_frac=0.1,
+                 filter_out=None, over_ride_total_classes=None, device_augment=False, **kwargs):
         assert height is not None, "No height is given"
         assert class_weights_exp is not None, "No class weights specified"
         assert frozen or None not in [scale, mini_batch_size, lr], "Training parameters must be specified for " \
@@ -39,6 +43,7 @@ class SemanticNetwork(object):
         self.lr = lr
         self.mini_batch_size = mini_batch_size
         self.scale = scale
+        self.device_input = None
         if over_ride_total_classes is not None:
             print(colored('Overriding default number of classes', 'cyan'))
             self.TOTAL_CLASSES = over_ride_total_classes
@@ -52,14 +57,14 @@ class SemanticNetwork(object):
         assert self.class_indices_graph.shape == (self.class_count,)
         assert self.class_count > 0
 
-        self.cross_miou_compat = cross_miou_compat
-
         self.color_map_reduced_ = np.take(colormap(), self.class_indices_graph, axis=0)
         self.take_array = np.cumsum(self.class_weights_graph).reshape(
             self.TOTAL_CLASSES) * self.class_weights_graph.reshape(self.TOTAL_CLASSES)
         self.take_array = np.where(self.take_array != 0, self.take_array - 1, self.take_array)
         self.take_array = self.take_array.astype(int)
         assert self.take_array.shape == (self.TOTAL_CLASSES,)
+        # Host-side label reduction used for the confusion matrices
+        self.label_lut, self.label_valid = label_lookup(self.class_indices_graph, self.TOTAL_CLASSES)
 
         self.frozen = frozen
         self.height = height
@@ -94,50 +99,27 @@ class SemanticNetwork(object):
 
                     init = tf.initializers.global_variables()
                     self.frozen_labels_pl = tf.placeholder(tf.int32, shape=[None, None, None])
-                    labels_onehot = tf.one_hot(self.frozen_labels_pl, 19, axis=-1)
-                    filtered_labels_onehot = tf.gather(labels_onehot, self.class_indices_graph, axis=-1)
-                    filtered_labels = tf.argmax(filtered_labels_onehot, axis=-1)
-                    weights = tf.reduce_sum(filtered_labels_onehot, axis=-1)
-
-                    self.mean_iou, self.update_op = tf.metrics.mean_iou(
-                        labels=filtered_labels,
-                        predictions=self.frozen_predictions,
-                        num_classes=self.class_count,
-                        weights=weights)
-                    miou_list_vars = [v for v in tf.local_variables() if any(tag in v.name for tag in
-                                                                             ['confusion', 'miou', 'mean_iou'])]
-                    self.reset_conf_mat = tf.variables_initializer(miou_list_vars)
+                    filtered_labels, weights = reduce_labels(self.frozen_labels_pl, self.class_indices_graph,
+                                                             self.TOTAL_CLASSES)
+                    # The confusion matrices are computed host-side by predict_with_metric, only the loss is needed
 
-                    pixel_loss = tf.nn.softmax_cross_entropy_with_logits(logits=self.frozen_logits,
-                                                                         labels=filtered_labels_onehot)
+                    pixel_loss = tf.nn.sparse_softmax_cross_entropy_with_logits(logits=self.frozen_logits,
+                                                                                labels=filtered_labels)
 
                     weights = tf.cast(weights, tf.bool)
                     self.loss = tf.reduce_mean(tf.boolean_mask(pixel_loss, weights))
 
             self.sess = tf.Session(config=self.config, graph=graph)
-            self.sess.run([init, self.reset_conf_mat])
+            self.sess.run(init)
         else:
             with tf.device('/gpu:0'):
                 self.student = create_student_v3(meta_dir, class_weights=class_weights_exp, **kwargs)
                 self.saver = SaveHelper(graph=self.student['graph'], map_fun=lambda x: x)
+                if device_augment:
+                    # Cropping and scaling run in the graph, on the frames fed once per round
+                    self.device_input = create_device_input(self.student['graph'], [height, height * 2], scale,
+                                                            mini_batch_size)
                 with self.student['graph'].as_default():
-                    if cross_miou_compat:
-                        self.labels_after = tf.placeholder(tf.int32, [None, None])
-                        labels_after_one_hot = tf.one_hot(self.labels_after, self.TOTAL_CLASSES, axis=-1)
-                        labels_after_one_hot_reduced = tf.gather(labels_after_one_hot, self.class_indices_graph, axis=-1)
-                        labels_after_reduced = tf.argmax(labels_after_one_hot_reduced, axis=-1, output_type=tf.int32)
-                        self.labels_before = tf.placeholder(tf.int32, [None, None])
-                        labels_before_one_hot = tf.one_hot(self.labels_before, self.TOTAL_CLASSES, axis=-1)
-                        labels_before_one_hot_reduced = tf.gather(labels_before_one_hot, self.class_indices_graph, axis=-1)
-                        labels_before_reduced = tf.argmax(labels_before_one_hot_reduced, axis=-1, output_type=tf.int32)
-                        weights = tf.reduce_max(labels_before_one_hot_reduced, axis=-1) * \
-                                  tf.reduce_max(labels_after_one_hot_reduced, axis=-1)
-                        self.cross_mean_iou, self.cross_update_op = tf.metrics.mean_iou(
-                            labels=labels_before_reduced,
-                            predictions=labels_after_reduced,
-                            num_classes=self.class_count,
-                            weights=weights)
-
                     miou_list_vars = [v for v in tf.local_variables() if any(tag in v.name for tag in
                                                                              ['confusion', 'miou', 'mean_iou'])]
                     self.reset_conf_mat = tf.variables_initializer(miou_list_vars)
@@ -147,25 +129,42 @@ class SemanticNetwork(object):
                                       ['images:0', 'labels:0', 'label_cache:0', 'image_cache:0']]
 
             self.sess = tf.Session(graph=self.student['graph'], config=self.config)
+            self.init = init
             self.sess.run([init, self.reset_conf_mat])
 
             if filter_out is not None:
                 self.OPT_FILTER.extend(filter_out)
             self.filter = lambda elem: elem if all(
                 keyword not in elem for keyword in self.OPT_FILTER) and elem not in self.OP_FILTER else None
-            self.saver.restore_vars(self.sess, "%s.npy" % self.meta_dir, self.filter)
+            initial = load_checkpoint(self.meta_dir)
+            self.saver.restore_vars(self.sess, initial, self.filter)
+            # Kept in memory, so going back to the checkpoint is one feed instead of reading the npy again
+            self.initial_vars = [v for v in self.save_vars if v.name in initial]
+            self.saver.snapshot(self.sess, self.initial_vars, self.filter, 'initial')
             self.mask = None
 
         print("Semantic Network is ready!!!")
 
     def restore_initial(self):
-        self.saver.restore_vars(self.sess, "%s.npy" % self.meta_dir, self.filter)
+        with tracer.span('restore'):
+            self.saver.rollback(self.sess, 'initial')
+
+    def reset(self):
+        """
+        Brings a trainable network back to the state it was created in, including the optimizer's slots, so that a
+        cached network can be reused for another experiment instead of being rebuilt.
+        """
+        assert not self.frozen, "Frozen graphs have no state to reset"
+        self.sess.run([self.init, self.reset_conf_mat])
+        self.saver.rollback(self.sess, 'initial')
+        self.mask = None
 
     def restore(self, chk):
         self.saver.restore_vars(self.sess, chk, self.filter)
 
     def get_vars(self):
-        return self.saver.save_vars(self.sess, self.save_vars, lambda x: x)
+        # A plain dict, it may be restored into another network's graph after this one is closed
+        return self.saver.save_flat(self.sess, self.save_vars, lambda x: x).to_dict()
 
     def predict_input(self, frames):
         self.process_lock.acquire()
@@ -182,34 +181,47 @@ class SemanticNetwork(object):
         return labels_
 
     def calc_cross_miou(self, labels):
-        assert not self.frozen or self.cross_miou_compat
         assert labels.shape == (2, self.height, 2 * self.height)
-        self.process_lock.acquire()
-        self.sess.run(self.reset_conf_mat)
-        conf_mat_ = self.sess.run(self.cross_update_op, feed_dict={self.labels_before: labels[0],
-                                                                   self.labels_after: labels[1]})
-        iou_ = calculate_miou(conf_mat_, nan=True)
+        labels_before, weights_before = reduce_labels_np(labels[0], self.label_lut, self.label_valid)
+        labels_after, weights_after = reduce_labels_np(labels[1], self.label_lut, self.label_valid)
+        conf_mat_ = confusion_matrix(labels_before, labels_after, self.class_count,
+                                     np.logical_and(weights_before, weights_after))
+        iou_ = iou_from_confusion(conf_mat_)
         miou_ = np.nanmean(iou_)
-        self.process_lock.release()
         return conf_mat_, iou_, miou_
 
+    def cross_miou_series(self, labels, pixel_budget=None):
+        """
+        Computes calc_cross_miou for every consecutive pair of labels in one vectorized pass.
+
+        :param labels: Sequence of full-set teacher labels
+        :param pixel_budget: If given, the total number of pixels compared over all pairs
+        :type labels: list of np.ndarray
+        :type pixel_budget: int
+        :return: The cross mIoU of each pair
+        :rtype: np.ndarray
+        """
+        return cross_miou_series(labels, self.label_lut, self.label_valid, self.class_count,
+                                 pixel_budget=pixel_budget)
+
     def predict_with_metric(self, frames, labels_teacher):
+        # The confusion matrix is computed host-side, so a single session run is needed per frame
         self.process_lock.acquire()
-        self.sess.run(self.reset_conf_mat)
         if self.frozen:
-            labels_student, conf_mat_, loss_ = self.sess.run([self.frozen_predictions, self.update_op, self.loss],
-                                                             feed_dict={self.frozen_labels_pl: labels_teacher,
-                                                                        self.frozen_image: frames})
+            labels_student, loss_ = self.sess.run([self.frozen_predictions, self.loss],
+                                                  feed_dict={self.frozen_labels_pl: labels_teacher,
+                                                             self.frozen_image: frames})
         else:
             self.sess.run(self.student['fill_input_buffer'],
                           feed_dict={self.student['features_input']: frames,
                                      self.student['labels_input']: labels_teacher})
-            labels_student, conf_mat_, loss_ = self.sess.run([self.student['predictions'], self.student['update_op'],
-                                                              self.student['loss']])
+            labels_student, loss_ = self.sess.run([self.student['predictions'], self.student['loss']])
+        self.process_lock.release()
         assert labels_student.shape == frames.shape[:-1]
-        iou_ = calculate_miou(conf_mat_, nan=True)
+        labels_reduced, weights = reduce_labels_np(labels_teacher, self.label_lut, self.label_valid)
+        conf_mat_ = confusion_matrix(labels_reduced, labels_student, self.class_count, weights)
+        iou_ = iou_from_confusion(conf_mat_)
         miou_ = np.nanmean(iou_)
-        self.process_lock.release()
         return labels_student, conf_mat_, iou_, miou_, loss_
 
     def train_with_deque(self, frame_deque, label_deque, num_of_iterations, train_strategy='full_model',
@@ -219,9 +231,17 @@ class SemanticNetwork(object):
             self.mask = None
         self.process_lock.acquire()
         batch_deque = deque()
-        batch_thr = threading.Thread(target=self._fill_batch, args=(batch_deque, frame_deque, label_deque,
-                                                                    num_of_iterations,))
-        batch_thr.start()
+        if self.device_input is not None:
+            with tracer.span('round_upload', frames=len(frame_deque)):
+                self.sess.run(self.device_input['fill_round_buffer'],
+                              feed_dict={self.device_input['frames_input']: np.stack(
+                                             [frame_deque[k] for k in range(len(frame_deque))]).astype(np.uint8),
+                                         self.device_input['labels_input']: np.stack(
+                                             [label_deque[k] for k in range(len(label_deque))]).astype(np.uint8)})
+        else:
+            batch_thr = threading.Thread(target=self._fill_batch, args=(batch_deque, frame_deque, label_deque,
+                                                                        num_of_iterations,))
+            batch_thr.start()
         self._train(batch_deque, num_of_iterations, train_strategy)
 
     def _train(self, batch_deque, num_of_iterations, train_strategy):
@@ -235,18 +255,20 @@ class SemanticNetwork(object):
         else:
             train_node = self.student['train']
 
-        _before, train_mask_ = self.get_train_mask(train_strategy)
+        with tracer.span('mask_selection', strategy=train_strategy):
+            _before, train_mask_ = self.get_train_mask(train_strategy)
 
         iteration_update_ops = {'train_node': train_node,
                                 'loss': self.student['loss']}
 
         for it in range(num_of_iterations):
             signal = None
-            while signal is None:
-                try:
-                    signal = signal_deque.popleft()
-                except IndexError:
-                    time.sleep(self.THREAD_SLEEP_INTERVAL)
+            with tracer.span('batch_wait', it=it):
+                while signal is None:
+                    try:
+                        signal = signal_deque.popleft()
+                    except IndexError:
+                        time.sleep(self.THREAD_SLEEP_INTERVAL)
             t1 = time.time()
 
             # Construct the feed_dict
@@ -256,14 +278,24 @@ class SemanticNetwork(object):
                 for k in train_mask_:
                     feed_dict[k] = train_mask_[k]
 
-            # Call for execution
-            results = self.sess.run(iteration_update_ops, feed_dict=feed_dict)
+            # Call for execution, optionally with a full step trace
+            with tracer.span('train_step', it=it) as record:
+                if tracer.should_profile(it):
+                    run_metadata = tf.RunMetadata()
+                    results = self.sess.run(iteration_update_ops, feed_dict=feed_dict,
+                                            options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+                                            run_metadata=run_metadata)
+                    save_run_metadata(run_metadata, tracer.next_profile_path(it))
+                else:
+                    results = self.sess.run(iteration_update_ops, feed_dict=feed_dict)
+                record['loss'] = float(results['loss'])
             print('Loss is %.3f at iteration %d and took %.1f ms' % (results['loss'], it, (time.time() - t1) * 1000.0))
 
             if train_strategy == 'coord_desc_auto':
                 if it == 0 and self.mask is None:
                     # Update the train_mask
-                    _after = self.saver.save_vars(self.sess, self.save_vars, self.filter)
+                    t_mask = time.perf_counter()
+                    _after = self.saver.save_flat(self.sess, self.save_vars, self.filter)
                     changes = []
                     for k in self.student['grad_masks_pl']:
                         changes.append(np.reshape(np.abs(_after[k] - _before[k]), (-1,)))
@@ -272,7 +304,8 @@ class SemanticNetwork(object):
                     numvars_list = []
                     train_vars_len = 0
                     all_vars = 0
-                    _combine = {}
+                    # Variables outside the masks keep their trained values
+                    _combine = _after.copy()
                     for var_name in self.student['grad_masks_pl']:
                         train_mask_[self.student['grad_masks_pl'][var_name]] = np.abs(
                             _after[var_name] - _before[var_name]) > cut_threshold
@@ -280,20 +313,20 @@ class SemanticNetwork(object):
                         train_vars_len += np.sum(train_mask_[self.student['grad_masks_pl'][var_name]])
                         all_vars += train_mask_[self.student['grad_masks_pl'][var_name]].size
                         numvars_list.append(np.sum(train_mask_[self.student['grad_masks_pl'][var_name]]))
-                        _combine[var_name] = np.where(train_mask_[self.student['grad_masks_pl'][var_name]],
-                                                      _after[var_name], _before[var_name])
-                        assert _combine[var_name].shape == _before[var_name].shape
+                        _combine[var_name][...] = np.where(train_mask_[self.student['grad_masks_pl'][var_name]],
+                                                           _after[var_name], _before[var_name])
                     print("Using auto mode, Training %.3f%% of variables" % (100 * train_vars_len / all_vars))
-                    self.saver.restore_vars(self.sess, _combine, self.filter)
+                    self.saver.restore_flat(self.sess, _combine)
                     self.mask = train_mask_
+                    tracer.add('mask_update', t_mask, time.perf_counter() - t_mask, strategy=train_strategy)
 
         if 'coord_desc_' in train_strategy:
             self.curr_mask = [train_mask_[self.student['grad_masks_pl'][var_name]]
                               for var_name in self.student['grad_masks_pl']]
-            _after_train = self.saver.save_vars(self.sess, self.save_vars, self.filter)
+            _after_train = self.saver.save_flat(self.sess, self.save_vars, self.filter)
             self.train_params = [_after_train[var_name] for var_name in self.student['grad_masks_pl']]
         else:
-            _after_train = self.saver.save_vars(self.sess, self.save_vars, self.filter)
+            _after_train = self.saver.save_flat(self.sess, self.save_vars, self.filter)
             self.train_params = [_after_train[var_name] for var_name in _after_train.keys()]
             self.curr_mask = [np.ones_like(_after_train[var_name], dtype=np.bool) for var_name in _after_train.keys()]
 
@@ -301,14 +334,14 @@ class SemanticNetwork(object):
 
     def get_train_mask(self, train_strategy):
         if train_strategy == 'coord_desc_auto':
-            _before = self.saver.save_vars(self.sess, self.save_vars, self.filter)
+            _before = self.saver.save_flat(self.sess, self.save_vars, self.filter)
             if self.mask is None:
                 train_mask_ = {self.student['grad_masks_pl'][var_name]: np.ones(_before[var_name].shape, dtype=np.bool)
                                for var_name in self.student['grad_masks_pl']}
             else:
                 train_mask_ = self.mask
         elif train_strategy == 'coord_desc_last' and self.coord_frac == 0.1:
-            _before = self.saver.save_vars(self.sess, self.save_vars, self.filter)
+            _before = self.saver.save_flat(self.sess, self.save_vars, self.filter)
             train_mask_ = {self.student['grad_masks_pl'][var_name]: np.zeros(_before[var_name].shape, dtype=np.bool)
                            for var_name in self.student['grad_masks_pl']}
             for key in ['aspp0/BatchNorm/gamma:0', 'aspp0/BatchNorm/beta:0', 'concat_projection/weights:0',
@@ -324,7 +357,7 @@ class SemanticNetwork(object):
             print("Using last10 mode, Training %.3f%% of variables" % (100 * train_vars_len / all_vars))
 
         elif train_strategy == 'coord_desc_first' and self.coord_frac == 0.1:
-            _before = self.saver.save_vars(self.sess, self.save_vars, self.filter)
+            _before = self.saver.save_flat(self.sess, self.save_vars, self.filter)
             train_mask_ = {self.student['grad_masks_pl'][var_name]: np.zeros(_before[var_name].shape, dtype=np.bool)
                            for var_name in self.student['grad_masks_pl']}
             for key in self.student['grad_masks_pl']:
@@ -350,7 +383,7 @@ class SemanticNetwork(object):
             all_vars, train_vars_len = self.train_vars_count(train_mask_)
             print("Using first10 mode, Training %.3f%% of variables" % (100 * train_vars_len / all_vars))
         elif train_strategy == 'coord_desc_both' and self.coord_frac == 0.1:
-            _before = self.saver.save_vars(self.sess, self.save_vars, self.filter)
+            _before = self.saver.save_flat(self.sess, self.save_vars, self.filter)
             train_mask_ = {self.student['grad_masks_pl'][var_name]: np.zeros(_before[var_name].shape, dtype=np.bool)
                            for var_name in self.student['grad_masks_pl']}
             for key in self.student['grad_masks_pl']:
@@ -383,7 +416,7 @@ class SemanticNetwork(object):
             all_vars, train_vars_len = self.train_vars_count(train_mask_)
             print("Using both10 mode, Training %.3f%% of variables" % (100 * train_vars_len / all_vars))
         elif train_strategy == 'coord_desc_last' and self.coord_frac == 0.05:
-            _before = self.saver.save_vars(self.sess, self.save_vars, self.filter)
+            _before = self.saver.save_flat(self.sess, self.save_vars, self.filter)
             train_mask_ = {self.student['grad_masks_pl'][var_name]: np.zeros(_before[var_name].shape, dtype=np.bool)
                            for var_name in self.student['grad_masks_pl']}
             for key in self.student['grad_masks_pl']:
@@ -399,7 +432,7 @@ class SemanticNetwork(object):
             all_vars, train_vars_len = self.train_vars_count(train_mask_)
             print("Using last5 mode, Training %.3f%% of variables" % (100 * train_vars_len / all_vars))
         elif train_strategy == 'coord_desc_first' and self.coord_frac == 0.05:
-            _before = self.saver.save_vars(self.sess, self.save_vars, self.filter)
+            _before = self.saver.save_flat(self.sess, self.save_vars, self.filter)
             train_mask_ = {self.student['grad_masks_pl'][var_name]: np.zeros(_before[var_name].shape, dtype=np.bool)
                            for var_name in self.student['grad_masks_pl']}
             for key in self.student['grad_masks_pl']:
@@ -424,7 +457,7 @@ class SemanticNetwork(object):
             all_vars, train_vars_len = self.train_vars_count(train_mask_)
             print("Using first5 mode, Training %.3f%% of variables" % (100 * train_vars_len / all_vars))
         elif train_strategy == 'coord_desc_both' and self.coord_frac == 0.05:
-            _before = self.saver.save_vars(self.sess, self.save_vars, self.filter)
+            _before = self.saver.save_flat(self.sess, self.save_vars, self.filter)
             train_mask_ = {self.student['grad_masks_pl'][var_name]: np.zeros(_before[var_name].shape, dtype=np.bool)
                            for var_name in self.student['grad_masks_pl']}
             for key in self.student['grad_masks_pl']:
@@ -453,7 +486,7 @@ class SemanticNetwork(object):
             all_vars, train_vars_len = self.train_vars_count(train_mask_)
             print("Using both5 mode, Training %.3f%% of variables" % (100 * train_vars_len / all_vars))
         elif train_strategy == 'coord_desc_last' and self.coord_frac == 0.01:
-            _before = self.saver.save_vars(self.sess, self.save_vars, self.filter)
+            _before = self.saver.save_flat(self.sess, self.save_vars, self.filter)
             train_mask_ = {self.student['grad_masks_pl'][var_name]: np.zeros(_before[var_name].shape, dtype=np.bool)
                            for var_name in self.student['grad_masks_pl']}
             for key in self.student['grad_masks_pl']:
@@ -469,7 +502,7 @@ class SemanticNetwork(object):
             print("Using last1 mode, Training %.3f%% of variables" % (100 * train_vars_len / all_vars))
 
         elif train_strategy == 'coord_desc_first' and self.coord_frac == 0.01:
-            _before = self.saver.save_vars(self.sess, self.save_vars, self.filter)
+            _before = self.saver.save_flat(self.sess, self.save_vars, self.filter)
             train_mask_ = {self.student['grad_masks_pl'][var_name]: np.zeros(_before[var_name].shape, dtype=np.bool)
                            for var_name in self.student['grad_masks_pl']}
             for key in self.student['grad_masks_pl']:
@@ -488,7 +521,7 @@ class SemanticNetwork(object):
             all_vars, train_vars_len = self.train_vars_count(train_mask_)
             print("Using first1 mode, Training %.3f%% of variables" % (100 * train_vars_len / all_vars))
         elif train_strategy == 'coord_desc_both' and self.coord_frac == 0.01:
-            _before = self.saver.save_vars(self.sess, self.save_vars, self.filter)
+            _before = self.saver.save_flat(self.sess, self.save_vars, self.filter)
             train_mask_ = {self.student['grad_masks_pl'][var_name]: np.zeros(_before[var_name].shape, dtype=np.bool)
                            for var_name in self.student['grad_masks_pl']}
             for key in self.student['grad_masks_pl']:
@@ -513,7 +546,7 @@ class SemanticNetwork(object):
             all_vars, train_vars_len = self.train_vars_count(train_mask_)
             print("Using both1 mode, Training %.3f%% of variables" % (100 * train_vars_len / all_vars))
         elif train_strategy == 'coord_desc_last' and self.coord_frac == 0.2:
-            _before = self.saver.save_vars(self.sess, self.save_vars, self.filter)
+            _before = self.saver.save_flat(self.sess, self.save_vars, self.filter)
             train_mask_ = {self.student['grad_masks_pl'][var_name]: np.zeros(_before[var_name].shape, dtype=np.bool)
                            for var_name in self.student['grad_masks_pl']}
             for key in self.student['grad_masks_pl']:
@@ -531,7 +564,7 @@ class SemanticNetwork(object):
             all_vars, train_vars_len = self.train_vars_count(train_mask_)
             print("Using last20 mode, Training %.3f%% of variables" % (100 * train_vars_len / all_vars))
         elif train_strategy == 'coord_desc_first' and self.coord_frac == 0.2:
-            _before = self.saver.save_vars(self.sess, self.save_vars, self.filter)
+            _before = self.saver.save_flat(self.sess, self.save_vars, self.filter)
             train_mask_ = {self.student['grad_masks_pl'][var_name]: np.zeros(_before[var_name].shape, dtype=np.bool)
                            for var_name in self.student['grad_masks_pl']}
             for key in self.student['grad_masks_pl']:
@@ -558,7 +591,7 @@ class SemanticNetwork(object):
             all_vars, train_vars_len = self.train_vars_count(train_mask_)
             print("Using first20 mode, Training %.3f%% of variables" % (100 * train_vars_len / all_vars))
         elif train_strategy == 'coord_desc_both' and self.coord_frac == 0.2:
-            _before = self.saver.save_vars(self.sess, self.save_vars, self.filter)
+            _before = self.saver.save_flat(self.sess, self.save_vars, self.filter)
             train_mask_ = {self.student['grad_masks_pl'][var_name]: np.zeros(_before[var_name].shape, dtype=np.bool)
                            for var_name in self.student['grad_masks_pl']}
             for key in self.student['grad_masks_pl']:
@@ -592,7 +625,7 @@ class SemanticNetwork(object):
             all_vars, train_vars_len = self.train_vars_count(train_mask_)
             print("Using both20 mode, Training %.3f%% of variables" % (100 * train_vars_len / all_vars))
         elif train_strategy == 'coord_desc_last' and self.coord_frac == 0.02:
-            _before = self.saver.save_vars(self.sess, self.save_vars, self.filter)
+            _before = self.saver.save_flat(self.sess, self.save_vars, self.filter)
             train_mask_ = {self.student['grad_masks_pl'][var_name]: np.zeros(_before[var_name].shape, dtype=np.bool)
                            for var_name in self.student['grad_masks_pl']}
             for key in self.student['grad_masks_pl']:
@@ -607,7 +640,7 @@ class SemanticNetwork(object):
             all_vars, train_vars_len = self.train_vars_count(train_mask_)
             print("Using last2 mode, Training %.3f%% of variables" % (100 * train_vars_len / all_vars))
         elif train_strategy == 'coord_desc_first' and self.coord_frac == 0.02:
-            _before = self.saver.save_vars(self.sess, self.save_vars, self.filter)
+            _before = self.saver.save_flat(self.sess, self.save_vars, self.filter)
             train_mask_ = {self.student['grad_masks_pl'][var_name]: np.zeros(_before[var_name].shape, dtype=np.bool)
                            for var_name in self.student['grad_masks_pl']}
             for key in self.student['grad_masks_pl']:
@@ -626,7 +659,7 @@ class SemanticNetwork(object):
             all_vars, train_vars_len = self.train_vars_count(train_mask_)
             print("Using first2 mode, Training %.3f%% of variables" % (100 * train_vars_len / all_vars))
         elif train_strategy == 'coord_desc_both' and self.coord_frac == 0.02:
-            _before = self.saver.save_vars(self.sess, self.save_vars, self.filter)
+            _before = self.saver.save_flat(self.sess, self.save_vars, self.filter)
             train_mask_ = {self.student['grad_masks_pl'][var_name]: np.zeros(_before[var_name].shape, dtype=np.bool)
                            for var_name in self.student['grad_masks_pl']}
             for key in self.student['grad_masks_pl']:
@@ -652,7 +685,7 @@ class SemanticNetwork(object):
             all_vars, train_vars_len = self.train_vars_count(train_mask_)
             print("Using both2 mode, Training %.3f%% of variables" % (100 * train_vars_len / all_vars))
         elif train_strategy == 'coord_desc_rand':
-            _before = self.saver.save_vars(self.sess, self.save_vars, self.filter)
+            _before = self.saver.save_flat(self.sess, self.save_vars, self.filter)
             train_mask_ = {
                 self.student['grad_masks_pl'][var_name]: np.random.choice([True, False], size=_before[var_name].shape,
                                                                           p=[self.coord_frac,
@@ -677,6 +710,8 @@ class SemanticNetwork(object):
         return all_vars, train_vars_len
 
     def _fill_batch(self, batch_deque, frame_deque, label_deque, number_of_batches):
+        # A replay memory may keep the scaled samples across iterations and rounds
+        cache = getattr(frame_deque, 'pyramid', None)
         for batch_index in range(number_of_batches):
             image_batch, label_batch = mini_batch(frame_deque,
                                                   label_deque,
@@ -684,7 +719,8 @@ class SemanticNetwork(object):
                                                   self.scale,
                                                   self.mini_batch_size,
                                                   1,
-                                                  flip=False)
+                                                  flip=False,
+                                                  cache=cache)
 
             assert np.shape(label_batch) == (1, self.mini_batch_size, self.height, self.height * 2)
             assert np.shape(image_batch) == (1, self.mini_batch_size, self.height, self.height * 2, 3)
@@ -692,6 +728,10 @@ class SemanticNetwork(object):
 
     def _fill_queue(self, batch_deque, number_of_batches, signal_deque):
         for batch_index in range(number_of_batches):
+            if self.device_input is not None:
+                self.sess.run(self.device_input['augment_step'])
+                signal_deque.append(1)
+                continue
             batch = None
             while batch is None:
                 try:
@@ -709,9 +749,10 @@ class SemanticNetwork(object):
                                  kill_norms=True)
 
     def save_to_frozen_graph(self, save_dir):
-        graph_def = self.get_frozen_graph()
-        with open(save_dir + ".pb", 'wb') as pb_file:
-            pb_file.write(graph_def.SerializeToString())
+        with tracer.span('export'):
+            graph_def = self.get_frozen_graph()
+            with open(save_dir + ".pb", 'wb') as pb_file:
+                pb_file.write(graph_def.SerializeToString())
 
     def close_model(self):
         self.sess.close()
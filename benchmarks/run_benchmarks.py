@@ -0,0 +1,384 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+from collections import deque
+
+import numpy as np
+import cv2
+from termcolor import colored
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+import tensorflow as tf
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from ams.benchmarks.synthetic import make_video, make_student_checkpoint, SYNTHETIC_EXP_NUM
+from ams.exp_configs import class_weights
+from ams.SemanticNetwork import SemanticNetwork
+from ams.utils.graph_utils import create_student_v3
+from ams.utils.checkpoint import Checkpoint, CHECKPOINT_EXT, write_checkpoint
+from ams.utils.replay_memory import ReplayMemory, ScalePyramid
+from ams.utils.utils import mini_batch, calculate_miou, choose_frames, choose_indices, pack_update, \
+    compress_update, frame_thumbnail, content_change
+
+BENCHMARKS = ['decode', 'content_scoring', 'checkpoint_load', 'student_build', 'mini_batch', 'scale_pyramid',
+              'calculate_miou', 'choose_frames', 'restore_vars', 'snapshot_vars', 'train_step', 'train_step_device',
+              'save_to_frozen_graph', 'predict_with_metric', 'downlink_packing', 'end_to_end']
+
+# Prefixes of the repository's checkpoints, skipped by checkpoint_load when their .npy is not there
+CHECKPOINTS = [os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'checkpoints', name, 'model')
+               for name in ['deeplabv3_mobilenetv2_cityscapes', 'deeplabv3_mobilenetv2_pascalvoc2012']]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmarks of the hot paths on a synthetic video and student')
+    parser.add_argument('--work_dir', type=str, default='/tmp/ams_benchmarks/',
+                        help='Where the synthetic video, labels and checkpoint are generated')
+    parser.add_argument('--regenerate', action='store_true', help='Regenerate the synthetic data even if it exists')
+    parser.add_argument('--gpu', type=str, default='0', help='GPU to use for this')
+    parser.add_argument('--height', type=int, default=128, help='height of the synthetic video')
+    parser.add_argument('--seconds', type=int, default=20, help='Length of the synthetic video')
+    parser.add_argument('--width', type=int, default=8, help='Channels of the synthetic student')
+    parser.add_argument('--batch_size', type=int, default=10, help='Mini batch size')
+    parser.add_argument('--iter', type=int, default=20, help='Training iterations per timed training')
+    parser.add_argument('--send_periods', type=str, default='1,3,10,30',
+                        help='Comma separated --send_period values the decode benchmark samples frames with')
+    parser.add_argument('--train_period', type=int, default=10,
+                        help='Seconds between sends of the sampled frames in the decode benchmark')
+    parser.add_argument('--checkpoints', type=str, default=','.join(CHECKPOINTS),
+                        help='Comma separated checkpoint prefixes whose .npy the checkpoint_load benchmark converts')
+    parser.add_argument('--repeat', type=int, default=20, help='Timed repetitions of every benchmark')
+    parser.add_argument('--only', type=str, default=','.join(BENCHMARKS),
+                        help='Comma separated benchmarks to run, among %s' % ', '.join(BENCHMARKS))
+    parser.add_argument('--output', type=str, default=None, help='Save the results as a JSON baseline here')
+    parser.add_argument('--baseline', type=str, default=None, help='Compare the results with this JSON baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Relative slowdown of the median over the baseline reported as a regression')
+    args = parser.parse_args()
+    for name in args.only.split(','):
+        assert name in BENCHMARKS, 'Unknown benchmark %s' % name
+    return args
+
+
+def timed(fn, repeat, warmup=1):
+    """
+    :param fn: The function to time, called without arguments
+    :param repeat: Number of timed calls
+    :param warmup: Number of untimed calls before
+    :type fn: callable
+    :type repeat: int
+    :type warmup: int
+    :return: Statistics of the durations in ms
+    :rtype: dict
+    """
+    for _ in range(warmup):
+        fn()
+    durations = []
+    for _ in range(repeat):
+        t1 = time.perf_counter()
+        fn()
+        durations.append((time.perf_counter() - t1) * 1000)
+    return {'median_ms': float(np.median(durations)), 'mean_ms': float(np.mean(durations)),
+            'min_ms': float(np.min(durations)), 'p95_ms': float(np.percentile(durations, 95)), 'repeat': repeat}
+
+
+def prepare_data(args):
+    """
+    Generates the synthetic video, labels and student checkpoint unless they already exist.
+
+    :return: Paths of the video, the labels and the student checkpoint
+    :rtype: (str, str, str)
+    """
+    tag = 'h%d_s%d_w%d' % (args.height, args.seconds, args.width)
+    video = os.path.join(args.work_dir, tag, '%d-synthetic.mp4' % SYNTHETIC_EXP_NUM)
+    gt_path = os.path.join(args.work_dir, tag, '%d-synthetic' % SYNTHETIC_EXP_NUM) + '/'
+    student = os.path.join(args.work_dir, tag, 'student', 'model')
+    if args.regenerate and os.path.exists(os.path.join(args.work_dir, tag)):
+        shutil.rmtree(os.path.join(args.work_dir, tag))
+    if not os.path.exists(video):
+        print(colored("Benchmark:", "green"), "Generating a %d s synthetic video" % args.seconds)
+        os.makedirs(os.path.dirname(video), exist_ok=True)
+        make_video(video, gt_path, args.seconds, args.height)
+    if not os.path.exists(student + '.npy'):
+        make_student_checkpoint(student, args.width)
+    return video, gt_path, student
+
+
+def load_memory(video, gt_path, height, num_frames):
+    # Reads frames and labels the way train_model puts them in the replay memory
+    cap = cv2.VideoCapture(video)
+    frames, labels = deque(), deque()
+    for index_frame in range(num_frames):
+        ret, frame = cap.read()
+        assert ret, 'Synthetic video is too short'
+        frames.append(cv2.cvtColor(cv2.resize(frame, (height * 2, height)), cv2.COLOR_BGR2RGB))
+        gt = cv2.imread("%sgt_%06d.png" % (gt_path, index_frame), cv2.IMREAD_GRAYSCALE)
+        labels.append(cv2.resize(gt, (height * 2, height), interpolation=cv2.INTER_NEAREST))
+    cap.release()
+    return frames, labels
+
+
+def checkpoint_loads(npy_path, ckpt_path, repeat):
+    """
+    Times loading a checkpoint from its pickled .npy and from its .amsckpt, opened only or with every tensor read.
+
+    :return: The statistics by name
+    :rtype: dict
+    """
+    write_checkpoint(ckpt_path, np.load(npy_path, allow_pickle=True).item())
+
+    def read_all():
+        checkpoint = Checkpoint(ckpt_path)
+        for name in checkpoint:
+            np.array(checkpoint[name])
+    results = {'npy': timed(lambda: np.load(npy_path, allow_pickle=True).item(), repeat),
+               'amsckpt_open': timed(lambda: Checkpoint(ckpt_path), repeat),
+               'amsckpt_all': timed(read_all, repeat)}
+    for name in results:
+        results[name]['file_bytes'] = os.path.getsize(npy_path if name == 'npy' else ckpt_path)
+    return results
+
+
+def decode_video(video, gt_path, height, bucket_seconds, sample_fraction, skip):
+    """
+    Reads the video and labels the way train_model does, sending sample_fraction of the frames every bucket_seconds.
+
+    :param skip: Choose the frames before reading them and only grab the others, or else decode every frame and label
+    and choose the frames afterwards
+    :type skip: bool
+    :return: The number of seconds read
+    :rtype: int
+    """
+    cap = cv2.VideoCapture(video)
+    fps = round(cap.get(cv2.CAP_PROP_FPS))
+    bucket_length = bucket_seconds * fps
+    index_frame = 0
+    while True:
+        bucket = []
+        chosen = set(choose_indices(bucket_length, sample_fraction).tolist()) if skip else None
+        for offset in range(bucket_length):
+            if skip and offset not in chosen:
+                ret = cap.grab()
+            else:
+                ret, frame = cap.read()
+                if ret:
+                    gt = cv2.imread("%sgt_%06d.png" % (gt_path, index_frame), cv2.IMREAD_GRAYSCALE)
+                    bucket.append((frame, gt))
+            if not ret:
+                cap.release()
+                return index_frame // fps
+            index_frame += 1
+        if not skip:
+            bucket = list(zip(*choose_frames(bucket, sample_fraction)))
+        for frame, gt in bucket:
+            cv2.resize(frame, (height * 2, height))
+            cv2.resize(gt, (height * 2, height), interpolation=cv2.INTER_NEAREST)
+
+
+def run_benchmarks(args, video, gt_path, student):
+    only = args.only.split(',')
+    results = {}
+    frames, labels = load_memory(video, gt_path, args.height, 60)
+    height = args.height
+
+    if 'decode' in only:
+        # Per simulated second, for train_model's send rates of send_period / fps
+        fps = round(cv2.VideoCapture(video).get(cv2.CAP_PROP_FPS))
+        for send_period in [int(period) for period in args.send_periods.split(',')]:
+            for skip, name in [(False, 'decode_all'), (True, 'decode_skip')]:
+                result = timed(lambda: decode_video(video, gt_path, height, args.train_period, send_period / fps, skip),
+                               max(args.repeat // 10, 1))
+                results['%s_sp%d' % (name, send_period)] = {k: v / args.seconds if k.endswith('_ms') else v
+                                                             for k, v in result.items()}
+    if 'content_scoring' in only:
+        # Per frame, to compare with decode_all_sp*, which is per second
+        bgr_frames = [cv2.cvtColor(frame, cv2.COLOR_RGB2BGR) for frame in frames]
+        index = [0]
+
+        def score():
+            k = index[0] % len(bgr_frames)
+            index[0] += 1
+            content_change(frame_thumbnail(bgr_frames[k]), frame_thumbnail(labels[k]),
+                           frame_thumbnail(bgr_frames[k - 1]), frame_thumbnail(labels[k - 1]))
+        results['content_scoring'] = timed(score, args.repeat * 10)
+    if 'checkpoint_load' in only:
+        checkpoints = [('synthetic', student)]
+        for prefix in args.checkpoints.split(','):
+            if os.path.exists(prefix + '.npy'):
+                checkpoints.append((os.path.basename(os.path.dirname(prefix)), prefix))
+            else:
+                print(colored("Benchmark:", "yellow"), "Skipping checkpoint_load of %s, no .npy found" % prefix)
+        for tag, prefix in checkpoints:
+            ckpt_path = os.path.join(args.work_dir, tag + CHECKPOINT_EXT)
+            for name, result in checkpoint_loads(prefix + '.npy', ckpt_path, args.repeat).items():
+                results['checkpoint_load_%s_%s' % (tag, name)] = result
+    if 'mini_batch' in only:
+        results['mini_batch'] = timed(lambda: mini_batch(frames, labels, [height, height * 2], [1], args.batch_size, 1),
+                                      args.repeat)
+    if 'scale_pyramid' in only:
+        # Training iterations over a replay memory with crops from scales other than 1, resized every time or cached
+        for name, pyramid in [('mini_batch_scales', None), ('mini_batch_pyramid', ScalePyramid())]:
+            memory = ReplayMemory(len(frames), spill='none', pyramid=pyramid)
+            memory.extend(frames, labels)
+            results[name] = timed(lambda: mini_batch(memory.frames, memory.labels, [height, height * 2],
+                                                     [1, 1.25, 1.5], args.batch_size, 1, cache=pyramid), args.repeat)
+            if pyramid is not None:
+                stats = pyramid.round_stats()
+                results[name]['hit_rate'] = stats['hits'] / max(stats['hits'] + stats['misses'], 1)
+                results[name]['cached_bytes'] = stats['bytes']
+    if 'calculate_miou' in only:
+        conf_mat = np.random.randint(0, 1000, size=(7, 7)).astype(np.float64)
+        results['calculate_miou'] = timed(lambda: calculate_miou(conf_mat, nan=True), args.repeat * 50)
+    if 'choose_frames' in only:
+        bucket = [(frame, label) for frame, label in zip(frames, labels)] * 5
+        results['choose_frames'] = timed(lambda: choose_frames(bucket, 0.1), args.repeat * 50)
+
+    if 'student_build' in only:
+        for lean, name in [(False, 'student_build_full'), (True, 'student_build_lean')]:
+            graphs = []
+            results[name] = timed(lambda: graphs.append(create_student_v3(
+                student, class_weights=class_weights(SYNTHETIC_EXP_NUM), lean=lean)['graph']), max(args.repeat // 4, 1))
+            results[name]['graph_def_bytes'] = graphs[-1].as_graph_def().ByteSize()
+            del graphs[:]
+        # The lean student must still export, as save_to_frozen_graph does with --lean_student
+        lean_network = SemanticNetwork(meta_dir=student, class_weights_exp=class_weights(SYNTHETIC_EXP_NUM),
+                                       height=height, gpu_id=args.gpu, scale=[1], mini_batch_size=args.batch_size,
+                                       lr=1e-3, train_biases_only=False, regularize=False, masked_gradients=False,
+                                       lean=True)
+        frozen_graph_defs = []
+        results['student_freeze_lean'] = timed(lambda: frozen_graph_defs.append(lean_network.get_frozen_graph()),
+                                               max(args.repeat // 4, 1))
+        results['student_freeze_lean']['graph_def_bytes'] = frozen_graph_defs[-1].ByteSize()
+        del frozen_graph_defs[:]
+        lean_network.close_model()
+    train_benchmarks = ['restore_vars', 'snapshot_vars', 'train_step', 'save_to_frozen_graph',
+                        'predict_with_metric', 'downlink_packing']
+    if any(name in only for name in train_benchmarks):
+        semantic_network = SemanticNetwork(meta_dir=student, class_weights_exp=class_weights(SYNTHETIC_EXP_NUM),
+                                           height=height, gpu_id=args.gpu, scale=[1],
+                                           mini_batch_size=args.batch_size, lr=1e-3, train_biases_only=False,
+                                           regularize=False, masked_gradients=False)
+        frozen_dir = os.path.join(os.path.dirname(student), 'frozen')
+        if 'restore_vars' in only:
+            results['restore_vars'] = timed(semantic_network.restore_initial, args.repeat)
+        if 'snapshot_vars' in only:
+            saver = semantic_network.saver
+            results['snapshot_vars'] = timed(
+                lambda: saver.save_flat(semantic_network.sess, semantic_network.save_vars, semantic_network.filter),
+                args.repeat)
+            results['save_vars_dict'] = timed(
+                lambda: saver.save_vars(semantic_network.sess, semantic_network.save_vars, semantic_network.filter),
+                args.repeat)
+        # Training also fills curr_mask and train_params, needed by downlink_packing
+        train_result = timed(lambda: semantic_network.train_with_deque(frames, labels, args.iter),
+                             max(args.repeat // 4, 1))
+        if 'train_step' in only:
+            results['train_step'] = {k: v / args.iter if k.endswith('_ms') else v for k, v in train_result.items()}
+        if 'downlink_packing' in only:
+            update_path = os.path.join(os.path.dirname(student), 'update.dat')
+
+            def downlink():
+                pack_update(update_path, semantic_network.curr_mask, semantic_network.train_params)
+                compress_update(update_path)
+            results['downlink_packing'] = timed(downlink, args.repeat)
+        save_result = timed(lambda: semantic_network.save_to_frozen_graph(frozen_dir), max(args.repeat // 4, 1))
+        if 'save_to_frozen_graph' in only:
+            results['save_to_frozen_graph'] = save_result
+        semantic_network.close_model()
+        if 'predict_with_metric' in only:
+            frozen_network = SemanticNetwork(meta_dir=frozen_dir, class_weights_exp=class_weights(SYNTHETIC_EXP_NUM),
+                                             height=height, gpu_id=args.gpu, frozen=True)
+            samples = [(np.expand_dims(frame, axis=0), np.expand_dims(label, axis=0))
+                       for frame, label in zip(frames, labels)]
+            index = [0]
+
+            def predict():
+                frame, label = samples[index[0] % len(samples)]
+                index[0] += 1
+                frozen_network.predict_with_metric(frame, label)
+            results['predict_with_metric'] = timed(predict, args.repeat * 5)
+            frozen_network.close_model()
+
+    if 'train_step_device' in only:
+        # Like train_step, with the mini batches cropped on the device from the memory uploaded once per training. Also
+        # with a student fed by a queue, as the DeepLab checkpoints are
+        queue_student = os.path.join(os.path.dirname(os.path.dirname(student)), 'student_queue', 'model')
+        if not os.path.exists(queue_student + '.npy'):
+            make_student_checkpoint(queue_student, args.width, queue=True)
+        for name, meta_dir in [('train_step_device', student), ('train_step_device_queue', queue_student)]:
+            semantic_network = SemanticNetwork(meta_dir=meta_dir, class_weights_exp=class_weights(SYNTHETIC_EXP_NUM),
+                                               height=height, gpu_id=args.gpu, scale=[1],
+                                               mini_batch_size=args.batch_size, lr=1e-3, train_biases_only=False,
+                                               regularize=False, masked_gradients=False, device_augment=True)
+            train_result = timed(lambda: semantic_network.train_with_deque(frames, labels, args.iter),
+                                 max(args.repeat // 4, 1))
+            results[name] = {k: v / args.iter if k.endswith('_ms') else v for k, v in train_result.items()}
+            semantic_network.close_model()
+
+    if 'end_to_end' in only:
+        results['end_to_end'] = timed(lambda: run_end_to_end(args, video, gt_path, student), 1, warmup=0)
+    return results
+
+
+def run_end_to_end(args, video, gt_path, student):
+    # Trains every 5 seconds over the whole synthetic video and infers with the models, as the simple mode does
+    from ams import run
+    output_dir = os.path.join(args.work_dir, 'end_to_end') + '/'
+    run.configure(run.parse_args(['--input_video', video, '--gt_video', gt_path, '--student_checkpoint', student,
+                                  '--output_dir', output_dir, '--gpu', args.gpu, '--mode', 'simple',
+                                  '--height', str(args.height), '--iter', str(args.iter),
+                                  '--batch_size', str(args.batch_size), '--train_period', '5', '--send_period', '3',
+                                  '--no_cache']))
+    os.makedirs(output_dir, exist_ok=True)
+    event_list = [0] + list(range(5, args.seconds, 5))
+    run.train_model(0, args.seconds, 3, args.gpu, 'bench', gt_path, SYNTHETIC_EXP_NUM, list(event_list), 5)
+    run.infer_output(0, args.seconds, args.gpu, 'bench', gt_path, SYNTHETIC_EXP_NUM, event_list)
+
+
+def compare(results, baseline, tolerance):
+    """
+    :return: The names of the benchmarks whose median got slower than the baseline by more than tolerance
+    :rtype: list of str
+    """
+    regressions = []
+    print("%-22s\t%12s\t%12s\t%8s" % ("Benchmark", "Median (ms)", "Baseline", "Change"))
+    for name in results:
+        median = results[name]['median_ms']
+        if name not in baseline:
+            print("%-22s\t%12.3f\t%12s\t%8s" % (name, median, '-', '-'))
+            continue
+        change = median / baseline[name]['median_ms'] - 1
+        print("%-22s\t%12.3f\t%12.3f\t%+7.1f%%" % (name, median, baseline[name]['median_ms'], change * 100))
+        if change > tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    args = parse_args()
+    video, gt_path, student = prepare_data(args)
+    results = run_benchmarks(args, video, gt_path, student)
+    report = {'meta': {'height': args.height, 'seconds': args.seconds, 'width': args.width,
+                       'batch_size': args.batch_size, 'iter': args.iter, 'repeat': args.repeat,
+                       'tensorflow': tf.__version__, 'numpy': np.__version__, 'opencv': cv2.__version__,
+                       'host': platform.node(), 'date': time.strftime('%Y-%m-%d %H:%M:%S')},
+              'results': results}
+    baseline = {}
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)['results']
+    regressions = compare(results, baseline, args.tolerance)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(colored("Benchmark:", "green"), "Results saved to %s" % args.output)
+    if regressions:
+        print(colored("Benchmark:", "red"), "Regressions in %s" % ', '.join(regressions))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+import os
+
+import numpy as np
+import cv2
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+import tensorflow as tf
+
+# Video number used for the synthetic video, its classes (exp_configs.class_weights) are drawn in the labels
+SYNTHETIC_EXP_NUM = 12
+SYNTHETIC_CLASSES = [0, 1, 2, 8, 10, 11, 13]
+TOTAL_CLASSES = 19
+
+
+def make_video(path, gt_path, seconds, height, fps=30, seed=0):
+    """
+    Writes a video of moving colored shapes over class regions, and its ground truth labels the way extract_labels
+    writes them (gt_%06d.png, one per frame).
+
+    :param path: The video's path, named VIDEO_NUM-VIDEO_NAME.mp4 like the real videos
+    :param gt_path: Directory of the labels
+    :param seconds: Length of the video
+    :param height: Height of the frames, the width is twice the height
+    :param fps: Frame rate
+    :param seed: Seed of the scene
+    :type path: str
+    :type gt_path: str
+    :type seconds: int
+    :type height: int
+    :type fps: int
+    :type seed: int
+    """
+    os.makedirs(gt_path, exist_ok=True)
+    rng = np.random.RandomState(seed)
+    width = height * 2
+    colors = rng.randint(0, 256, size=(TOTAL_CLASSES, 3)).astype(np.uint8)
+    # Static background: horizontal bands of classes, plus moving ellipses of other classes
+    background = np.zeros((height, width), dtype=np.uint8)
+    bands = np.sort(rng.choice(np.arange(1, height), 3, replace=False))
+    for index_band, (start, end) in enumerate(zip(np.concatenate([[0], bands]), np.concatenate([bands, [height]]))):
+        background[start:end] = SYNTHETIC_CLASSES[index_band]
+    shapes = [{'class': SYNTHETIC_CLASSES[4 + k % 3], 'center': rng.random_sample(2) * [width, height],
+               'velocity': (rng.random_sample(2) - 0.5) * height / fps,
+               'axes': (int(rng.randint(4, height // 4)), int(rng.randint(4, height // 4)))}
+              for k in range(6)]
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+    for index_frame in range(seconds * fps):
+        label = background.copy()
+        for shape in shapes:
+            shape['center'] = np.mod(shape['center'] + shape['velocity'], [width, height])
+            cv2.ellipse(label, (int(shape['center'][0]), int(shape['center'][1])), shape['axes'], 0, 0, 360,
+                        int(shape['class']), -1)
+        frame = colors[label]
+        frame = np.clip(frame.astype(np.int16) + rng.randint(-10, 11, size=frame.shape), 0, 255).astype(np.uint8)
+        writer.write(frame)
+        cv2.imwrite("%sgt_%06d.png" % (gt_path, index_frame), label)
+    writer.release()
+
+
+def make_student_checkpoint(prefix, width=8, seed=0, queue=False):
+    """
+    Builds a small-width stand-in for the DeepLab student and saves it as prefix.meta and prefix.npy, with the tensor
+    and operation names create_student_v3 looks up: features_input, labels_input, fill_input_buffer, features, labels,
+    logits and fused batch norms.
+
+    :param prefix: Path prefix of the checkpoint, e.g. work_dir/student/model
+    :param width: Number of channels of the hidden layers
+    :param seed: Seed of the initial weights
+    :param queue: Feed the input through a fifo_queue like the DeepLab checkpoints, instead of images and labels
+    variables
+    :type prefix: str
+    :type width: int
+    :type seed: int
+    :type queue: bool
+    """
+    os.makedirs(os.path.dirname(prefix), exist_ok=True)
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.set_random_seed(seed)
+        features_input = tf.placeholder(tf.float32, shape=[None, None, None, 3], name='features_input')
+        labels_input = tf.placeholder(tf.float32, shape=[None, None, None], name='labels_input')
+        if queue:
+            # As in the checkpoints of checkpoints/: labels first, then features
+            input_queue = tf.FIFOQueue(200, [tf.float32, tf.float32], name='fifo_queue')
+            input_queue.enqueue([labels_input, features_input], name='fill_input_buffer')
+            dequeued_labels, dequeued_features = input_queue.dequeue(name='fifo_queue_Dequeue')
+            dequeued_features.set_shape([None, None, None, 3])
+            features = tf.identity(tf.stop_gradient(dequeued_features), name='features')
+            tf.identity(dequeued_labels, name='labels')
+        else:
+            images = tf.Variable(tf.zeros([1, 1, 1, 3]), trainable=False, validate_shape=False, name='images')
+            labels = tf.Variable(tf.zeros([1, 1, 1]), trainable=False, validate_shape=False, name='labels')
+            tf.group(tf.assign(images, features_input, validate_shape=False),
+                     tf.assign(labels, labels_input, validate_shape=False), name='fill_input_buffer')
+            features = tf.identity(images, name='features')
+        net = features / 127.5 - 1
+        for index_layer, stride in enumerate([2, 2, 1]):
+            net = tf.layers.conv2d(net, width, 3, strides=stride, padding='same', use_bias=False,
+                                   name='conv_%d' % index_layer)
+            net = tf.layers.batch_normalization(net, fused=True, training=False, name='conv_%d_bn' % index_layer)
+            net = tf.nn.relu6(net)
+        net = tf.layers.conv2d(net, TOTAL_CLASSES, 1, name='semantic')
+        tf.image.resize_bilinear(net, tf.shape(features)[1:3], align_corners=True, name='logits')
+        init = tf.initializers.global_variables()
+        model_vars = [v for v in tf.global_variables() if v.name not in ['images:0', 'labels:0']]
+        with tf.Session() as sess:
+            sess.run(init)
+            np.save(prefix + '.npy', dict(zip([v.name for v in model_vars], sess.run(model_vars))))
+        tf.train.export_meta_graph(filename=prefix + '.meta', graph=graph)
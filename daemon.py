@@ -0,0 +1,190 @@
+import time
+
+TIME_START = time.time()
+
+import os
+import sys
+import json
+import shlex
+import socket
+import argparse
+import traceback
+from collections import OrderedDict
+
+import numpy as np
+from termcolor import colored
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+from ams import run
+from ams.SemanticNetwork import SemanticNetwork
+
+# Paid once by the daemon instead of once per experiment: importing TensorFlow and the experiment code
+IMPORT_TIME = time.time() - TIME_START
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Keeps TensorFlow and the student graphs loaded between experiments. '
+                                                 'Each job is a JSON object whose "args" are the arguments of run.py, '
+                                                 'as a list or a string.')
+    parser.add_argument('--socket', type=str, default=None,
+                        help='Path of a Unix socket to accept jobs on, one JSON job per line, answered with one JSON '
+                             'report per line. Send {"cmd": "shutdown"} to stop the daemon')
+    parser.add_argument('--job_file', type=str, default=None, help='File of JSON jobs, one per line, run in order')
+    parser.add_argument('--report_file', type=str, default=None,
+                        help='Where job reports are appended, defaults to job_file.reports.jsonl')
+    parser.add_argument('--max_networks', type=int, default=1,
+                        help='Number of student graphs kept loaded, more than one needs each of them to use a '
+                             'fraction of the GPU memory')
+    args = parser.parse_args()
+    assert (args.socket is None) != (args.job_file is None), 'Give exactly one of --socket and --job_file'
+    return args
+
+
+class NetworkCache(object):
+    """
+    Keeps the built student networks, keyed by everything that changes their graph, and hands them out reset to the
+    initial checkpoint. The least recently used network is closed when more than max_networks are needed.
+    """
+
+    def __init__(self, max_networks):
+        self.max_networks = max_networks
+        self.networks = OrderedDict()
+        self.built = 0
+        self.reused = 0
+        self.build_time = 0.
+
+    def get(self, kwargs):
+        """
+        :param kwargs: The arguments of the SemanticNetwork constructor
+        :type kwargs: dict
+        :rtype: SemanticNetwork
+        """
+        # The learning rate is fed at every step, so it does not need its own graph
+        key = tuple(sorted((k, v.tobytes() if isinstance(v, np.ndarray) else repr(v)) for k, v in kwargs.items()
+                           if k != 'lr'))
+        if key in self.networks:
+            self.networks.move_to_end(key)
+            semantic_network = self.networks[key]
+            semantic_network.reset()
+            self.reused += 1
+        else:
+            while len(self.networks) >= self.max_networks:
+                _, evicted = self.networks.popitem(last=False)
+                evicted.close_model()
+            t1 = time.time()
+            semantic_network = SemanticNetwork(**kwargs)
+            self.build_time += time.time() - t1
+            self.networks[key] = semantic_network
+            self.built += 1
+        semantic_network.lr = kwargs['lr']
+        return semantic_network
+
+    def close(self):
+        for semantic_network in self.networks.values():
+            semantic_network.close_model()
+        self.networks.clear()
+
+
+def run_job(job, cache, first):
+    """
+    Runs one experiment in this process.
+
+    :param job: The job, its args are the command line arguments of run.py
+    :param cache: The daemon's network cache
+    :param first: Whether this is the first job of the daemon, which is charged the import time
+    :type job: dict
+    :type cache: NetworkCache
+    :type first: bool
+    :return: The job's report, with its warm time and an estimate of what a fresh run.py invocation would take
+    :rtype: dict
+    """
+    argv = job['args'] if isinstance(job['args'], list) else shlex.split(job['args'])
+    built, reused, build_time = cache.built, cache.reused, cache.build_time
+    status = 'ok'
+    t1 = time.time()
+    try:
+        run.configure(run.parse_args(argv))
+        run.main()
+    except SystemExit as e:
+        status = 'exited with code %s' % e.code
+    except Exception as e:
+        traceback.print_exc()
+        status = 'failed: %r' % e
+    total = time.time() - t1
+    job_build_time = cache.build_time - build_time
+    networks_built = cache.built - built
+    networks_reused = cache.reused - reused
+    # A fresh invocation pays the imports and would have built the reused graphs too
+    mean_build_time = cache.build_time / cache.built if cache.built > 0 else 0.
+    report = {'id': job.get('id'),
+              'status': status,
+              'warm': networks_built == 0 and not first,
+              'import_s': IMPORT_TIME if first else 0.,
+              'graph_build_s': job_build_time,
+              'networks_built': networks_built,
+              'networks_reused': networks_reused,
+              'total_s': total + (IMPORT_TIME if first else 0.),
+              'cold_estimate_s': total + IMPORT_TIME + networks_reused * mean_build_time}
+    print(colored("Daemon:", "green"), "Job %s %s in %.1f s (%s start, a fresh run would take about %.1f s)" %
+          (report['id'], status, report['total_s'], 'warm' if report['warm'] else 'cold', report['cold_estimate_s']))
+    return report
+
+
+def serve_job_file(args, cache):
+    report_file = args.report_file if args.report_file is not None else args.job_file + '.reports.jsonl'
+    with open(args.job_file, 'r') as f:
+        jobs = [json.loads(line) for line in f if line.strip() and not line.lstrip().startswith('#')]
+    for index, job in enumerate(jobs):
+        job.setdefault('id', index)
+        report = run_job(job, cache, index == 0)
+        with open(report_file, 'a') as f:
+            f.write(json.dumps(report) + '\n')
+
+
+def serve_socket(args, cache):
+    if os.path.exists(args.socket):
+        os.remove(args.socket)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(args.socket)
+    server.listen(1)
+    print(colored("Daemon:", "green"), "Ready on %s after %.1f s of imports" % (args.socket, IMPORT_TIME))
+    first = True
+    running = True
+    try:
+        while running:
+            connection, _ = server.accept()
+            with connection, connection.makefile('rw') as stream:
+                for line in stream:
+                    if not line.strip():
+                        continue
+                    job = json.loads(line)
+                    if job.get('cmd') == 'shutdown':
+                        running = False
+                        break
+                    report = run_job(job, cache, first)
+                    first = False
+                    stream.write(json.dumps(report) + '\n')
+                    stream.flush()
+    finally:
+        server.close()
+        os.remove(args.socket)
+
+
+def main():
+    args = parse_args()
+    cache = NetworkCache(args.max_networks)
+    run.network_cache = cache
+    try:
+        if args.job_file is not None:
+            serve_job_file(args, cache)
+        else:
+            serve_socket(args, cache)
+    finally:
+        cache.close()
+    print(colored("Daemon:", "green"), "Built %d student graphs in %.1f s and reused them %d times" %
+          (cache.built, cache.build_time, cache.reused))
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,12 @@
 import os
+import re
 import sys
+import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+
 import numpy as np
 import cv2
 from termcolor import colored
@@ -10,9 +16,9 @@ import tensorflow as tf
 
 sys.path.append('../../.')
 
-from ams.tools.exp_configs import class_weights, test_length
-from ams.utils.graph_utils import create_teacher
-from ams.utils.utils import SaveHelper, colormap
+from ams.exp_configs import test_length
+from ams.utils.utils import colormap
+from ams.utils.teacher_stage import load_teacher, run_teacher, teacher_input, write_image
 
 tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
 
@@ -23,87 +29,139 @@ flags.DEFINE_string('teacher_checkpoint', None, 'Directory for teacher checkpoin
 flags.DEFINE_integer('gpu', 0, 'GPU to use for this')
 flags.DEFINE_string('input_video', None, "Video used in the test, optional")
 flags.DEFINE_integer('height', None, 'height to extract labels')
+flags.DEFINE_integer('batch_size', 8, 'Number of frames labeled by the teacher per session run')
+flags.DEFINE_integer('writer_threads', 4, 'Number of threads writing the label images')
+flags.DEFINE_integer('decode_ahead', 64, 'Number of decoded frames buffered ahead of the teacher')
+flags.DEFINE_boolean('save_colored', False, 'Also save the colored labels (annot_) and overlays (vis_)')
+flags.DEFINE_boolean('resume', False, 'Skip the frames whose labels already exist in dump_path')
 
 NUM_CLASSES = 19
+GT_PATTERN = re.compile(r'^gt_(\d{6})\.png$')
 
 # TODO: simplify code, remove the sys.append, test running it.
 
 
+def extracted_frames(dump_path):
+    """
+    Builds the resume index, the set of frame indices whose labels are already in dump_path. Labels are written under a
+    temporary name and renamed when complete, so a partially written label is never counted.
+
+    :param dump_path: Directory of the extracted labels
+    :type dump_path: str
+    :rtype: set of int
+    """
+    done = set()
+    for name in os.listdir(dump_path):
+        match = GT_PATTERN.match(name)
+        if match:
+            done.add(int(match.group(1)))
+    return done
+
+
+def decode_frames(cap, max_length, skip, frame_queue):
+    """
+    Decodes and preprocesses frames ahead of the teacher, frames in skip are only grabbed.
+
+    :param cap: The opened video
+    :param max_length: Number of frames to go through
+    :param skip: Indices of the frames that are not labeled
+    :param frame_queue: Bounded queue receiving (index, padded frame) tuples, None marks the end
+    :type cap: cv2.VideoCapture
+    :type max_length: int
+    :type skip: set of int
+    :type frame_queue: Queue
+    """
+    index_frame = 0
+    while index_frame < max_length:
+        if index_frame in skip:
+            if not cap.grab():
+                break
+            index_frame += 1
+            continue
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frame_queue.put((index_frame, teacher_input(frame, FLAGS.height)))
+        index_frame += 1
+    frame_queue.put(None)
+
+
+def write_labels(index_frame, frame, teacher_out, colormap_):
+    write_image("%sgt_%06d.png" % (FLAGS.dump_path, index_frame), np.array(teacher_out, dtype=np.uint8))
+    if FLAGS.save_colored:
+        label_colored = colormap_[teacher_out]
+        write_image("%sannot_%06d.png" % (FLAGS.dump_path, index_frame),
+                    cv2.cvtColor(np.array(label_colored, dtype=np.uint8), cv2.COLOR_RGB2BGR))
+        colored_frame = cv2.addWeighted(np.array(frame[1:, 1:, :], dtype=np.uint8), 0.5,
+                                        np.array(label_colored, dtype=np.uint8), 0.5, 0)
+        write_image("%svis_%06d.png" % (FLAGS.dump_path, index_frame),
+                    cv2.cvtColor(np.array(colored_frame, dtype=np.uint8), cv2.COLOR_RGB2BGR))
+
+
 def extract_labels():
     try:
         os.makedirs(FLAGS.dump_path)
     except FileExistsError:
         pass
 
-    config = tf.ConfigProto()
-    config.gpu_options.visible_device_list = "%d" % FLAGS.gpu
-    config.allow_soft_placement = True
-    config.gpu_options.allow_growth = False
-
-    class_weights_exp = class_weights(0)
-
     colormap_ = colormap()
     exp_num = int(FLAGS.input_video.split("/")[-1].split("-")[0])
 
-    with tf.device('/gpu:0'):
-        graph = tf.Graph()
-        with graph.as_default():
-            teacher = create_teacher(FLAGS.teacher_checkpoint, class_weights=class_weights_exp, test_mode=True)
-            reset_conf_mat = tf.initializers.local_variables()
-            init = tf.initializers.global_variables()
-    saver = SaveHelper(graph=graph, map_fun=lambda x: x)
-    with tf.Session(graph=graph, config=config) as sess:
+    sess, teacher = load_teacher(FLAGS.teacher_checkpoint, FLAGS.gpu)
+    with sess:
         print("Starting Teacher Inference")
-        sess.run([init, reset_conf_mat])
-        teacher_checkpoint = np.load('%s.npy' % FLAGS.teacher_checkpoint, allow_pickle=True).item()
-        teacher_checkpoint = {'teacher/%s' % k: teacher_checkpoint[k] for k in teacher_checkpoint}
-        saver.restore_vars(sess, teacher_checkpoint,
-                           lambda x: x if x not in ['global_step:0'] and 'Momentum' not in x else None)
-
         cap = cv2.VideoCapture(FLAGS.input_video)
         fps = round(cap.get(cv2.CAP_PROP_FPS))
         max_length = test_length(exp_num) * fps
         if cap.isOpened() is False:
             print(colored("Error opening video stream or file", "red"))
             return
-        print("There are %d frames to extract" % max_length)
-
-        index_frame = 0
-        if not os.path.exists(FLAGS.dump_path):
-            os.makedirs(FLAGS.dump_path)
-
+        skip = extracted_frames(FLAGS.dump_path) if FLAGS.resume else set()
+        skip = {index_frame for index_frame in skip if index_frame < max_length}
+        to_extract = max_length - len(skip)
+        print("There are %d frames to extract, %d already extracted" % (to_extract, len(skip)))
+
+        frame_queue = Queue(maxsize=FLAGS.decode_ahead)
+        decoder = threading.Thread(target=decode_frames, args=(cap, max_length, skip, frame_queue), daemon=True)
+        decoder.start()
+        writers = ThreadPoolExecutor(max_workers=FLAGS.writer_threads)
+        pending_writes = deque()
+
+        index_extracted = 0
         begin_time = time.time()
-
-        while True:
-            ret, frame = cap.read()
-            if not ret or index_frame >= max_length:
+        finished = False
+        while not finished:
+            batch = []
+            while len(batch) < FLAGS.batch_size:
+                item = frame_queue.get()
+                if item is None:
+                    finished = True
+                    break
+                batch.append(item)
+            if len(batch) == 0:
                 break
-            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            if FLAGS.height is not None:
-                frame = cv2.resize(frame, (FLAGS.height * 2, FLAGS.height))
-            correct_shape = np.shape(frame)[:-1]
-            frame = np.pad(frame, ((1, 0), (1, 0), (0, 0)), mode='symmetric')
-            teacher_out = sess.run(teacher['predictions'], feed_dict={teacher['images']: np.expand_dims(frame, axis=0)})
-            teacher_out = [teacher_out[0][1:, 1:]]
-            teacher_conf = teacher_conf[0][1:, 1:] * 255
-            assert np.shape(teacher_out[0]) == correct_shape
-            assert np.shape(teacher_conf) == correct_shape
-            cv2.imwrite("%sgt_%06d.png" % (FLAGS.dump_path, index_frame), np.array(teacher_out[0], dtype=np.uint8))
-
-            label_colored = colormap_[teacher_out[0]]
-            cv2.imwrite("%sannot_%06d.png" % (FLAGS.dump_path, index_frame),
-                        cv2.cvtColor(np.array(label_colored, dtype=np.uint8), cv2.COLOR_RGB2BGR))
-            colored_frame = cv2.addWeighted(np.array(frame[1:, 1:, :], dtype=np.uint8), 0.5,
-                                            np.array(label_colored, dtype=np.uint8), 0.5, 0)
-            cv2.imwrite("%svis_%06d.png" % (FLAGS.dump_path, index_frame),
-                        cv2.cvtColor(np.array(colored_frame, dtype=np.uint8), cv2.COLOR_RGB2BGR))
-
-            index_frame += 1
-            if index_frame % 100 == 0:
-                time_to_finish = (time.time() - begin_time) / index_frame * (max_length - index_frame)
-                print('Have computed %d frames so far, ETF: %02d:%02d.%02d' % (index_frame, time_to_finish // 60,
+            teacher_out = run_teacher(sess, teacher, [frame for _, frame in batch])
+            correct_shape = (batch[0][1].shape[0] - 1, batch[0][1].shape[1] - 1)
+            for (index_frame, frame), label in zip(batch, teacher_out):
+                assert np.shape(label) == correct_shape
+                pending_writes.append(writers.submit(write_labels, index_frame, frame, label, colormap_))
+            # Bound the number of labels waiting to be written, which also surfaces write errors early
+            while len(pending_writes) > 4 * FLAGS.writer_threads * FLAGS.batch_size:
+                pending_writes.popleft().result()
+
+            previous_extracted = index_extracted
+            index_extracted += len(batch)
+            if index_extracted // 100 > previous_extracted // 100:
+                time_to_finish = (time.time() - begin_time) / index_extracted * (to_extract - index_extracted)
+                print('Have computed %d frames so far, ETF: %02d:%02d.%02d' % (index_extracted, time_to_finish // 60,
                                                                                time_to_finish % 60,
                                                                                (time_to_finish * 100) % 100))
+        while pending_writes:
+            pending_writes.popleft().result()
+        writers.shutdown()
+        decoder.join()
+        cap.release()
+        print("Extracted %d frames in %.1f s" % (index_extracted, time.time() - begin_time))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,322 @@
+import os
+import time
+import argparse
+import numpy as np
+import cv2
+from collections import deque, OrderedDict
+from ams.utils.utils import choose_frames
+from ams.utils.metrics import label_lookup, cross_miou_series
+from ams.utils.scheduler import TrainingScheduler, POLICIES
+from ams.exp_configs import class_weights, test_length, coco_class_converter, is_coco
+from ams.SemanticNetwork import SemanticNetwork
+
+from termcolor import colored
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Multi-stream training server emulation')
+    parser.add_argument('--input_videos', type=str, required=True, help='Comma separated videos, one per stream')
+    parser.add_argument('--gt_videos', type=str, required=True,
+                        help='Comma separated directories of the ground truth labels, in the order of input_videos')
+    parser.add_argument('--student_checkpoint', type=str, required=True, help='Directory for student checkpoint')
+    parser.add_argument('--output_dir', type=str, required=True, help='Directory for the outputs')
+    parser.add_argument('--gpu', type=str, required=True, help='GPU to use for this')
+
+    parser.add_argument('--memory_len', type=int, default=250, help='Memory length')
+    parser.add_argument('--batch_size', type=int, default=10, help='Mini batch size')
+    parser.add_argument('--iter', type=int, default=200, help='# of iterations')
+    parser.add_argument('--height', type=int, default=256, help='height of video')
+    parser.add_argument('--lr', type=float, default=1e-3, help='Learning rate')
+    parser.add_argument('--send_period', type=int, default=30, help='Period between frame sample arrival')
+    parser.add_argument('--train_period', type=int, default=10, help='Training rate of every stream')
+    parser.add_argument('--no_restore', action='store_true', help='Do not restore the model on every training')
+    parser.add_argument('--train_strategy', type=str, default='full_model', choices=['full_model',
+                                                                                     'coord_desc_auto',
+                                                                                     'coord_desc_last',
+                                                                                     'coord_desc_first',
+                                                                                     'coord_desc_both',
+                                                                                     'coord_desc_rand'],
+                        help='Strategy of selecting which parts of the model to retrain every time')
+    parser.add_argument('--coord_fraction', type=str, default='0.1', choices=['0.1', '0.05', '0.2', '0.01'],
+                        help='Fraction of parameters trained in coordinate descent mode')
+
+    parser.add_argument('--policy', type=str, default='round_robin', choices=POLICIES,
+                        help='Policy deciding which stream gets the next training slot')
+    parser.add_argument('--train_slots', type=int, default=1,
+                        help='Number of trainings the server can run at the same time')
+    parser.add_argument('--max_sessions', type=int, default=2,
+                        help='Maximum number of training sessions kept open, streams with the same classes share them')
+    parser.add_argument('--duration', type=int, default=None,
+                        help='Seconds of video to run, the length of the shortest video when not given')
+
+    args = parser.parse_args()
+    assert len(args.input_videos.split(',')) == len(args.gt_videos.split(',')), \
+        'Every stream needs a ground truth directory'
+    assert args.train_slots > 0 and args.max_sessions > 0
+    return args
+
+
+flags = parse_args()
+SIZE = [flags.height, flags.height * 2]
+
+
+class Stream(object):
+    """
+    The server-side state of one client stream: its video, replay memory, student weights and update logs.
+    """
+
+    def __init__(self, index, input_video, gt_path):
+        self.index = index
+        self.input_video = input_video
+        self.gt_path = gt_path
+        self.exp_num = int(input_video.split("/")[-1].split("-")[0])
+        self.class_weights = class_weights(self.exp_num)
+        # Streams with the same classes can share a training session
+        self.session_key = self.class_weights.tobytes()
+        class_indices = np.where(self.class_weights.reshape(-1) == 1)[0]
+        self.class_count = len(class_indices)
+        self.label_lut, self.label_valid = label_lookup(class_indices, self.class_weights.size)
+        self.map_coco = coco_class_converter() if is_coco(self.exp_num) else None
+
+        self.cap = cv2.VideoCapture(input_video)
+        if not self.cap.isOpened():
+            print_process("Error opening video stream or file %s" % input_video, -1)
+            exit(1)
+        self.fps = round(self.cap.get(cv2.CAP_PROP_FPS))
+        self.frame_index = 0
+        self.send_rate = flags.send_period / self.fps
+        self.frame_memory = deque(maxlen=int(flags.memory_len / flags.send_period * self.fps))
+        self.label_memory = deque(maxlen=int(flags.memory_len / flags.send_period * self.fps))
+        self.frame_label_bucket = []
+        self.num_unseen_frames = 0
+        self.phi_score = 1.
+        # Student weights, kept between trainings when they are not restored to the initial checkpoint
+        self.weights = None
+        # Rows of (request time, start time, finish time, time of the newest training data), in seconds
+        self.updates = []
+
+    def read_second(self):
+        """
+        Reads the next second of video and its labels into the sampling bucket.
+
+        :return: False if the video ended
+        :rtype: bool
+        """
+        for _ in range(self.fps):
+            ret, frame = self.cap.read()
+            if not ret:
+                return False
+            gt = cv2.imread("%sgt_%06d.png" % (self.gt_path, self.frame_index), cv2.IMREAD_GRAYSCALE)
+            self.frame_label_bucket.append((frame, gt))
+            self.frame_index += 1
+        return True
+
+    def send_samples(self):
+        """
+        Samples the bucket like the client does and adds the samples to the replay memory.
+        """
+        frames_chosen, labels_chosen = choose_frames(self.frame_label_bucket, self.send_rate)
+        for frame, label in zip(frames_chosen, labels_chosen):
+            frame = cv2.resize(frame, (SIZE[1], SIZE[0]))
+            self.frame_memory.append(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+            label_resized = cv2.resize(label, (SIZE[1], SIZE[0]), interpolation=cv2.INTER_NEAREST)
+            if self.map_coco is not None:
+                label_resized = self.map_coco[label_resized]
+            self.label_memory.append(label_resized)
+        self.num_unseen_frames += len(frames_chosen)
+        self.frame_label_bucket.clear()
+
+    def update_phi_score(self):
+        i_start = max(0, len(self.label_memory) - self.num_unseen_frames - 1)
+        miou_cross = cross_miou_series([self.label_memory[k] for k in range(i_start, len(self.label_memory))],
+                                       self.label_lut, self.label_valid, self.class_count)
+        if miou_cross.size > 0 and not np.all(np.isnan(miou_cross)):
+            self.phi_score = float(np.nanmean(miou_cross))
+        self.num_unseen_frames = 0
+
+    def freshness(self, duration):
+        """
+        :return: For every second of the run, the age in seconds of the training data of the model the client runs,
+        NaN before the first update arrives
+        :rtype: np.ndarray
+        """
+        ages = np.full(duration, np.nan)
+        if len(self.updates) == 0:
+            return ages
+        updates = np.array(sorted(self.updates, key=lambda u: u[2]))
+        newest_data = np.maximum.accumulate(updates[:, 3])
+        seconds = np.arange(duration)
+        arrived = np.searchsorted(updates[:, 2], seconds, side='right') - 1
+        ages[arrived >= 0] = seconds[arrived >= 0] - newest_data[arrived[arrived >= 0]]
+        return ages
+
+
+class SessionPool(object):
+    """
+    Keeps at most max_sessions training sessions open, one per class configuration, closing the least recently used
+    one when another configuration needs a session.
+    """
+
+    def __init__(self, max_sessions):
+        self.max_sessions = max_sessions
+        self.sessions = OrderedDict()
+        self.owners = {}
+        self.created = 0
+
+    def acquire(self, stream):
+        """
+        :return: A session for the stream's classes, loaded with the stream's weights
+        :rtype: SemanticNetwork
+        """
+        if stream.session_key in self.sessions:
+            self.sessions.move_to_end(stream.session_key)
+        else:
+            if len(self.sessions) >= self.max_sessions:
+                key, semantic_network = self.sessions.popitem(last=False)
+                semantic_network.close_model()
+                del self.owners[key]
+            self.sessions[stream.session_key] = SemanticNetwork(meta_dir=flags.student_checkpoint,
+                                                                class_weights_exp=stream.class_weights,
+                                                                height=flags.height,
+                                                                gpu_id=flags.gpu,
+                                                                scale=[1],
+                                                                mini_batch_size=flags.batch_size,
+                                                                lr=flags.lr,
+                                                                mem_frac=1,
+                                                                coord_frac=float(flags.coord_fraction),
+                                                                train_biases_only=False,
+                                                                regularize=False,
+                                                                masked_gradients=flags.train_strategy not in
+                                                                ['full_model'])
+            self.owners[stream.session_key] = None
+            self.created += 1
+        semantic_network = self.sessions[stream.session_key]
+        if flags.no_restore and stream.weights is not None:
+            # The session still holds this stream's weights if it was the last one trained on it
+            if self.owners[stream.session_key] != stream.index:
+                semantic_network.restore(stream.weights)
+        else:
+            semantic_network.restore_initial()
+        self.owners[stream.session_key] = stream.index
+        return semantic_network
+
+    def close(self):
+        for semantic_network in self.sessions.values():
+            semantic_network.close_model()
+        self.sessions.clear()
+        self.owners.clear()
+
+
+def train_stream(pool, stream, now):
+    """
+    Trains the stream's student on its replay memory and saves the model the stream's client would download.
+
+    :return: Wall-clock time of the training in seconds
+    :rtype: float
+    """
+    t1 = time.time()
+    semantic_network = pool.acquire(stream)
+    semantic_network.train_with_deque(stream.frame_memory, stream.label_memory, flags.iter, flags.train_strategy)
+    if flags.no_restore:
+        stream.weights = semantic_network.get_vars()
+    save_dir = get_save_dir(stream, "%d" % now)
+    semantic_network.save_to_frozen_graph(save_dir + "_final")
+    return time.time() - t1
+
+
+def serve(streams, duration):
+    """
+    Runs all streams in lock-step over the video time, one second at a time. Training takes the wall-clock time it
+    actually needs, during which its slot is busy, so the video time and the server's compute time share one clock.
+    """
+    scheduler = TrainingScheduler(flags.policy, len(streams))
+    pool = SessionPool(flags.max_sessions)
+    slot_free = np.zeros(flags.train_slots)
+    busy_time = 0
+    for t in range(1, duration + 1):
+        for stream in streams:
+            if not stream.read_second():
+                print_process("Premature end of video %s, exiting" % stream.input_video, t)
+                exit(1)
+            if t % flags.train_period == 0:
+                stream.send_samples()
+                if len(stream.label_memory) > 0:
+                    if flags.policy == 'phi_score':
+                        stream.update_phi_score()
+                    scheduler.request(stream.index, t, stream.phi_score)
+        # Start trainings on the slots that are free by now
+        while scheduler.has_pending() and np.min(slot_free) <= t:
+            slot = int(np.argmin(slot_free))
+            stream_id, time_requested = scheduler.next()
+            time_start = max(slot_free[slot], time_requested)
+            time_train = train_stream(pool, streams[stream_id], t)
+            busy_time += time_train
+            slot_free[slot] = time_start + time_train
+            streams[stream_id].updates.append((time_requested, time_start, slot_free[slot], t))
+            scheduler.served(stream_id, t)
+            print_process("Trained stream %d on slot %d in %.1f s, latency %.1f s" %
+                          (stream_id, slot, time_train, slot_free[slot] - time_requested), t)
+        if t % 5 == 0:
+            print_process("%d seconds elapsed" % t, t)
+    pool.close()
+    print_process("Opened %d training sessions, the server was busy for %.1f s" % (pool.created, busy_time), duration)
+
+
+def report(streams, duration):
+    print("%-8s\t%8s\t%16s\t%16s\t%16s" % ("Stream", "Updates", "Latency (s)", "p95 latency (s)", "Mean age (s)"))
+    for stream in streams:
+        updates = np.array(stream.updates).reshape(-1, 4)
+        latencies = updates[:, 2] - updates[:, 0]
+        freshness = stream.freshness(duration)
+        final_save_dir = get_save_dir(stream, "results")
+        np.save(final_save_dir + '_update_latency.npy', updates)
+        np.save(final_save_dir + '_freshness.npy', freshness)
+        print("%-8d\t%8d\t%16.2f\t%16.2f\t%16.2f" % (
+            stream.index, len(updates), np.mean(latencies) if len(updates) > 0 else np.nan,
+            np.percentile(latencies, 95) if len(updates) > 0 else np.nan,
+            np.nanmean(freshness) if not np.all(np.isnan(freshness)) else np.nan))
+
+
+def get_save_dir(stream, append):
+    """
+    This helper function returns a label unique to the stream in this experiment.
+    :type stream: Stream
+    :type append: str
+    :rtype: str
+    """
+    return flags.output_dir + 'multi_%s_n%d_slots%d_tp%d_f%d_%s_%s_%d_%s' % (
+        flags.policy, len(flags.input_videos.split(',')), flags.train_slots, flags.train_period, flags.send_period,
+        stream.input_video.split('/')[-1], flags.student_checkpoint.split('/')[-2], flags.height, append)
+
+
+def print_process(str_log, curr_time):
+    """
+    This helper function tidies up command line outputs.
+    :param str_log: a string to print
+    :param curr_time: The time in the experiment
+    """
+    print(colored('Server [current time: %d]: ' % curr_time, 'cyan'), str_log)
+
+
+def main():
+    try:
+        os.makedirs(flags.output_dir)
+    except FileExistsError:
+        pass
+
+    streams = [Stream(index, input_video, gt_path) for index, (input_video, gt_path) in
+               enumerate(zip(flags.input_videos.split(','), flags.gt_videos.split(',')))]
+    duration = flags.duration
+    if duration is None:
+        duration = min(test_length(stream.exp_num) for stream in streams)
+    serve(streams, duration)
+    report(streams, duration)
+    for stream in streams:
+        stream.cap.release()
+    print(colored("Process [Main]:", "green"), "Done!!!")
+
+
+if __name__ == "__main__":
+    main()
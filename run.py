@@ -4,39 +4,89 @@ import numpy as np
 import cv2
 from collections import deque
 import subprocess as sp
-from ams.utils.utils import calculate_miou, string_class_iou, choose_frames
+import multiprocessing as mp
+from queue import Empty
+from ams.utils.utils import calculate_miou, string_class_iou, choose_indices, pack_update, compress_update, \
+    frame_thumbnail, content_change, choose_content_indices, SAMPLING_POLICIES
 from ams.exp_configs import class_weights, test_length, coco_class_converter, is_coco
 from ams.SemanticNetwork import SemanticNetwork
+from ams.utils.tracing import tracer
+from ams.utils.link import Link
+from ams.utils.horizon import HorizonIndex, horizon_diffs
+from ams.utils.result_cache import ResultCache, checkpoint_files
+from ams.utils.results_store import ResultsStore, load_result as load_stored_result
+from ams.utils.replay_memory import ReplayMemory, ScalePyramid, SPILL_MODES
+from ams.utils.teacher_stage import OnlineTeacher
+from ams.utils.visualization import Colorizer, VisualizationWriter, VIS_FORMATS
+from ams.utils.video_catalog import video_fps
 
 from termcolor import colored
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 import argparse
-def parse_args():
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(description='TensorFlow Training Script')
     parser.add_argument('--input_video', type=str, required=True, help='Directory for the video')
     parser.add_argument('--gt_video', type=str, required=True, help='Directory for the ground truth labels of video')
     parser.add_argument('--student_checkpoint', type=str, required=True, help='Directory for student checkpoint')
     parser.add_argument('--output_dir', type=str, required=True, help='Directory for the output figure')
+    parser.add_argument('--online_teacher', type=str, default=None,
+                        help='Teacher checkpoint labeling the frames missing from gt_video as they are sent to the '
+                             'server, or evaluated, and memoizing their labels there. Without it all labels must have '
+                             'been extracted beforehand')
+    parser.add_argument('--teacher_height', type=int, default=None,
+                        help='Height the online teacher labels frames at, the video\'s if not given')
+    parser.add_argument('--teacher_batch_size', type=int, default=8,
+                        help='Number of frames labeled by the online teacher per session run')
     parser.add_argument('--gpu', type=str, required=True, help='GPU to use for this')
 
     parser.add_argument('--initial_fill', action='store_true', help='When true, doesn\'t train until memory is full')
     parser.add_argument('--memory_len', type=int, default=250, help='Memory length')
+    parser.add_argument('--replay_budget_mb', type=float, default=0,
+                        help='MB of uncompressed samples the server keeps in RAM, older samples are spilled. 0 for no '
+                             'budget')
+    parser.add_argument('--replay_spill', type=str, default='memmap', choices=SPILL_MODES,
+                        help='Where samples over the budget go: a memory-mapped file in output_dir, zlib compressed '
+                             'in RAM, or none to drop them')
+    parser.add_argument('--train_scales', type=str, default='1',
+                        help='Comma separated scales, at least 1, the training crops are taken from')
+    parser.add_argument('--pyramid_cache_mb', type=float, default=512,
+                        help='MB of scaled samples the replay memory keeps for scales other than 1, 0 to resize them '
+                             'every time')
+    parser.add_argument('--device_augment', action='store_true',
+                        help='Feed the replay memory to the GPU once per training and crop and scale the mini batches '
+                             'there, instead of on the CPU every iteration')
     parser.add_argument('--batch_size', type=int, default=10, help='Mini batch size')
     parser.add_argument('--iter', type=int, default=200, help='# of iterations')
     parser.add_argument('--height', type=int, default=256, help='height of video')
     parser.add_argument('--lr', type=float, default=1e-3, help='Learning rate')
+    parser.add_argument('--lean_student', action='store_true',
+                        help='Build only the ops of the student that training and inference use, which makes the '
+                             'graph faster to build and smaller to serialize')
 
     parser.add_argument('--send_period', type=int, default=30, help='Period between frame sample arrival')
     parser.add_argument('--train_period', type=int, default=10, help='Training rate')
+    parser.add_argument('--sampling_policy', type=str, default='uniform', choices=SAMPLING_POLICIES,
+                        help='Send equally spaced frames, or spread the same number of frames over the changes of '
+                             'the frames and labels. content has to decode every frame')
 
     parser.add_argument('--only_results', action='store_true', help='Just print the results')
+    parser.add_argument('--no_cache', action='store_true',
+                        help='Recompute runs even if results computed from the same inputs are stored')
+    parser.add_argument('--eval_skip_frames', type=int, default=7500,
+                        help='Number of first frames left out of the mean mIoU that is reported')
     parser.add_argument('--compress_uplink', action='store_true', help='Compress the uplink using H264 encoding')
     parser.add_argument('--no_restore', action='store_true', help='Do not restore the model on every training')
     parser.add_argument('--save_pic', action='store_true', help='Save the pictures in inference')
+    parser.add_argument('--vis_format', type=str, default='png', choices=VIS_FORMATS,
+                        help='Save the pictures of every frame as PNGs, or each kind of picture as one video')
+    parser.add_argument('--vis_every', type=int, default=1, help='Save the pictures of one frame out of vis_every')
+    parser.add_argument('--vis_workers', type=int, default=4, help='Number of threads saving the pictures')
 
     parser.add_argument('--enable_ASR', action='store_true', help='Enable Adaptive Sampling Rate')
     parser.add_argument('--enable_ATR', action='store_true', help='Enable Adaptive Training Rate')
+    parser.add_argument('--asr_pixel_budget', type=int, default=None,
+                        help='Total number of pixels compared when computing the phi-score, all pixels when not given')
 
     parser.add_argument('--train_strategy', type=str, default='full_model', choices=['full_model',
                                                                                      'coord_desc_auto',
@@ -48,29 +98,127 @@ def parse_args():
     parser.add_argument('--coord_fraction', type=str, default='0.1', choices=['0.1', '0.05', '0.2', '0.01'],
                         help='Fraction of parameters trained in coordinate descent mode')
 
-    parser.add_argument('--mode', type=str, required=True, choices=['simple', 'pretrained', 'horizon', 'early'],
+    parser.add_argument('--mode', type=str, required=True, choices=['simple', 'pretrained', 'horizon', 'early',
+                                                                    'pipelined'],
                         help='Profiling mode')
+    parser.add_argument('--client_realtime', action='store_true',
+                        help='In pipelined mode, pace the client at the video fps and keep using the old model until '
+                             'an update arrives instead of waiting for it')
+    parser.add_argument('--pipeline_mem_frac', type=float, default=0.45,
+                        help='Fraction of the GPU memory used by each of the server and client in pipelined mode')
     
+    parser.add_argument('--emulate_link', action='store_true',
+                        help='Deliver samples and model updates through an emulated link instead of instantly')
+    parser.add_argument('--uplink_kbps', type=float, default=1024, help='Bandwidth of the emulated uplink')
+    parser.add_argument('--downlink_kbps', type=float, default=1024, help='Bandwidth of the emulated downlink')
+    parser.add_argument('--uplink_trace', type=str, default=None,
+                        help='Uplink bandwidth trace, lines of "seconds kbps", overrides --uplink_kbps')
+    parser.add_argument('--downlink_trace', type=str, default=None,
+                        help='Downlink bandwidth trace, lines of "seconds kbps", overrides --downlink_kbps')
+    parser.add_argument('--link_rtt', type=float, default=50, help='Round trip time of the emulated link in ms')
+    parser.add_argument('--link_jitter', type=float, default=0, help='Jitter of the emulated link in ms')
+    parser.add_argument('--link_loss', type=float, default=0, help='Packet loss probability of the emulated link')
+
     parser.add_argument('--early_cutoff_time', type=int, default=60, help='Where to start making the one-time customized model')
 
-    args = parser.parse_args()
+    parser.add_argument('--trace_output', type=str, default=None,
+                        help='Record per-phase timings and export them here (.jsonl for JSON lines, otherwise a Chrome '
+                             'trace)')
+    parser.add_argument('--trace_capacity', type=int, default=100000, help='Number of trace records kept in memory')
+    parser.add_argument('--profile_iters', type=str, default='',
+                        help='Comma separated training iterations to profile with TF RunMetadata, needs --trace_output')
+
+    args = parser.parse_args(argv)
 
     assert not args.enable_ATR or args.enable_ASR, 'ASR must be enabled for ATR to work'
     assert not args.enable_ASR or args.mode == 'simple', 'ASR can only be used in simple mode'
     assert not args.enable_ATR or args.mode == 'simple', 'ATR can only be used in simple mode'
+    assert not args.emulate_link or args.mode == 'simple', 'The link can only be emulated in simple mode'
 
     # print('Arguments:', args)
     return args
 
 
-flags = parse_args()
-SIZE = [flags.height, flags.height * 2]
+# Set by configure, so that the module can be imported (e.g. by the daemon) without parsing the command line
+flags = None
+SIZE = None
+# Cache of trainable networks kept alive between experiments, only used by the daemon
+network_cache = None
+# Flags that do not change the results of a run, left out of the result cache's digest
+CACHE_IGNORED_FLAGS = ['gpu', 'output_dir', 'only_results', 'no_cache', 'mode', 'save_pic', 'eval_skip_frames',
+                       'vis_format', 'vis_every', 'vis_workers', 'lean_student', 'pipeline_mem_frac', 'trace_output',
+                       'trace_capacity', 'profile_iters', 'pyramid_cache_mb']
+# Seconds between checks that the pipelined server is still alive, while waiting for its messages
+SERVER_POLL_INTERVAL = 5
+
+def configure(args):
+    """
+    Sets the flags used by all the functions of this module.
+    :param args: The output of parse_args
+    :type args: argparse.Namespace
+    """
+    global flags, SIZE, _results_store, _result_cache
+    flags = args
+    SIZE = [flags.height, flags.height * 2]
+    # Both depend on output_dir
+    _results_store = None
+    _result_cache = None
+    # The daemon runs many jobs in one process, a job only traces if its own flags ask for it
+    tracer.reset()
+
+
+def create_training_network(exp_num, gpu_id, mem_frac):
+    """
+    Returns the student network trained by train_model, taken from network_cache if the daemon keeps one.
+    :rtype: SemanticNetwork
+    """
+    kwargs = dict(meta_dir=flags.student_checkpoint,
+                  class_weights_exp=class_weights(exp_num),
+                  height=flags.height,
+                  gpu_id=gpu_id,
+                  scale=train_scales(),
+                  mini_batch_size=flags.batch_size,
+                  lr=flags.lr,
+                  mem_frac=mem_frac,
+                  coord_frac=float(flags.coord_fraction),
+                  train_biases_only=False,
+                  regularize=False,
+                  masked_gradients=flags.train_strategy not in ['full_model'],
+                  lean=flags.lean_student,
+                  device_augment=flags.device_augment)
+    if network_cache is None:
+        return SemanticNetwork(**kwargs)
+    return network_cache.get(kwargs)
+
+
+def train_scales():
+    scales = [float(scale) for scale in flags.train_scales.split(',')]
+    assert all(scale >= 1 for scale in scales), 'Training scales must be at least 1'
+    return scales
+
+
+def release_training_network(semantic_network):
+    if network_cache is None:
+        semantic_network.close_model()
+
+
+def next_send_frame(i, fps, sample_send_period):
+    """
+    :param i: Number of frames read so far
+    :return: The number of frames read when train_model next sends the bucket of sampled frames
+    :rtype: int
+    """
+    if (i + 1) // fps % sample_send_period == 0:
+        return i + 1
+    return ((i + 1) // fps // sample_send_period + 1) * sample_send_period * fps
+
 
 def train_model(train_start, train_end, sampling_period, gpu_id, run_label, gt_path, exp_num, save_range,
-                sample_send_period):
+                sample_send_period, update_channel=None, mem_frac=1):
     """
     This function emulates the training phase of the server-client setting. It collects frames with a rate of
     sampling_period in the range [train_start, train_end). It saves the trained models for time points in save_range
+    and, if update_channel is given, announces every saved model on it
 
     :param train_start: Start of the interval
     :param train_end: End of the interval
@@ -81,6 +229,8 @@ def train_model(train_start, train_end, sampling_period, gpu_id, run_label, gt_p
     :param exp_num: A unique number assigned to each video that can be used to look up it's length and chosen classes
     :param save_range: The points to save the models
     :param sample_send_period: The period at which samples are sent, in seconds
+    :param update_channel: A queue receiving a message for each saved model, used in pipelined mode
+    :param mem_frac: Fraction of the GPU memory to use
     :type train_start: int
     :type train_end: int
     :type gpu_id: str
@@ -90,6 +240,8 @@ def train_model(train_start, train_end, sampling_period, gpu_id, run_label, gt_p
     :type exp_num: int
     :type save_range: list of int
     :type sample_send_period: int
+    :type update_channel: multiprocessing.Queue
+    :type mem_frac: float
     """
     assert train_end - train_start != 0, "There should be at least one set of data points"
     # Open video, get the fps and set it's starting point to train_start
@@ -105,12 +257,20 @@ def train_model(train_start, train_end, sampling_period, gpu_id, run_label, gt_p
     update_count = 0
     send_rate = sampling_period / fps
     sample_per_period = []
-    up_bw_per_period = []  # in bits
+    up_bw_per_period = []  # in kilobits, 1024 bits
     down_bw_per_period = []  # in bits
     frame_label_bucket = []
     num_unseen_frames = 0
     # ATR state variables and logs, if ATRis used, save_range changes in the middle of a run and must be saved
     model_save_times = [0]
+    # Samples in flight on the uplink as (arrival time, frames, labels) and the times models reach the client
+    samples_in_flight = deque()
+    model_arrival_times = [train_start]
+    uplink, downlink = None, None
+    if flags.emulate_link:
+        uplink = Link(flags.uplink_kbps, flags.link_rtt, flags.link_jitter, flags.link_loss, flags.uplink_trace, seed=0)
+        downlink = Link(flags.downlink_kbps, flags.link_rtt, flags.link_jitter, flags.link_loss, flags.downlink_trace,
+                        seed=1)
     train_period_reset = save_range[2] - save_range[1]
     train_period_current = save_range[2] - save_range[1]
     if flags.enable_ATR:
@@ -124,36 +284,78 @@ def train_model(train_start, train_end, sampling_period, gpu_id, run_label, gt_p
     if is_coco(exp_num):
         map_coco = coco_class_converter()
     # Use deques to keep a finite number of data points, representing a span of flags.memory_len amount of seconds
-    frame_memory = deque(maxlen=int(flags.memory_len / sampling_period * fps))
-    label_memory = deque(maxlen=int(flags.memory_len / sampling_period * fps))
+    # The replay memory spills the oldest samples to disk or compresses them when they go over the budget
+    # Scaled samples are kept with them in the memory when training takes crops from other scales than 1
+    pyramid = None
+    if flags.pyramid_cache_mb > 0 and any(scale != 1 for scale in train_scales()) and not flags.device_augment:
+        pyramid = ScalePyramid(int(flags.pyramid_cache_mb * 2 ** 20))
+    replay_memory = ReplayMemory(int(flags.memory_len / sampling_period * fps),
+                                 budget_bytes=int(flags.replay_budget_mb * 2 ** 20), spill=flags.replay_spill,
+                                 spill_path=get_save_dir(run_label) + '_replay', pyramid=pyramid)
+    replay_stats = []
+    pyramid_stats = []
     to_compress_frame_memory = deque(maxlen=int(flags.memory_len / sampling_period * fps))
     # Initialize the model
-    semantic_network = SemanticNetwork(meta_dir=flags.student_checkpoint,
-                                       class_weights_exp=class_weights(exp_num),
-                                       height=flags.height,
-                                       gpu_id=gpu_id,
-                                       scale=[1],
-                                       mini_batch_size=flags.batch_size,
-                                       lr=flags.lr,
-                                       mem_frac=1,
-                                       coord_frac=float(flags.coord_fraction),
-                                       train_biases_only=False,
-                                       regularize=False,
-                                       masked_gradients=flags.train_strategy not in ['full_model'],
-                                       cross_miou_compat=flags.enable_ASR)
+    semantic_network = create_training_network(exp_num, gpu_id, mem_frac)
     # Initially save the model
     save_dir = get_save_dir(run_label + "_%d" % train_start)
     semantic_network.save_to_frozen_graph(save_dir + "_final")
     print_process("Saved model to %s_final.pb" % save_dir, 0)
+    if update_channel is not None:
+        time_now = time.time()
+        update_channel.put({'time': train_start, 'requested': time_now, 'sent': time_now})
+
+    # Frames of the current bucket that will be sent, chosen when the bucket starts so that the others are only grabbed
+    # and never decoded. With ASR, a bucket is sampled at the send rate it starts with
+    bucket_start = i
+    bucket_chosen = set(choose_indices(next_send_frame(i, fps, sample_send_period) - i, send_rate).tolist())
+    # The content policy needs every frame of the bucket, and scores it against the previous one
+    content_sampling = flags.sampling_policy == 'content'
+    bucket_scores = []
+    last_thumbnails = (None, None)
+    # With the online teacher, labels missing from gt_path are computed for the frames that are sent, once per send. The
+    # frames missing a label are kept as read until then, only the ones sent are prepared for the teacher
+    online_teacher = None
+    teacher_frames = {}
+    if flags.online_teacher is not None:
+        online_teacher = OnlineTeacher(flags.online_teacher, gt_path, gpu_id, height=flags.teacher_height,
+                                       batch_size=flags.teacher_batch_size)
 
     while cap.isOpened() and i < train_end_frame:
         # Read frame from video
-        ret, frame = cap.read()
-        if ret:
-            # load corresponding label in gt_path
-            gt = cv2.imread("%sgt_%06d.png" % (gt_path, i), cv2.IMREAD_GRAYSCALE)
-            frame_label_bucket.append((frame, gt))
-        else:
+        chosen = content_sampling or i - bucket_start in bucket_chosen
+        with tracer.span('decode', chosen=chosen):
+            if not chosen:
+                ret = cap.grab()
+            else:
+                ret, frame = cap.read()
+            if ret and chosen:
+                # load corresponding label in gt_path
+                if online_teacher is None:
+                    gt = cv2.imread("%sgt_%06d.png" % (gt_path, i), cv2.IMREAD_GRAYSCALE)
+                else:
+                    gt = online_teacher.cached(i)
+                    if gt is None:
+                        teacher_frames[i] = frame
+                if content_sampling:
+                    with tracer.span('content_scoring'):
+                        thumbnails = (frame_thumbnail(frame), frame_thumbnail(gt) if gt is not None else None)
+                        bucket_scores.append(content_change(*thumbnails, *last_thumbnails))
+                        last_thumbnails = thumbnails
+                # Only keep the frame at the size it is sent at, full resolution frames of a whole send period do not
+                # fit in memory
+                if flags.compress_uplink:
+                    # If we use compress_uplink, use twice the resolution to send a higher quality
+                    frame = cv2.resize(frame, (SIZE[1] * 2, SIZE[0] * 2))
+                else:
+                    frame = cv2.resize(frame, (SIZE[1], SIZE[0]))
+                if gt is None:
+                    # Labeled by the online teacher when the bucket is sent
+                    gt = i
+                else:
+                    gt = cv2.resize(gt, (SIZE[1], SIZE[0]), interpolation=cv2.INTER_NEAREST)
+                frame_label_bucket.append((frame, gt))
+        if not ret:
             print("Premature end of video, exiting")
             exit(1)
 
@@ -163,31 +365,42 @@ def train_model(train_start, train_end, sampling_period, gpu_id, run_label, gt_p
 
         if i // fps % sample_send_period == 0:
             # When it's time to send, choose frames to send based on send_rate
-            frames_chosen, labels_chosen = choose_frames(frame_label_bucket, send_rate)
-            for frame, label in zip(frames_chosen, labels_chosen):
-                if flags.compress_uplink:
-                    # If we use compress_uplink, use twice the resolution to send a higher quality
-                    frame = cv2.resize(frame, (SIZE[1] * 2, SIZE[0] * 2))
-                else:
-                    frame = cv2.resize(frame, (SIZE[1], SIZE[0]))
-                    frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                label_resized = cv2.resize(label, (SIZE[1], SIZE[0]), interpolation=cv2.INTER_NEAREST)
-                to_compress_frame_memory.append(frame)
-                if map_coco is not None:
-                    label_resized = map_coco[label_resized]
-                label_memory.extend(label_resized)
-            frame_label_bucket.clear()
+            with tracer.span('sampling', bucket=i - bucket_start):
+                labels_sent = []
+                if content_sampling:
+                    frame_label_bucket = [frame_label_bucket[k]
+                                          for k in choose_content_indices(bucket_scores, send_rate)]
+                    bucket_scores = []
+                if online_teacher is not None:
+                    pending = [gt for _, gt in frame_label_bucket if not isinstance(gt, np.ndarray)]
+                    with tracer.span('teacher', frames=len(pending)):
+                        teacher_labels = dict(zip(pending, online_teacher.label(
+                            pending, [online_teacher.prepare(teacher_frames[index_frame]) for index_frame in pending])))
+                        frame_label_bucket = [(frame, gt if isinstance(gt, np.ndarray) else cv2.resize(
+                            teacher_labels[gt], (SIZE[1], SIZE[0]), interpolation=cv2.INTER_NEAREST))
+                                              for frame, gt in frame_label_bucket]
+                        teacher_frames.clear()
+                for frame, label_resized in frame_label_bucket:
+                    if not flags.compress_uplink:
+                        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                    to_compress_frame_memory.append(frame)
+                    if map_coco is not None:
+                        label_resized = map_coco[label_resized]
+                    labels_sent.append(label_resized)
+                frame_label_bucket.clear()
+                bucket_start = i
+                bucket_chosen = set(choose_indices(next_send_frame(i, fps, sample_send_period) - i, send_rate).tolist())
 
             num_frames = len(to_compress_frame_memory)
             sample_per_period.append(num_frames)
-            # Log unseen frames to use for computing phi-score in ASR
-            num_unseen_frames += num_frames
+            sent_frames = []
 
             if flags.compress_uplink:
                 # First write frames to video files using FFMPEG, then read frames from that video and append them to
                 # the server's memory
                 output_video_file = f"{get_save_dir(run_label)}_tmp_movie.mp4"
                 time_start_encode = time.time()
+                t_trace = time.perf_counter()
                 trying = True
                 while trying:
                     # If multiple runs are initiated, their input pipes can compete, so we add a while loop to keep
@@ -242,6 +455,7 @@ def train_model(train_start, train_end, sampling_period, gpu_id, run_label, gt_p
                         print_process("GOT BROKEN PIPE, TRYING AGAIN", i // fps)
                         continue
                 to_compress_frame_memory.clear()
+                tracer.add('uplink_encode', t_trace, time.perf_counter() - t_trace, frames=num_frames)
                 print("FFMPEG took %.1f ms to encode" % ((time.time() - time_start_encode) * 1000))
                 size_vid = os.path.getsize(output_video_file) / 1024
                 print_process("Video is %.2fKB, %.2fKb per frame" % (size_vid, size_vid / num_frames * 8), i / fps)
@@ -253,28 +467,43 @@ def train_model(train_start, train_end, sampling_period, gpu_id, run_label, gt_p
                     if comp_ret:
                         dec_frame = cv2.resize(dec_frame, (SIZE[1], SIZE[0]))
                         dec_frame = cv2.cvtColor(dec_frame, cv2.COLOR_BGR2RGB)
-                        frame_memory.append(dec_frame)
+                        sent_frames.append(dec_frame)
                 os.remove(output_video_file)
             else:
                 output_image_file = f"{get_save_dir(run_label)}_tmp_image.png"
                 size_images = 0
-                while len(to_compress_frame_memory) > 0:
-                    f = to_compress_frame_memory.popleft()
-                    cv2.imwrite(output_image_file, f)
-                    size_images += os.path.getsize(output_image_file) / 1024
-                    frame_memory.append(f)
+                with tracer.span('uplink_encode', frames=num_frames):
+                    while len(to_compress_frame_memory) > 0:
+                        f = to_compress_frame_memory.popleft()
+                        cv2.imwrite(output_image_file, f)
+                        size_images += os.path.getsize(output_image_file) / 1024
+                        sent_frames.append(f)
                 up_bw_per_period.append(size_images * 8)
-                os.remove(output_image_file)
+                if num_frames > 0:
+                    os.remove(output_image_file)
+            # Samples join the server's memory when the link delivers them, instantly without an emulated link
+            arrival_time = i / fps if uplink is None else uplink.send(up_bw_per_period[-1] * 1024, i / fps)
+            samples_in_flight.append((arrival_time, sent_frames, labels_sent))
+
+        while len(samples_in_flight) > 0 and samples_in_flight[0][0] <= i / fps:
+            _, sent_frames, labels_sent = samples_in_flight.popleft()
+            with tracer.span('replay_update', frames=len(sent_frames)):
+                replay_memory.extend(sent_frames, labels_sent)
+            # Log unseen frames to use for computing phi-score in ASR
+            num_unseen_frames += len(sent_frames)
+            stats = replay_memory.stats()
+            replay_stats.append([i / fps, stats['hot_bytes'], stats['cold_bytes'], stats['rss_bytes']])
+            print_process("Replay memory holds %d samples in RAM (%.1f MB) and %d spilled (%.1f MB), RSS is %.1f MB" %
+                          (stats['hot'], stats['hot_bytes'] / 2 ** 20, stats['cold'], stats['cold_bytes'] / 2 ** 20,
+                           stats['rss_bytes'] / 2 ** 20), i / fps)
 
         if i // fps in save_range:
             if flags.enable_ASR:
                 # Compute phi-score based on unseen frames and change send_rate
-                i_start = max(0, len(label_memory) - num_unseen_frames - 1)
-                miou_cross_arr_ = []
-                for k in range(i_start, len(label_memory) - 1):
-                    _, _, miou_cross_ = semantic_network.calc_cross_miou(
-                        np.array([label_memory[k], label_memory[k + 1]]))
-                    miou_cross_arr_.append(miou_cross_)
+                i_start = max(0, len(replay_memory) - num_unseen_frames - 1)
+                with tracer.span('asr_scoring', pairs=len(replay_memory) - 1 - i_start):
+                    miou_cross_arr_ = semantic_network.cross_miou_series(
+                        [replay_memory.labels[k] for k in range(i_start, len(replay_memory))], flags.asr_pixel_budget)
                 send_rate = send_rate - 0.2 * np.tanh((np.mean(miou_cross_arr_) - 0.6) * 20)
                 send_rate = np.clip(send_rate, 0.1, 1)
                 print_process("Send rate updated to %.2f" % send_rate, i / fps)
@@ -297,65 +526,87 @@ def train_model(train_start, train_end, sampling_period, gpu_id, run_label, gt_p
                 save_range.extend([save_time for save_time in range(i//fps, train_end, train_period_current)])
                 assert i // fps in save_range
 
+            time_requested = time.time()
             if not flags.no_restore:
                 semantic_network.restore_initial()
             t1 = time.time()
-            semantic_network.train_with_deque(frame_memory, label_memory, flags.iter, flags.train_strategy)
+            semantic_network.train_with_deque(replay_memory.frames, replay_memory.labels, flags.iter,
+                                              flags.train_strategy)
             print("Training for %d iterations took %d ms!!!" % (flags.iter, 1000 * (time.time() - t1)))
-            whole_params = 0
+            if pyramid is not None:
+                stats = pyramid.round_stats()
+                pyramid_stats.append([i / fps, stats['hits'], stats['misses'], stats['resize_time'] * 1000,
+                                      stats['saved_time'] * 1000, stats['bytes']])
+                print_process("Scale pyramid hit rate is %.1f%%, %.1f ms resizing and %.1f ms saved, %.1f MB cached" %
+                              (100 * stats['hits'] / max(stats['hits'] + stats['misses'], 1),
+                               stats['resize_time'] * 1000, stats['saved_time'] * 1000, stats['bytes'] / 2 ** 20),
+                              i / fps)
             # Calculate the down-link bandwidth
-            with open(save_dir + '_mask.dat', 'wb') as f:
-                full_size = 0
-                for val in semantic_network.curr_mask:
-                    val_reshape = val.flatten()
-                    whole_params += val_reshape.size
-                    val_reshape = np.packbits(val_reshape)
-                    f.write(val_reshape.tobytes())
-                    full_size += val.size
-                for p_ind in range(len(semantic_network.train_params)):
-                    assert semantic_network.train_params[p_ind].shape == semantic_network.curr_mask[p_ind].shape
-                    write_params = \
-                        semantic_network.train_params[p_ind][semantic_network.curr_mask[p_ind]].astype(np.float16)
-                    f.write(write_params.tobytes())
+            t_trace = time.perf_counter()
+            full_size = pack_update(save_dir + '_mask.dat', semantic_network.curr_mask, semantic_network.train_params)
             # Experimental method: Add params to gzip as well, instead of sending changed params
             # if bw usage is worse switch to the version used for the paper
-            sp.Popen(['gzip', '-9', '-f', '-k', save_dir + '_mask.dat']).wait()
+            curr_update = compress_update(save_dir + '_mask.dat')
+            tracer.add('downlink_encode', t_trace, time.perf_counter() - t_trace)
             print("Full size of model is %d" % full_size)
-            curr_update = os.path.getsize(save_dir + '_mask.dat.gz') * 8
             down_bw_per_period.append(curr_update)
             update_count += 1
             print("Using %.1fKbps for updating params" % (curr_update // 1024))
+            if downlink is not None:
+                model_arrival_times.append(downlink.send(curr_update, i / fps))
+                print_process("Update reaches the client after %.2f s" % (model_arrival_times[-1] - i / fps), i / fps)
+            else:
+                model_arrival_times.append(i / fps)
             # Save the model
             save_dir = get_save_dir(run_label + f"_{i // fps}")
             semantic_network.save_to_frozen_graph(save_dir + "_final")
             print_process("Saved model to %s_final.pb" % save_dir, i / fps)
+            if update_channel is not None:
+                update_channel.put({'time': i // fps, 'requested': time_requested, 'sent': time.time()})
             model_save_times.append(i / fps)
 
-    semantic_network.close_model()
-    final_save_dir = get_save_dir(run_label + "_results")
-    np.save(final_save_dir + '_fps_client.npy', sample_per_period)
-    np.save(final_save_dir + '_bw_uplink.npy', up_bw_per_period)
-    np.save(final_save_dir + '_bw_downlink.npy', down_bw_per_period)
-    np.save(final_save_dir + '_model_update_times.npy', model_save_times)
+    release_training_network(semantic_network)
+    if online_teacher is not None:
+        print_process(online_teacher.summary(), i / fps)
+        online_teacher.close()
+    save_result(run_label, 'fps_client', sample_per_period)
+    save_result(run_label, 'bw_uplink', up_bw_per_period)
+    save_result(run_label, 'bw_downlink', down_bw_per_period)
+    save_result(run_label, 'model_update_times', model_save_times)
+    save_result(run_label, 'model_arrival_times', model_arrival_times)
+    # Columns: time, bytes in RAM, bytes spilled and RSS of the server, after every delivery of samples
+    save_result(run_label, 'replay_memory', np.array(replay_stats, dtype=np.float64).reshape(-1, 4))
+    # Columns: time, hits, misses, ms resizing, ms saved by the hits and bytes cached, after every training
+    if pyramid is not None:
+        save_result(run_label, 'scale_pyramid', np.array(pyramid_stats, dtype=np.float64).reshape(-1, 6))
+    if downlink is not None:
+        staleness = np.array(model_arrival_times[1:]) - np.array(model_save_times[1:])
+        print_process("Uplink delivered %d sample batches, updates took %.2f s on average (max %.2f s) to arrive" %
+                      (len(uplink.log), np.mean(staleness) if staleness.size else 0,
+                       np.max(staleness) if staleness.size else 0), i / fps)
     # Write bandwidth stats
-    with open(final_save_dir + '_update.txt', 'w') as f:
-        interval = train_end - train_start
-        if update_count == 0:
-            assert len(down_bw_per_period) == 0
-        downlink_size = sum(down_bw_per_period)
-        uplink_size = sum(up_bw_per_period)
-        samples_sent = sum(sample_per_period)
-        f.write("%d\n%d\n%d\n%d\n%d" % (downlink_size, uplink_size, update_count, interval, samples_sent))
+    interval = train_end - train_start
+    if update_count == 0:
+        assert len(down_bw_per_period) == 0
+    downlink_size = sum(down_bw_per_period)
+    uplink_size = sum(up_bw_per_period)
+    samples_sent = sum(sample_per_period)
+    save_result(run_label, 'update', np.array([downlink_size, uplink_size, update_count, interval, samples_sent],
+                                              dtype=np.int64))
     cap.release()
-    frame_memory.clear()
-    label_memory.clear()
+    replay_memory.clear()
     to_compress_frame_memory.clear()
+    if tracer.enabled:
+        print_process("\n\n%s" % string_trace_summary(tracer.summary()), i / fps)
 
 
-def infer_output(inf_start, inf_end, gpu_id, run_label, gt_path, exp_num, load_range):
+def infer_output(inf_start, inf_end, gpu_id, run_label, gt_path, exp_num, load_range, update_channel=None,
+                 mem_frac=1, arrival_times=None, server=None):
     """
     This function emulates the client-side inference phase of the server-client setting. It infers frames  in the range
-    [inf_start, inf_end). It loads models for times in load_range whenever it reaches them.
+    [inf_start, inf_end). It loads models for times in load_range whenever it reaches them. If update_channel is given,
+    the models are loaded as the server announces them on it, and the latency of every update is logged. If
+    arrival_times is given, each model is loaded when it reaches the client instead.
 
     :param inf_start: Start of the interval
     :param inf_end: End of the interval
@@ -364,6 +615,10 @@ def infer_output(inf_start, inf_end, gpu_id, run_label, gt_path, exp_num, load_r
     :param gt_path: Where ground truth labels are saved
     :param exp_num: A unique number assigned to each video that can be used to look up it's length and chosen classes
     :param load_range: The points to load new models
+    :param update_channel: A queue receiving the server's model updates, used in pipelined mode
+    :param mem_frac: Fraction of the GPU memory to use
+    :param arrival_times: The time each model of load_range reaches the client, in seconds
+    :param server: The process sending the updates, to fail instead of waiting for it forever if it dies
     :type inf_end: int
     :type inf_start: int
     :type gpu_id: str
@@ -371,6 +626,12 @@ def infer_output(inf_start, inf_end, gpu_id, run_label, gt_path, exp_num, load_r
     :type gt_path: str
     :type exp_num: int
     :type load_range: list
+    :type update_channel: multiprocessing.Queue
+    :type mem_frac: float
+    :type arrival_times: list of float
+    :type server: multiprocessing.Process
+    :return: The time spent waiting for updates, in seconds
+    :rtype: float
     """
     assert inf_end - inf_start != 0, "There should be at least one set of data points"
     # Open video, get the fps and set it's starting point to train_start
@@ -387,28 +648,110 @@ def infer_output(inf_start, inf_end, gpu_id, run_label, gt_path, exp_num, load_r
     confusion_matrix_memory = deque(maxlen=10 * fps)
     loss_s, miou_cats, miou_s, miou_mem_s = [], [], [], []
     final_save_dir = get_save_dir(run_label + "_results")
+    # Pipelined mode state: updates received but not due yet, and per-update latency logs
+    pending_updates = deque()
+    server_done = None
+    update_latencies = []
+    time_waiting = 0
+    time_client_start = time.time()
+    vis_writer = None
+    evaluation_teacher = None
+    if flags.online_teacher is not None:
+        evaluation_teacher = OnlineTeacher(flags.online_teacher, gt_path, gpu_id, height=flags.teacher_height,
+                                           batch_size=flags.teacher_batch_size)
+    # Frames read ahead of i by the evaluation teacher, next ones first
+    frames_ahead = deque()
+    # Frames at which delayed models are loaded, the newest model wins if several arrive during the same frame
+    arrival_frames = None
+    if arrival_times is not None:
+        assert len(arrival_times) == len(load_range), "Every model needs an arrival time"
+        arrival_frames = {}
+        for load_time, arrival_time in zip(load_range, arrival_times):
+            arrival_frames[max(int(np.ceil(arrival_time * fps - 1e-6)), i)] = int(load_time)
 
     while cap.isOpened() and i < inf_end_frame:
-        if i / fps in load_range:
+        load_time = None
+        if update_channel is None:
+            if arrival_frames is not None:
+                load_time = arrival_frames.get(i)
+            elif i / fps in load_range:
+                load_time = i // fps
+        else:
+            if flags.client_realtime:
+                # Show frame i at its time in the video and never wait for the server
+                time_due = time_client_start + (i - inf_start * fps) / fps
+                if time.time() < time_due:
+                    time.sleep(time_due - time.time())
+                while server_done is None:
+                    try:
+                        update = update_channel.get_nowait()
+                    except Empty:
+                        break
+                    if 'done' in update:
+                        server_done = update
+                    else:
+                        pending_updates.append(update)
+            elif i / fps in load_range:
+                # Wait until the server has trained the model for this point, ATR may have skipped it
+                time_wait = time.time()
+                while server_done is None and (len(pending_updates) == 0 or pending_updates[-1]['time'] < i // fps):
+                    update = receive_update(update_channel, server)
+                    if 'done' in update:
+                        server_done = update
+                    else:
+                        pending_updates.append(update)
+                time_waiting += time.time() - time_wait
+            while len(pending_updates) > 0 and pending_updates[0]['time'] * fps <= i:
+                update = pending_updates.popleft()
+                # Updates that are overtaken by a newer due update are never loaded
+                superseded = len(pending_updates) > 0 and pending_updates[0]['time'] * fps <= i
+                update['superseded'] = superseded
+                update['late'] = max(0., time.time() - (time_client_start + (update['time'] * fps - inf_start * fps)
+                                                        / fps)) if flags.client_realtime else 0.
+                if not superseded:
+                    load_time = update['time']
+                update_latencies.append(update)
+        if load_time is not None:
             # Load new model
-            save_dir = get_save_dir(run_label + "_%d" % (i//fps))
+            save_dir = get_save_dir(run_label + "_%d" % load_time)
             if semantic_network is not None:
                 semantic_network.close_model()
             semantic_network = SemanticNetwork(meta_dir=save_dir + "_final",
                                                class_weights_exp=class_weights(exp_num),
                                                height=flags.height,
                                                gpu_id=gpu_id,
-                                               mem_frac=1,
+                                               mem_frac=mem_frac,
                                                frozen=True)
+            if update_channel is not None:
+                update_latencies[-1]['loaded'] = time.time()
+                print_process("Update for %d s arrived %.1f ms after the server started training it" %
+                              (load_time, (update_latencies[-1]['loaded'] - update_latencies[-1]['requested']) * 1000),
+                              i / fps)
         # Load frame, actual label, the model's prediction and compute mIoU and loss
-        ret, frame = cap.read()
+        if len(frames_ahead) > 0:
+            ret, frame = True, frames_ahead.popleft()
+        else:
+            ret, frame = cap.read()
         if ret:
+            raw_frame = frame
             frame = cv2.resize(frame, (SIZE[1], SIZE[0]))
             frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
         else:
             print("Premature end of video, exiting")
             exit(1)
         gt_frame = cv2.imread("%sgt_%06d.png" % (gt_path, i), cv2.IMREAD_GRAYSCALE)
+        if gt_frame is None and evaluation_teacher is not None:
+            # The evaluation needs every frame's label, they are memoized for all the later runs. The next frames are
+            # read ahead so the ones missing a label are labeled in the same teacher batch
+            while len(frames_ahead) < flags.teacher_batch_size - 1 and i + 1 + len(frames_ahead) < inf_end_frame:
+                ret_ahead, frame_ahead = cap.read()
+                if not ret_ahead:
+                    break
+                frames_ahead.append(frame_ahead)
+            missing = [(i, raw_frame)] + [(i + 1 + k, frame_ahead) for k, frame_ahead in enumerate(frames_ahead)
+                                          if not evaluation_teacher.memoized(i + 1 + k)]
+            gt_frame = evaluation_teacher.label([index_frame for index_frame, _ in missing],
+                                                [evaluation_teacher.prepare(raw) for _, raw in missing])[0]
         gt_frame = cv2.resize(gt_frame, (SIZE[1], SIZE[0]), interpolation=cv2.INTER_NEAREST)
         labels_, conf_mat_, _, miou_, loss_ = semantic_network.predict_with_metric(np.expand_dims(frame, axis=0),
                                                                                    np.expand_dims(gt_frame, axis=0))
@@ -429,27 +772,102 @@ def infer_output(inf_start, inf_end, gpu_id, run_label, gt_path, exp_num, load_r
                                                        class_weights=class_weights(exp_num))), i / fps)
         # Save visual results: the teachers output, the student's output, the ignored pixels and the student's
         # wrongly-predicted pixels
-        if flags.save_pic:
-            save_dir_pic = final_save_dir + ("_%d_" % (i / fps))
-            cross_mask, ignore_mask = semantic_network.cross_ignore(label_teacher=gt_frame,
-                                                                    label_student=labels_[0])
-            cv2.imwrite(save_dir_pic + "cross_mask.png", cv2.cvtColor(cross_mask, cv2.COLOR_RGB2BGR))
-            cv2.imwrite(save_dir_pic + "ignore_mask.png", cv2.cvtColor(ignore_mask, cv2.COLOR_RGB2BGR))
-            overlay_teacher, output_teacher = semantic_network.colorize_teacher(label=gt_frame, frame=frame)
-            cv2.imwrite(save_dir_pic + "overlay_teacher.png", cv2.cvtColor(overlay_teacher, cv2.COLOR_RGB2BGR))
-            cv2.imwrite(save_dir_pic + "output_teacher.png", cv2.cvtColor(output_teacher, cv2.COLOR_RGB2BGR))
-            overlay_student, output_student = semantic_network.colorize(label=labels_[0], frame=frame)
-            cv2.imwrite(save_dir_pic + "output_student.png", cv2.cvtColor(output_student, cv2.COLOR_RGB2BGR))
-            cv2.imwrite(save_dir_pic + "overlay_student.png", cv2.cvtColor(overlay_student, cv2.COLOR_RGB2BGR))
-            cv2.imwrite(save_dir_pic + "frame.png", cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))
-            cv2.imwrite(save_dir_pic + "label_student.png", labels_[0])
-
-    np.save('%s_loss.npy' % final_save_dir, loss_s)
-    np.save('%s_mioucats.npy' % final_save_dir, miou_cats)
-    np.save('%s_mious.npy' % final_save_dir, miou_s)
-    np.save('%s_mioumems.npy' % final_save_dir, miou_mem_s)
+        # They are built and written by worker threads, the frame i - 1 is the one just inferred
+        if flags.save_pic and (i - 1) % flags.vis_every == 0:
+            if vis_writer is None:
+                vis_writer = VisualizationWriter(Colorizer(semantic_network), final_save_dir + "_vis",
+                                                 vis_format=flags.vis_format, workers=flags.vis_workers,
+                                                 fps=fps / flags.vis_every)
+            vis_writer.submit(i - 1, frame, gt_frame, labels_[0])
+
+    save_result(run_label, 'loss', loss_s)
+    save_result(run_label, 'mioucats', miou_cats)
+    save_result(run_label, 'mious', miou_s)
+    save_result(run_label, 'mioumems', miou_mem_s)
+    if update_channel is not None:
+        # Columns: model time, training time, end-to-end latency and lateness at the client, in ms
+        latencies = np.array([[u['time'], (u['sent'] - u['requested']) * 1000,
+                               (u.get('loaded', np.nan) - u['requested']) * 1000, u['late'] * 1000]
+                              for u in update_latencies])
+        save_result(run_label, 'update_latency', latencies)
+        if server_done is not None:
+            # Hand the server's report back to run_pipelined
+            update_channel.put(server_done)
     cap.release()
     semantic_network.close_model()
+    if vis_writer is not None:
+        vis_writer.close()
+    if evaluation_teacher is not None:
+        if evaluation_teacher.labeled > 0:
+            print_process(evaluation_teacher.summary(), i / fps)
+        evaluation_teacher.close()
+    return time_waiting
+
+
+def run_pretrained(vid_num):
+    """
+    Computes the results of the pretrained model over the whole video, the baseline of all modes.
+    """
+    train_model(0, 1, flags.send_period, flags.gpu, "pretrained", flags.gt_video, vid_num, [0], flags.train_period)
+    infer_output(0, test_length(vid_num), flags.gpu, "pretrained", flags.gt_video, vid_num, [0])
+
+
+def receive_update(update_channel, server):
+    """
+    Waits for the next message of the pipelined server, and raises if the server process exits before sending one, e.g.
+    after running out of memory.
+
+    :type update_channel: multiprocessing.Queue
+    :type server: multiprocessing.Process
+    :rtype: dict
+    """
+    while True:
+        try:
+            return update_channel.get(timeout=SERVER_POLL_INTERVAL)
+        except Empty:
+            if server is not None and not server.is_alive():
+                # A message sent right before exiting may only be readable now
+                try:
+                    return update_channel.get_nowait()
+                except Empty:
+                    raise RuntimeError('The pipelined server exited with code %s' % server.exitcode)
+
+
+def pipelined_server(args, train_args, update_channel, mem_frac):
+    """
+    Runs train_model in the server process of the pipelined mode and reports its busy time on the channel when done.
+    """
+    configure(args)
+    time_start = time.time()
+    train_model(*train_args, update_channel=update_channel, mem_frac=mem_frac)
+    update_channel.put({'done': True, 'busy': time.time() - time_start})
+
+
+def run_pipelined(run_label, vid_num, event_list):
+    """
+    Runs the server's training and the client's inference concurrently in separate processes connected by an update
+    queue, and compares the wall-clock time with running them one after the other.
+    """
+    ctx = mp.get_context('spawn')
+    update_channel = ctx.Queue()
+    time_start = time.time()
+    train_args = (0, test_length(vid_num), flags.send_period, flags.gpu, run_label, flags.gt_video, vid_num,
+                  event_list, flags.train_period)
+    server = ctx.Process(target=pipelined_server, args=(flags, train_args, update_channel, flags.pipeline_mem_frac))
+    server.start()
+    time_waiting = infer_output(0, test_length(vid_num), flags.gpu, run_label, flags.gt_video, vid_num, event_list,
+                                update_channel=update_channel, mem_frac=flags.pipeline_mem_frac, server=server)
+    time_client = time.time() - time_start - time_waiting
+    message = receive_update(update_channel, server)
+    while 'done' not in message:
+        message = receive_update(update_channel, server)
+    server.join()
+    time_wall = time.time() - time_start
+    latencies = load_result(run_label, 'update_latency')
+    print_process("Update latency: mean %.1f ms, max %.1f ms, %d late updates" %
+                  (np.nanmean(latencies[:, 2]), np.nanmax(latencies[:, 2]), np.sum(latencies[:, 3] > 0)), -1)
+    print_process("Pipelined wall-clock time %.1f s, sequential would take %.1f s (server %.1f s + client %.1f s)" %
+                  (time_wall, message['busy'] + time_client, message['busy'], time_client), -1)
 
 
 def k1k2_plot(ts, k1s, k2s):
@@ -463,12 +881,8 @@ def k1k2_plot(ts, k1s, k2s):
     :type k1s: list
     :type k2s: list
     """
-    cap = cv2.VideoCapture(flags.input_video)
-    if not cap.isOpened():
-        print_process("Error opening video stream or file", -1)
-        exit(1)
-    fps = round(cap.get(cv2.CAP_PROP_FPS))
-    cap.release()
+    # From the video catalog, the video is only opened if it was not probed
+    fps = video_fps(flags.input_video)
     # To compare against pretrained, first load data for the pretrained version
     # There are two methods to compute mIoU:
     # 1: sum up all the confusion matrices of frames and then calculate mIoU
@@ -480,40 +894,22 @@ def k1k2_plot(ts, k1s, k2s):
     # the bad performance at the start but the 2nd version gives these time spans the same weight. However the mIoU of
     # the individual frames are noisy. So we used the 3rd version which de-noises them a bit. Despite these
     # explanations, actual results showed all versions to follow the same trends and gaps.
-    pretrained_confmats = np.load(get_save_dir("pretrained_results") + "_mioucats.npy")
-    pretrained_mious = np.load(get_save_dir("pretrained_results") + "_mious.npy")
-    pretrained_miou_mems = np.load(get_save_dir("pretrained_results") + "_mioumems.npy")
-    results_conf_mious = np.empty((len(k1s), len(k2s)))
-    results_avg_mious = np.empty((len(k1s), len(k2s)))
-    results_miou_mems = np.empty((len(k1s), len(k2s)))
+    pretrained = HorizonIndex(load_result("pretrained", 'mioucats'), load_result("pretrained", 'mious'),
+                              load_result("pretrained", 'mioumems'))
+    diff_conf_mious = np.empty((len(k1s), len(k2s), len(ts)))
+    diff_avg_mious = np.empty((len(k1s), len(k2s), len(ts)))
+    diff_mem_mious = np.empty((len(k1s), len(k2s), len(ts)))
+    # A single pass over the runs: every run is indexed once and evaluated for all inference horizons
     for i_k1, k1 in enumerate(k1s):
-        for i_k2, k2 in enumerate(k2s):
-            diff_conf_mious, diff_avg_mious, diff_mem_mious = [], [], []
-            for t in ts:
-                trained_conf_mats = np.load(get_save_dir("%d__%d__%d_f%d_results" %
-                                                         (t - k1, t, t + k2s[-1], flags.send_period)) + "_mioucats.npy")
-                assert trained_conf_mats[:k2 * fps].shape == pretrained_confmats[t * fps:(t + k2) * fps].shape
-                pretrained_conf_miou = np.nanmean(calculate_miou(
-                    np.sum(pretrained_confmats[t * fps:(t + k2) * fps], axis=0), nan=True))
-                trained_conf_miou = np.nanmean(calculate_miou(np.sum(trained_conf_mats[:k2 * fps], axis=0), nan=True))
-                diff_conf_mious.append(trained_conf_miou - pretrained_conf_miou)
-
-                trained_mious = np.load(get_save_dir("%d__%d__%d_f%d_results" %
-                                                     (t - k1, t, t + k2s[-1], flags.send_period)) + "_mious.npy")
-                assert trained_mious[:k2 * fps].shape == pretrained_mious[t * fps:(t + k2) * fps].shape
-                pretrained_avg_miou = np.mean(pretrained_mious[t * fps:(t + k2) * fps])
-                trained_avg_miou = np.mean(trained_mious[:k2 * fps])
-                diff_avg_mious.append(trained_avg_miou - pretrained_avg_miou)
-
-                trained_miou_mems = np.load(get_save_dir("%d__%d__%d_f%d_results" %
-                                                     (t - k1, t, t + k2s[-1], flags.send_period)) + "_mioumems.npy")
-                assert trained_miou_mems[:k2 * fps].shape == pretrained_miou_mems[t * fps:(t + k2) * fps].shape
-                pretrained_mioumem = np.mean(pretrained_miou_mems[t * fps:(t + k2) * fps])
-                trained_mioumem = np.mean(trained_miou_mems[:k2 * fps])
-                diff_mem_mious.append(trained_mioumem - pretrained_mioumem)
-            results_conf_mious[i_k1, i_k2] = np.mean(diff_conf_mious)
-            results_avg_mious[i_k1, i_k2] = np.mean(diff_avg_mious)
-            results_miou_mems[i_k1, i_k2] = np.mean(diff_mem_mious)
+        for i_t, t in enumerate(ts):
+            run_label = "%d__%d__%d_f%d" % (t - k1, t, t + k2s[-1], flags.send_period)
+            trained = HorizonIndex(load_result(run_label, 'mioucats'), load_result(run_label, 'mious'),
+                                   load_result(run_label, 'mioumems'))
+            diff_conf_mious[i_k1, :, i_t], diff_avg_mious[i_k1, :, i_t], diff_mem_mious[i_k1, :, i_t] = \
+                horizon_diffs(pretrained, trained, t, k2s, fps)
+    results_conf_mious = np.mean(diff_conf_mious, axis=2)
+    results_avg_mious = np.mean(diff_avg_mious, axis=2)
+    results_miou_mems = np.mean(diff_mem_mious, axis=2)
 
     print("Confusions Matrix-Based mIoUs:")
     for i_k1, k1 in enumerate(k1s):
@@ -543,14 +939,89 @@ def plot_miou_mean(period, sampling_period, run_label):
     :type run_label: str
     """
     final_save_dir = get_save_dir(run_label + "_results")
-    with open(final_save_dir + '_update.txt', 'r') as f:
-        downlink_size, uplink_size, update_count, interval, samples_sent = [k.rstrip('\n') for k in f.readlines()]
-    miou_s = np.load('%s_mioumems.npy' % get_save_dir(run_label + "_results"))
-    print(f'({period}, {sampling_period}, {np.mean(miou_s[7500:]) * 100})')
+    if results_store().contains(final_save_dir[len(flags.output_dir):], 'update'):
+        downlink_size, uplink_size, update_count, interval, samples_sent = load_result(run_label, 'update')
+    else:
+        # Runs from before the results store wrote the bandwidth stats to a text file
+        with open(final_save_dir + '_update.txt', 'r') as f:
+            downlink_size, uplink_size, update_count, interval, samples_sent = [int(k) for k in f.readlines()]
+    miou_s = load_result(run_label, 'mioumems')
+    # Skip the first frames, where the memory is still filling up
+    print(f'({period}, {sampling_period}, {np.mean(miou_s[flags.eval_skip_frames:]) * 100})')
     print(f'Uplink: {uplink_size / interval / 1024}, Downlink: {downlink_size / interval / 1024}, Sampling rate: '
           f'{samples_sent / interval}, Update rate: {update_count / interval}')
 
 
+_results_store = None
+
+
+def results_store():
+    """
+    :return: The results store shared by all runs written to output_dir
+    :rtype: ResultsStore
+    """
+    global _results_store
+    if _results_store is None:
+        _results_store = ResultsStore(flags.output_dir + 'results')
+    return _results_store
+
+
+def save_result(run_label, name, array):
+    """
+    This helper function saves one of the result arrays of the run with this run_label to the results store.
+    """
+    results_store().append(get_save_dir(run_label + "_results")[len(flags.output_dir):], name, array)
+
+
+def load_result(run_label, name):
+    """
+    This helper function loads a result array of the run with this run_label, from the results store or from the .npy
+    file written by older versions.
+    :rtype: np.ndarray
+    """
+    final_save_dir = get_save_dir(run_label + "_results")
+    return load_stored_result(results_store(), final_save_dir[len(flags.output_dir):], name, final_save_dir)
+
+
+_result_cache = None
+
+
+def result_cache():
+    """
+    :return: The result cache shared by all runs written to output_dir
+    :rtype: ResultCache
+    """
+    global _result_cache
+    if _result_cache is None:
+        _result_cache = ResultCache(flags.output_dir + 'result_cache.json')
+    return _result_cache
+
+
+def run_cached(run_label, run):
+    """
+    This helper function calls run, which must compute and store the results of run_label, unless results computed from
+    the same inputs and flags are stored already.
+    :type run_label: str
+    :type run: callable
+    """
+    key = get_save_dir(run_label + "_results")[len(flags.output_dir):]
+    settings = {k: v for k, v in vars(flags).items() if k not in CACHE_IGNORED_FLAGS}
+    input_paths = [flags.input_video] + checkpoint_files(flags.student_checkpoint)
+    input_paths += [path for path in [flags.uplink_trace, flags.downlink_trace] if path is not None]
+    if flags.online_teacher is not None:
+        # The online teacher writes its labels to gt_video on every run, the labels follow from its checkpoint
+        input_paths += checkpoint_files(flags.online_teacher)
+    else:
+        input_paths.append(flags.gt_video)
+    digest = result_cache().run_digest(key, input_paths, settings)
+    if not flags.no_cache and result_cache().is_valid(key, digest) and results_store().contains(key, 'mioumems'):
+        print_process("Using the cached results of %s" % run_label, -1)
+        return
+    result_cache().invalidate(key)
+    run()
+    result_cache().record(key, digest)
+
+
 def get_save_dir(prepend):
     """
     This helper function returns a label, given a prepending string and the arguments.
@@ -564,6 +1035,20 @@ def get_save_dir(prepend):
                                                flags.student_checkpoint.split('/')[-2], flags.height)
 
 
+def string_trace_summary(summary):
+    """
+    This helper function formats the per-phase timings recorded by the tracer.
+    :param summary: The output of Tracer.summary()
+    :type summary: dict
+    :rtype: str
+    """
+    str_out = "%-22s\t%8s\t%12s\t%10s\n" % ("Phase", "Count", "Total (ms)", "Mean (ms)")
+    for name in sorted(summary, key=lambda k: -summary[k]['total_ms']):
+        str_out += "%-22s\t%8d\t%12.1f\t%10.2f\n" % (name, summary[name]['count'], summary[name]['total_ms'],
+                                                       summary[name]['mean_ms'])
+    return str_out
+
+
 def print_process(str_log, curr_time):
     """
     This helper function tidies up command line outputs.
@@ -581,20 +1066,51 @@ def main():
 
     vid_num = int(flags.input_video.split("/")[-1].split("-")[0])
 
+    if flags.trace_output is not None:
+        profile_iters = [int(it) for it in flags.profile_iters.split(',') if it.strip()]
+        tracer.enable(capacity=flags.trace_capacity, profile_iters=profile_iters,
+                      profile_prefix=os.path.splitext(flags.trace_output)[0] + '_step')
+
     if flags.mode == 'simple':
         run_label = "%d__%d_tp%d_f%d" % (0, test_length(vid_num), flags.train_period, flags.send_period)
+        if flags.sampling_policy != 'uniform':
+            run_label += '_' + flags.sampling_policy
         event_list = [0]
         first_train = np.ceil(100 / flags.train_period) * flags.train_period
         event_list.extend([i for i in range(first_train, test_length(vid_num), flags.train_period)
                            if i == 0 or i >= flags.memory_len or not flags.initial_fill])
-        if not flags.only_results:
+        def run():
             train_model(0, test_length(vid_num), flags.send_period, flags.gpu,
-                        run_label, flags.gt_video, vid_num, event_list, flags.train_period)
+                        run_label, flags.gt_video, vid_num, list(event_list), flags.train_period)
+            load_range = event_list
             if flags.enable_ATR:
                 # When ATR is enabled event_list can change, so load it
-                event_list = np.load(get_save_dir(run_label + "_results") + '_model_update_times.npy').tolist()
+                load_range = load_result(run_label, 'model_update_times').tolist()
+            arrival_times = None
+            if flags.emulate_link:
+                # Load every saved model when it arrives, in the order of their save times
+                load_range = load_result(run_label, 'model_update_times').tolist()
+                arrival_times = load_result(run_label, 'model_arrival_times').tolist()
             infer_output(0, test_length(vid_num), flags.gpu,
-                         run_label, flags.gt_video, vid_num, event_list)
+                         run_label, flags.gt_video, vid_num, load_range, arrival_times=arrival_times)
+        if not flags.only_results:
+            run_cached(run_label, run)
+
+        plot_miou_mean(flags.train_period, flags.send_period, run_label)
+        uniform_label = "%d__%d_tp%d_f%d" % (0, test_length(vid_num), flags.train_period, flags.send_period)
+        if uniform_label != run_label and results_store().contains(
+                get_save_dir(uniform_label + "_results")[len(flags.output_dir):], 'update'):
+            # Report the uniform policy's run of the same settings next to this one
+            print(colored("Uniform sampling:", "cyan"))
+            plot_miou_mean(flags.train_period, flags.send_period, uniform_label)
+    elif flags.mode == 'pipelined':
+        run_label = "pipe%d__%d_tp%d_f%d" % (0, test_length(vid_num), flags.train_period, flags.send_period)
+        event_list = [0]
+        first_train = int(np.ceil(100 / flags.train_period) * flags.train_period)
+        event_list.extend([i for i in range(first_train, test_length(vid_num), flags.train_period)
+                           if i == 0 or i >= flags.memory_len or not flags.initial_fill])
+        if not flags.only_results:
+            run_pipelined(run_label, vid_num, event_list)
 
         plot_miou_mean(flags.train_period, flags.send_period, run_label)
     elif flags.mode == 'horizon':
@@ -607,9 +1123,7 @@ def main():
         step = (test_length(vid_num) - k2 - k1s[-1]) // (number_of_points - 1)
         if not flags.only_results:
             # Get pretrained data
-            run_label = "pretrained"
-            train_model(0, 1, flags.send_period, flags.gpu, run_label, flags.gt_video, vid_num, [0], flags.train_period)
-            infer_output(0, test_length(vid_num), flags.gpu, run_label, flags.gt_video, vid_num, [0])
+            run_cached("pretrained", lambda: run_pretrained(vid_num))
             done = 0
             total = number_of_points * len(k1s)
             time_start = time.time()
@@ -618,9 +1132,12 @@ def main():
                 for k1 in k1s:
                     run_label = "%d__%d__%d_f%d" % (t - k1, t, t + k2, flags.send_period)
                     print("t: %d, k1: %d" % (t, k1))
-                    train_model(t - k1, t, flags.send_period, flags.gpu, run_label, flags.gt_video, vid_num, [t],
-                                flags.train_period)
-                    infer_output(t, t + k2, flags.gpu, run_label, flags.gt_video, vid_num, [t])
+
+                    def run():
+                        train_model(t - k1, t, flags.send_period, flags.gpu, run_label, flags.gt_video, vid_num, [t],
+                                    flags.train_period)
+                        infer_output(t, t + k2, flags.gpu, run_label, flags.gt_video, vid_num, [t])
+                    run_cached(run_label, run)
                     done += 1
                     time_to_finish = (time.time() - time_start) / done * (total - done)
                     print("ETF %02d:%02d.%02d" % (time_to_finish // 60, time_to_finish % 60,
@@ -635,20 +1152,25 @@ def main():
     elif flags.mode == 'early':
         run_label = "early%d_f%d" % (flags.early_cutoff_time, flags.send_period)
         event_list = [0, flags.early_cutoff_time]
-        if not flags.only_results:
+        def run():
             train_model(0, flags.early_cutoff_time, flags.send_period, flags.gpu, run_label, flags.gt_video, vid_num,
                         event_list, flags.train_period)
             infer_output(0, test_length(vid_num), flags.gpu, run_label, flags.gt_video, vid_num, event_list)
+        if not flags.only_results:
+            run_cached(run_label, run)
 
         plot_miou_mean(-1, flags.send_period, run_label)
     elif flags.mode == 'pretrained':
         run_label = "pretrained"
-        train_model(0, 1, flags.send_period, flags.gpu, run_label, flags.gt_video, vid_num, [0], flags.train_period)
-        infer_output(0, test_length(vid_num), flags.gpu, run_label, flags.gt_video, vid_num, [0])
+        run_cached(run_label, lambda: run_pretrained(vid_num))
         plot_miou_mean(-1, -1, run_label)
 
+    if flags.trace_output is not None:
+        tracer.export(flags.trace_output)
+        print(colored("Process [Main]:", "green"), "Trace written to %s" % flags.trace_output)
     print(colored("Process [Main]:", "green"), "Done!!!")
 
 
 if __name__ == "__main__":
+    configure(parse_args())
     main()
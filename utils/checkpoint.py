@@ -0,0 +1,162 @@
+import os
+import sys
+import json
+import struct
+import argparse
+
+import numpy as np
+
+# An .amsckpt file is the magic, the length of the JSON header, the header, then the raw tensors in C order. The header
+# lists the name, dtype, shape and byte offset of every tensor, offsets are aligned so each tensor can be viewed in
+# place. The file is memory-mapped, a tensor is only read from disk when it is used.
+CHECKPOINT_EXT = '.amsckpt'
+MAGIC = b'AMSCKPT1'
+ALIGNMENT = 64
+
+
+def _aligned(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write_checkpoint(path, tensors):
+    """
+    :param path: The checkpoint's path, ending with .amsckpt
+    :param tensors: The tensors by variable name, as in the .npy dicts
+    :type path: str
+    :type tensors: dict
+    """
+    tensors = {name: np.ascontiguousarray(tensors[name]) for name in tensors}
+    for name in tensors:
+        assert not tensors[name].dtype.hasobject, 'Tensor %s is not numeric' % name
+    index = []
+    offset = 0
+    for name in sorted(tensors):
+        index.append({'name': name, 'dtype': tensors[name].dtype.str, 'shape': list(tensors[name].shape),
+                      'offset': offset})
+        offset = _aligned(offset + tensors[name].nbytes)
+    header = json.dumps({'alignment': ALIGNMENT, 'tensors': index}).encode('utf-8')
+    data_start = _aligned(len(MAGIC) + 8 + len(header))
+    # Written under a temporary name and renamed when complete, so a partially written checkpoint is never read
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for entry in index:
+            f.seek(data_start + entry['offset'])
+            f.write(tensors[entry['name']].tobytes())
+        f.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+
+
+class Checkpoint(object):
+    """
+    Read-only mapping of variable names to the tensors of an .amsckpt file. The tensors are views of the memory-mapped
+    file, copy them before modifying them.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            magic = f.read(len(MAGIC))
+            assert magic == MAGIC, '%s is not an %s checkpoint' % (path, CHECKPOINT_EXT)
+            header_len = struct.unpack('<Q', f.read(8))[0]
+            header = json.loads(f.read(header_len).decode('utf-8'))
+        assert header['alignment'] == ALIGNMENT, 'Unsupported alignment in %s' % path
+        self.path = path
+        self.data_start = _aligned(len(MAGIC) + 8 + header_len)
+        self.index = {entry['name']: entry for entry in header['tensors']}
+        self.data = np.memmap(path, dtype=np.uint8, mode='r') if os.path.getsize(path) > self.data_start else None
+
+    def __getitem__(self, name):
+        entry = self.index[name]
+        if self.data is None:
+            return np.zeros(entry['shape'], dtype=np.dtype(entry['dtype']))
+        return np.ndarray(shape=entry['shape'], dtype=np.dtype(entry['dtype']), buffer=self.data,
+                          offset=self.data_start + entry['offset'])
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def keys(self):
+        return list(self.index)
+
+    def items(self):
+        return [(name, self[name]) for name in self.index]
+
+    def shape(self, name):
+        return tuple(self.index[name]['shape'])
+
+
+def checkpoint_prefix(path):
+    return path[:-len('.npy')] if path.endswith('.npy') else path
+
+
+def load_checkpoint(path):
+    """
+    Opens PREFIX.amsckpt, unless PREFIX.npy is newer or the only one there, which is then unpickled as before.
+
+    :param path: The checkpoint prefix, e.g. the student's meta_dir, or the path of its .npy
+    :type path: str
+    :return: The tensors by variable name
+    :rtype: Checkpoint or dict
+    """
+    prefix = checkpoint_prefix(path)
+    npy_path = prefix + '.npy'
+    ckpt_path = prefix + CHECKPOINT_EXT
+    if os.path.exists(ckpt_path) and (not os.path.exists(npy_path) or
+                                      os.path.getmtime(ckpt_path) >= os.path.getmtime(npy_path)):
+        return Checkpoint(ckpt_path)
+    return np.load(npy_path, allow_pickle=True).item()
+
+
+def convert_checkpoint(npy_path):
+    """
+    Writes the .amsckpt of an .npy checkpoint next to it.
+
+    :return: Path of the .amsckpt
+    :rtype: str
+    """
+    tensors = np.load(npy_path, allow_pickle=True).item()
+    ckpt_path = checkpoint_prefix(npy_path) + CHECKPOINT_EXT
+    write_checkpoint(ckpt_path, tensors)
+    checkpoint = Checkpoint(ckpt_path)
+    assert sorted(checkpoint.keys()) == sorted(tensors.keys())
+    for name in tensors:
+        assert np.array_equal(checkpoint[name], tensors[name]), 'Tensor %s differs after conversion' % name
+    return ckpt_path
+
+
+def checkpoint_test():
+    tensors = {'conv/weights:0': np.random.randn(3, 3, 3, 8).astype(np.float32),
+               'conv/BatchNorm/beta:0': np.random.randn(8).astype(np.float32),
+               'global_step:0': np.array(7, dtype=np.int64),
+               'empty:0': np.zeros((0, 4), dtype=np.float32)}
+    np.save('/tmp/checkpoint_test.npy', tensors)
+    os.utime('/tmp/checkpoint_test.npy', (0, 0))
+    convert_checkpoint('/tmp/checkpoint_test.npy')
+    checkpoint = load_checkpoint('/tmp/checkpoint_test')
+    assert isinstance(checkpoint, Checkpoint)
+    for name in tensors:
+        assert checkpoint[name].dtype == tensors[name].dtype and np.array_equal(checkpoint[name], tensors[name])
+        assert checkpoint[name].ctypes.data % ALIGNMENT == 0 or checkpoint[name].size == 0
+    print('Checkpoint round trip is exact for %d tensors' % len(checkpoint))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Converts .npy checkpoints to %s' % CHECKPOINT_EXT)
+    parser.add_argument('npy_paths', type=str, nargs='*', help='The .npy checkpoints to convert')
+    parser.add_argument('--test', action='store_true', help='Run the round trip test')
+    args = parser.parse_args()
+    if args.test:
+        checkpoint_test()
+    for npy_path in args.npy_paths:
+        if not os.path.exists(npy_path):
+            print('%s not found' % npy_path)
+            sys.exit(1)
+        print('Converted %s to %s' % (npy_path, convert_checkpoint(npy_path)))
@@ -4,11 +4,13 @@ import tensorflow as tf
 import numpy as np
 from tensorflow.python.tools import strip_unused_lib
 from tensorflow.python.framework import dtypes
+from tensorflow.python.ops import gen_data_flow_ops
 import sys
 import copy
 
 sys.path.append('../../.')
 from ams.utils.utils import colormap, prune, inspect
+from ams.utils.checkpoint import load_checkpoint
 
 # TODO: simplify code, remove the sys.append, test running it, merge with other profilers
 
@@ -262,15 +264,74 @@ def create_teacher_v2(meta_dir, class_weights=False, test_mode=False):
     return teacher
 
 
-def prob_confmat(student_labels, teacher_probs, num_classes):
-    mat = []
-    student_labels = tf.reshape(student_labels, [-1])
+def reduce_labels(labels, class_indices, total_classes=NUM_CLASSES):
+    """
+    Maps full-set labels to indices in the class subset with an int32 lookup table. This gives the same result as
+    gathering the subset columns of a one-hot encoding and taking the argmax, without the HxWxtotal_classes float
+    intermediate.
+
+    :param labels: Label tensor with values in [0, total_classes), other values are treated as ignored
+    :param class_indices: Indices of the classes in the subset
+    :param total_classes: Number of classes in the full label set
+    :type class_indices: np.ndarray or list
+    :type total_classes: int
+    :return: The reduced int32 labels and a float32 weight that is 0 for pixels outside of the subset
+    """
+    # The extra last entry catches the out-of-range labels, which one_hot would have encoded as all zeros
+    lut = np.zeros(total_classes + 1, dtype=np.int32)
+    lut[class_indices] = np.arange(len(class_indices), dtype=np.int32)
+    valid = np.zeros(total_classes + 1, dtype=np.float32)
+    valid[class_indices] = 1
+    labels = tf.cast(labels, tf.int32)
+    in_range = tf.logical_and(tf.greater_equal(labels, 0), tf.less(labels, total_classes))
+    labels = tf.where(in_range, labels, tf.fill(tf.shape(labels), total_classes))
+    return tf.gather(tf.constant(lut), labels), tf.gather(tf.constant(valid), labels)
+
+
+def reduce_labels_test():
+    total_classes = NUM_CLASSES
+    class_indices = np.array([0, 2, 8, 10, 11, 13])
+    num_classes = len(class_indices)
+    graph = tf.Graph()
+    with graph.as_default():
+        # Include an out-of-range value to make sure it is ignored in both versions
+        labels = tf.random_uniform(minval=0, maxval=total_classes + 1, shape=[4, 64, 128], dtype=tf.int32)
+        predictions = tf.random_uniform(minval=0, maxval=num_classes, shape=[4, 64, 128], dtype=tf.int32)
+        labels_onehot = tf.one_hot(labels, total_classes, axis=-1)
+        filtered_labels_onehot = tf.gather(labels_onehot, class_indices, axis=-1)
+        onehot_labels = tf.argmax(filtered_labels_onehot, axis=-1, output_type=tf.int32)
+        onehot_weights = tf.reduce_sum(filtered_labels_onehot, axis=-1)
+        lut_labels, lut_weights = reduce_labels(labels, class_indices, total_classes)
+        _, onehot_update = tf.metrics.mean_iou(labels=onehot_labels, predictions=predictions,
+                                               num_classes=num_classes, weights=onehot_weights)
+        _, lut_update = tf.metrics.mean_iou(labels=lut_labels, predictions=predictions,
+                                            num_classes=num_classes, weights=lut_weights)
+        reset = tf.initializers.local_variables()
+    with tf.Session(graph=graph) as sess:
+        for i in range(3):
+            sess.run(reset)
+            conf_onehot, conf_lut = sess.run([onehot_update, lut_update])
+            assert np.array_equal(conf_onehot, conf_lut), 'Confusion matrices differ'
+            print('Iteration %d: identical confusion matrices over %d pixels' % (i, np.sum(conf_lut)))
+
+
+def _soft_confusion(labels, valid, teacher_probs, num_classes):
+    # Sums the teacher's probabilities of the valid pixels per label with one segment sum, O(pixels * classes). The
+    # invalid pixels go to an extra segment that is dropped. Row t, column s holds the probability mass of teacher
+    # class t on the pixels labeled s
+    labels = tf.reshape(labels, [-1])
     teacher_probs = tf.reshape(teacher_probs, [-1, tf.shape(teacher_probs)[-1]])
-    for i in range(num_classes):
-        mat.append(tf.expand_dims(tf.where(tf.equal(student_labels,i), teacher_probs, tf.zeros_like(teacher_probs)), axis=-1))
-    mat = tf.concat(mat, axis=-1)
-    mat = tf.reduce_sum(mat, axis=0)
+    valid = tf.logical_and(valid, tf.logical_and(tf.greater_equal(labels, 0), tf.less(labels, num_classes)))
+    segments = tf.where(valid, labels, tf.fill(tf.shape(labels), tf.cast(num_classes, labels.dtype)))
+    mat = tf.unsorted_segment_sum(teacher_probs, segments, num_classes + 1)[:num_classes]
+    mat = tf.transpose(mat)
     mat.set_shape([num_classes, num_classes])
+    return mat
+
+
+def prob_confmat(student_labels, teacher_probs, num_classes):
+    student_labels = tf.reshape(student_labels, [-1])
+    mat = _soft_confusion(student_labels, tf.ones_like(student_labels, dtype=tf.bool), teacher_probs, num_classes)
 
     acc_mat = tf.Variable(tf.zeros_like(mat), trainable=False, collections=[], name='prob_conf_mat')
     reset = tf.initializers.variables([acc_mat], name='init_prob_confmat')
@@ -286,27 +347,9 @@ def prob_confmat(student_labels, teacher_probs, num_classes):
 
 
 def prob_confmat_star(student_labels, teacher_labels, weights, teacher_probs, num_classes):
-    mat_stu = []
-    student_labels = tf.reshape(student_labels, [-1])
-    weights = tf.reshape(weights, [-1])
-    teacher_probs = tf.reshape(teacher_probs, [-1, tf.shape(teacher_probs)[-1]])
-    for i in range(num_classes):
-        mat_stu.append(tf.expand_dims(tf.where(tf.logical_and(tf.equal(student_labels, i), tf.not_equal(weights, 0)),
-                                               teacher_probs, tf.zeros_like(teacher_probs)), axis=-1))
-    mat_stu = tf.concat(mat_stu, axis=-1)
-    mat_stu = tf.reduce_sum(mat_stu, axis=0)
-    mat_stu.set_shape([num_classes, num_classes])
-
-    mat_star = []
-    teacher_labels = tf.reshape(teacher_labels, [-1])
-    teacher_probs = tf.reshape(teacher_probs, [-1, tf.shape(teacher_probs)[-1]])
-    for i in range(num_classes):
-        mat_star.append(
-            tf.expand_dims(tf.where(tf.logical_and(tf.equal(teacher_labels, i), tf.not_equal(weights, 0)),
-                                    teacher_probs, tf.zeros_like(teacher_probs)), axis=-1))
-    mat_star = tf.concat(mat_star, axis=-1)
-    mat_star = tf.reduce_sum(mat_star, axis=0)
-    mat_star.set_shape([num_classes, num_classes])
+    valid = tf.not_equal(tf.reshape(weights, [-1]), 0)
+    mat_stu = _soft_confusion(student_labels, valid, teacher_probs, num_classes)
+    mat_star = _soft_confusion(teacher_labels, valid, teacher_probs, num_classes)
 
     acc_mat_stu = tf.Variable(tf.zeros_like(mat_stu), trainable=False, collections=[], name='prob_conf_mat_stu')
     acc_mat_star = tf.Variable(tf.zeros_like(mat_star), trainable=False, collections=[], name='prob_conf_mat_star')
@@ -317,26 +360,188 @@ def prob_confmat_star(student_labels, teacher_labels, weights, teacher_probs, nu
     return update_stu, update_star, reset
 
 
+def _prob_confmat_loop(labels, weights, teacher_probs, num_classes):
+    # The former per-class implementation, O(pixels * classes^2), kept as the reference of prob_confmat_test
+    mat = []
+    labels = tf.reshape(labels, [-1])
+    weights = tf.reshape(weights, [-1])
+    teacher_probs = tf.reshape(teacher_probs, [-1, tf.shape(teacher_probs)[-1]])
+    for i in range(num_classes):
+        mat.append(tf.expand_dims(tf.where(tf.logical_and(tf.equal(labels, i), tf.not_equal(weights, 0)),
+                                           teacher_probs, tf.zeros_like(teacher_probs)), axis=-1))
+    mat = tf.concat(mat, axis=-1)
+    mat = tf.reduce_sum(mat, axis=0)
+    mat.set_shape([num_classes, num_classes])
+    return mat
+
+
 def prob_confmat_test():
-    num_classes = 7
-    student_labels = tf.random_uniform(minval=0, maxval=num_classes, shape=[10, 20, 30], dtype=tf.int32)
-    teacher_probs = tf.random_uniform(minval=0, maxval=1, shape=[10, 20, 30, num_classes], dtype=tf.float32)
+    import time
+    num_classes = 19
+    shape = [8, 256, 512]
+    student_labels = tf.random_uniform(minval=0, maxval=num_classes, shape=shape, dtype=tf.int32)
+    teacher_labels = tf.random_uniform(minval=0, maxval=num_classes, shape=shape, dtype=tf.int32)
+    weights = tf.cast(tf.random_uniform(minval=0, maxval=2, shape=shape, dtype=tf.int32), tf.float32)
+    teacher_probs = tf.random_uniform(minval=0, maxval=1, shape=shape + [num_classes], dtype=tf.float32)
     teacher_probs = teacher_probs / tf.reduce_sum(teacher_probs, axis=-1, keepdims=True)
+    inputs = [student_labels, teacher_labels, weights, teacher_probs]
+    loop_mats = [_prob_confmat_loop(student_labels, tf.ones_like(weights), teacher_probs, num_classes),
+                 _prob_confmat_loop(student_labels, weights, teacher_probs, num_classes),
+                 _prob_confmat_loop(teacher_labels, weights, teacher_probs, num_classes)]
     update, miou, reset = prob_confmat(student_labels, teacher_probs, num_classes)
+    update_stu, update_star, reset_star = prob_confmat_star(student_labels, teacher_labels, weights, teacher_probs,
+                                                            num_classes)
     with tf.Session() as sess:
-        sess.run(reset)
+        sess.run([reset, reset_star])
         for i in range(3):
-            print(sess.run([miou,update]))
-            print(sess.run(miou))
+            # Same random inputs for both implementations
+            values = sess.run(inputs)
+            feed = dict(zip(inputs, values))
+            expected = sess.run(loop_mats, feed_dict=feed)
+            sess.run([reset, reset_star])
+            computed = sess.run([update, update_stu, update_star], feed_dict=feed)
+            for name, mat_expected, mat_computed in zip(['prob_confmat', 'prob_confmat_star (student)',
+                                                         'prob_confmat_star (teacher)'], expected, computed):
+                assert np.allclose(mat_expected, mat_computed, rtol=1e-4, atol=1e-2), '%s differs' % name
+            print('Iteration %d: identical soft confusion matrices, soft mIoU %.4f' % (i, sess.run(miou)))
+        feed = dict(zip(inputs, sess.run(inputs)))
+        for name, fetches in [('loop', loop_mats), ('segment sum', [update, update_stu, update_star])]:
+            sess.run(fetches, feed_dict=feed)
+            t1 = time.time()
+            for _ in range(10):
+                sess.run(fetches, feed_dict=feed)
+            print('%s: %.1f ms for %d pixels' % (name, (time.time() - t1) * 100, np.prod(shape)))
+
+def create_device_input(graph, crop_size, scales, mini_batch_size, flip=False):
+    """
+    Builds the input path that augments on the device instead of in mini_batch. The frames and labels of a round are
+    fed once, as uint8, to a buffer in the graph. Every augment_step then picks mini_batch_size samples, each at one of
+    the scales, resizes them, takes random crops of crop_size and hands them to the student the way fill_input_buffer
+    does: enqueued to the student's queue (the DeepLab checkpoints), or written to its images and labels variables
+    (the synthetic student). The sizes and crop offsets are computed as in mini_batch.
+
+    :param graph: The student's graph, from create_student_v3
+    :param crop_size: Height and width of the crops
+    :param scales: Scales the crops are taken from, at least 1
+    :param mini_batch_size: Number of crops per step
+    :param flip: Randomly flip the crops horizontally
+    :type graph: tf.Graph
+    :type crop_size: list
+    :type scales: list
+    :type mini_batch_size: int
+    :type flip: bool
+    :return: The round's placeholders, the op filling the buffer and the op writing a batch
+    :rtype: dict
+    """
+    with graph.as_default():
+        fill_input_buffer = graph.get_operation_by_name('fill_input_buffer')
+        input_vars = {v.name: v for v in tf.global_variables() if v.name in ['images:0', 'labels:0']}
+        if fill_input_buffer.type == 'QueueEnqueueV2':
+            # The queue's components, in the order fill_input_buffer enqueues them
+            components = [t.op.name for t in fill_input_buffer.inputs[1:]]
+            assert sorted(components) == ['features_input', 'labels_input'], \
+                'Unknown components %s of the student\'s input queue' % components
+        else:
+            assert len(input_vars) == 2, 'The student is fed neither by a queue nor by images and labels variables, ' \
+                                         'it can not be augmented on the device'
+        with tf.name_scope('device_input'):
+            frames_input = tf.placeholder(tf.uint8, shape=[None, None, None, 3], name='round_frames_input')
+            labels_input = tf.placeholder(tf.uint8, shape=[None, None, None], name='round_labels_input')
+            # In no collection, so they are neither saved nor initialized with the model: every round fills them first
+            round_frames = tf.Variable(tf.zeros([1, 1, 1, 3], dtype=tf.uint8), trainable=False, validate_shape=False,
+                                       collections=[], name='round_frames')
+            round_labels = tf.Variable(tf.zeros([1, 1, 1], dtype=tf.uint8), trainable=False, validate_shape=False,
+                                       collections=[], name='round_labels')
+            fill_round_buffer = tf.group(tf.assign(round_frames, frames_input, validate_shape=False),
+                                         tf.assign(round_labels, labels_input, validate_shape=False))
+
+            frames_shape = tf.shape(round_frames)
+            indices = tf.random.uniform([mini_batch_size], maxval=frames_shape[0], dtype=tf.int32)
+            chosen_scales = tf.gather(tf.constant(scales, dtype=tf.float64),
+                                      tf.random.uniform([mini_batch_size], maxval=len(scales), dtype=tf.int32))
+            # In float64 so the sizes are truncated like int() truncates them in mini_batch
+            actual_scales = chosen_scales * crop_size[1] / tf.cast(frames_shape[2], tf.float64)
+
+            def augment(sample):
+                index, actual_scale = sample
+                frame = tf.cast(tf.gather(round_frames, index), tf.float32)
+                label = tf.cast(tf.gather(round_labels, index), tf.float32)
+                size = tf.cast(tf.cast(frames_shape[1:3], tf.float64) * actual_scale, tf.int32)
+                # Pixel centers as cv2.INTER_LINEAR and cv2.INTER_NEAREST place them
+                frame = tf.image.resize_bilinear(frame[None], size, half_pixel_centers=True)[0]
+                label = tf.image.resize_nearest_neighbor(label[None, :, :, None], size)[0]
+                crop = tf.image.random_crop(tf.concat([frame, label], axis=-1), [crop_size[0], crop_size[1], 4])
+                if flip:
+                    crop = tf.image.random_flip_left_right(crop)
+                return crop
+
+            crops = tf.map_fn(augment, (indices, actual_scales), dtype=tf.float32)
+            batch = {'features_input': crops[:, :, :, :3], 'labels_input': crops[:, :, :, 3]}
+            if fill_input_buffer.type == 'QueueEnqueueV2':
+                augment_step = gen_data_flow_ops.queue_enqueue_v2(
+                    fill_input_buffer.inputs[0],
+                    [tf.cast(batch[name], t.dtype) for name, t in zip(components, fill_input_buffer.inputs[1:])])
+            else:
+                images, labels = input_vars['images:0'], input_vars['labels:0']
+                augment_step = tf.group(
+                    tf.assign(images, tf.cast(batch['features_input'], images.dtype.base_dtype), validate_shape=False),
+                    tf.assign(labels, tf.cast(batch['labels_input'], labels.dtype.base_dtype), validate_shape=False))
+    return {'frames_input': frames_input,
+            'labels_input': labels_input,
+            'fill_round_buffer': fill_round_buffer,
+            'augment_step': augment_step}
+
 
 def create_student_v3_test():
     meta_dir = '/data4/ModelStreaming/clean/models_inventory/mnv2_decay0.9_drop0.1/model'
     class_weights = np.array([1]*19)
     create_student_v3(meta_dir, class_weights=class_weights, threshold=None, map_misc=0, test_mode=False,
                       train_biases_only=False, regularize=False, soft_teacher=False, masked_gradients=True)
+    student_graph_report(meta_dir, class_weights=class_weights, masked_gradients=True)
+
+
+def student_graph_report(meta_dir, **kwargs):
+    """
+    Builds the student with and without lean and compares their build time and GraphDef size. Both are exported like
+    SemanticNetwork.get_frozen_graph, to check that lean keeps every op the export needs.
+
+    :param meta_dir: The student checkpoint
+    :param kwargs: The other arguments of create_student_v3
+    :type meta_dir: str
+    :return: Build time in seconds, GraphDef size in bytes, number of nodes and frozen GraphDef size in bytes, for the
+    full and the lean student
+    :rtype: dict
+    """
+    import time
+    report = {}
+    for lean in [False, True]:
+        t1 = time.time()
+        student = create_student_v3(meta_dir, lean=lean, **kwargs)
+        build_time = time.time() - t1
+        graph_def = student['graph'].as_graph_def()
+        with student['graph'].as_default():
+            init = tf.initializers.global_variables()
+        with tf.Session(graph=student['graph']) as sess:
+            sess.run(init)
+            frozen_graph_def = trim_graph_frozen(sess, sess.graph_def, ["features"],
+                                                 [student["prepend"] + "predictions"], kill_norms=True)
+        report['lean' if lean else 'full'] = {'build_s': build_time, 'graph_def_bytes': graph_def.ByteSize(),
+                                              'nodes': len(graph_def.node),
+                                              'frozen_bytes': frozen_graph_def.ByteSize()}
+    for name in ['full', 'lean']:
+        print('%s student: built in %.2f s, GraphDef of %.1f MB with %d nodes, frozen to %.1f MB' %
+              (name, report[name]['build_s'], report[name]['graph_def_bytes'] / 2 ** 20, report[name]['nodes'],
+               report[name]['frozen_bytes'] / 2 ** 20))
+    return report
+
 
 def create_student_v3(meta_dir, class_weights=None, threshold=None, map_misc=0, test_mode=False,
-                      train_biases_only=False, regularize=False, soft_teacher=False, masked_gradients=False):
+                      train_biases_only=False, regularize=False, soft_teacher=False, masked_gradients=False,
+                      lean=False):
+    # With lean, only the ops the training, prediction, metric and export fetches reach are built: the checkpoint is not
+    # embedded by the unused drift loss, and the per-class selective loss, probability outputs and Saver are left out.
+    # Their entries in the returned dict are None. The batch norm patches are kept, convert_batchnorms swaps them in
+    # when the student is exported
     if class_weights is not None:
         class_weights = np.where(class_weights == 1)[0]
     student_graph = None
@@ -356,9 +561,13 @@ def create_student_v3(meta_dir, class_weights=None, threshold=None, map_misc=0,
         fill_input_buffer = tf.get_default_graph().get_operation_by_name('fill_input_buffer')
         features = tf.get_default_graph().get_tensor_by_name('features:0')
         labels = tf.get_default_graph().get_tensor_by_name('labels:0')
-        teacher_labels_logits_pl = tf.placeholder(shape=[None, None, None, None], dtype=tf.float32)
-        student_probs = tf.nn.softmax(student_logits, axis=-1)
-        student_probs = tf.reduce_max(student_probs, axis=-1)
+        teacher_labels_logits_pl = None
+        if not lean or soft_teacher:
+            teacher_labels_logits_pl = tf.placeholder(shape=[None, None, None, None], dtype=tf.float32)
+        student_probs = None
+        if not lean:
+            student_probs = tf.nn.softmax(student_logits, axis=-1)
+            student_probs = tf.reduce_max(student_probs, axis=-1)
         # Create new BN ops
         nodes = student_graph.as_graph_def().node
         for n in nodes:
@@ -372,8 +581,9 @@ def create_student_v3(meta_dir, class_weights=None, threshold=None, map_misc=0,
         if class_weights is not None:
             filtered_logits = tf.gather(student_logits, class_weights, axis=-1)
             filtered_logits = tf.identity(filtered_logits, "logits_reduced")
-            filtered_teacher_labels_logits = tf.gather(teacher_labels_logits_pl, class_weights, axis=-1) 
-            filtered_teacher_labels_probs = tf.nn.softmax(filtered_teacher_labels_logits, axis=-1)
+            if teacher_labels_logits_pl is not None:
+                filtered_teacher_labels_logits = tf.gather(teacher_labels_logits_pl, class_weights, axis=-1)
+                filtered_teacher_labels_probs = tf.nn.softmax(filtered_teacher_labels_logits, axis=-1)
 
 
             ################
@@ -385,16 +595,14 @@ def create_student_v3(meta_dir, class_weights=None, threshold=None, map_misc=0,
 #            filtered_logits = tf.compat.v1.layers.conv2d(filtered_logits, 128, [3,3], padding='same', name='extra2', activation=tf.nn.relu)
 #            filtered_logits = tf.compat.v1.layers.conv2d(filtered_logits, out_degree, [3,3], padding='same', name='extra3')
             ######
-            filtered_probs = tf.nn.softmax(filtered_logits, axis=-1)
-            filtered_probs = tf.reduce_max(filtered_probs, axis=-1)
+            filtered_probs = None
+            if not lean:
+                filtered_probs = tf.nn.softmax(filtered_logits, axis=-1)
+                filtered_probs = tf.reduce_max(filtered_probs, axis=-1)
             filtered_predictions = tf.argmax(filtered_logits, axis=-1, output_type=tf.int32)
             filtered_predictions = tf.identity(filtered_predictions, str_prepend + 'predictions')
-            labels_onehot = tf.one_hot(tf.cast(labels, tf.int32), NUM_CLASSES, axis=-1)
-            filtered_labels_onehot = tf.gather(labels_onehot, class_weights, axis=-1)
-            filtered_labels = tf.argmax(filtered_labels_onehot, axis=-1)
+            filtered_labels, weights = reduce_labels(labels, class_weights, NUM_CLASSES)
             # soft_update, soft_miou, soft_reset = prob_confmat(filtered_labels, filtered_teacher_labels_probs, len(class_weights))
-            # set weight to zero if all elements in the last dimension are zero
-            weights = tf.reduce_sum(filtered_labels_onehot, axis=-1)
             mean_iou, update_op = tf.metrics.mean_iou(
                 labels=tf.reshape(filtered_labels, [-1, 1]),
                 predictions=tf.reshape(filtered_predictions, [-1, 1]),
@@ -403,11 +611,13 @@ def create_student_v3(meta_dir, class_weights=None, threshold=None, map_misc=0,
             if soft_teacher:
                 pixel_loss = tf.nn.softmax_cross_entropy_with_logits(logits=filtered_logits, labels=filtered_teacher_labels_probs)
             else:
-                pixel_loss = tf.nn.softmax_cross_entropy_with_logits(logits=filtered_logits, labels=filtered_labels_onehot)
+                # Pixels outside of the class subset get a valid dummy label here but are masked out below
+                pixel_loss = tf.nn.sparse_softmax_cross_entropy_with_logits(logits=filtered_logits,
+                                                                            labels=filtered_labels)
             weights = tf.cast(weights, tf.bool)
             loss = tf.reduce_mean(tf.boolean_mask(pixel_loss, weights))
             loss_sum = None
-            for i in range(len(class_weights)):
+            for i in range(len(class_weights) if not lean else 0):
                 weights_choice = tf.equal(filtered_labels, i)
                 weights_choice = tf.logical_or(weights_choice, tf.equal(filtered_predictions, tf.cast(i, tf.int32)))
                 loss_selective = tf.reduce_mean(tf.boolean_mask(pixel_loss, tf.logical_and(weights, weights_choice)))
@@ -415,7 +625,7 @@ def create_student_v3(meta_dir, class_weights=None, threshold=None, map_misc=0,
                     loss_sum = loss_selective
                 else:
                     loss_sum = loss_sum + loss_selective
-            loss_selective = tf.reduce_mean(loss_sum)
+            loss_selective = tf.reduce_mean(loss_sum) if loss_sum is not None else None
 
         tvars = tf.trainable_variables()
         entire_model_vars = [var for var in tvars if not 'image_cache' in var.name and not 'patch' in var.name]
@@ -433,10 +643,11 @@ def create_student_v3(meta_dir, class_weights=None, threshold=None, map_misc=0,
         #tvars = [var for var in tvars if not 'weights' in var.name]
         #tvars = [var for var in tvars if 'weights' in var.name]
         #tvars = [var for var in tvars if 'extra' in var.name]
-        chk = np.load('%s.npy'%meta_dir, allow_pickle=True).item()
-        drift_loss = 0.
-        for v in tvars:
-            drift_loss = drift_loss + tf.reduce_sum(tf.square(chk[v.name] - v))
+        if not lean:
+            chk = load_checkpoint(meta_dir)
+            drift_loss = 0.
+            for v in tvars:
+                drift_loss = drift_loss + tf.reduce_sum(tf.square(chk[v.name] - v))
 
         #loss = loss + 0.01 * drift_loss
         #print('Training:', tvars)
@@ -495,7 +706,8 @@ def create_student_v3(meta_dir, class_weights=None, threshold=None, map_misc=0,
                 with tf.control_dependencies(update_bn):
                     train = optimizer.minimize(loss)
             # train_selective = tf.train.AdamOptimizer(learning_rate).minimize(loss_selective, var_list=tvars)
-        student_saver = tf.train.Saver()
+        if not lean:
+            student_saver = tf.train.Saver()
     student = {'graph': student_graph,
                'features_input': features_input,
                'labels_input': labels_input,
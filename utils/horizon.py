@@ -0,0 +1,158 @@
+import time
+
+import numpy as np
+
+from ams.utils.metrics import miou_from_confusion
+from ams.utils.utils import calculate_miou
+
+
+def _prefix_sum(series):
+    # Prepends a zero so the sum of [start, end) is prefix[end] - prefix[start]. NaNs count as zeros here, so a NaN
+    # frame does not spill into every later window, _prefix_nans tells which windows hold one
+    series = np.asarray(series, dtype=np.float64)
+    prefix = np.empty((series.shape[0] + 1,) + series.shape[1:], dtype=np.float64)
+    prefix[0] = 0
+    np.nancumsum(series, axis=0, out=prefix[1:])
+    return prefix
+
+
+def _prefix_nans(series):
+    # Number of NaN values in the first i frames
+    nans = np.isnan(np.asarray(series, dtype=np.float64))
+    prefix = np.zeros(nans.shape[0] + 1, dtype=np.int64)
+    np.cumsum(nans, out=prefix[1:])
+    return prefix
+
+
+class HorizonIndex(object):
+    """
+    Cumulative sums over the per-frame outputs of one inference run (confusion matrices, mIoUs and mIoU memories), built
+    once so that the sum or mean over any window of frames [start, end) takes O(1). Window arguments can be arrays, to
+    evaluate many windows in one vectorized pass.
+    """
+
+    def __init__(self, confmats=None, mious=None, miou_mems=None):
+        """
+        :param confmats: Per-frame confusion matrices, [frames, classes, classes]. At least one of the three series must
+        be given
+        :param mious: Per-frame mIoUs
+        :param miou_mems: Per-frame mIoUs of the confusion matrices of the last 10 seconds
+        :type confmats: np.ndarray
+        :type mious: np.ndarray
+        :type miou_mems: np.ndarray
+        """
+        given = [series for series in [confmats, mious, miou_mems] if series is not None]
+        assert len(given) > 0, 'No series to index'
+        self.length = len(given[0])
+        if confmats is not None:
+            assert len(confmats) == self.length, 'All series of a run must have one value per frame'
+        self.conf_prefix = _prefix_sum(confmats) if confmats is not None else None
+        self.series_prefix = {}
+        self.series_nans = {}
+        for name, series in [('mious', mious), ('miou_mems', miou_mems)]:
+            if series is not None:
+                assert len(series) == self.length, 'All series of a run must have one value per frame'
+                self.series_prefix[name] = _prefix_sum(series)
+                self.series_nans[name] = _prefix_nans(series)
+
+    def _check(self, start, end):
+        start, end = np.asarray(start), np.asarray(end)
+        assert np.all(0 <= start) and np.all(start <= end) and np.all(end <= self.length), \
+            'Window out of the range of the run'
+        return start, end
+
+    def confusion_sum(self, start, end):
+        """
+        :return: The sum of the confusion matrices of the frames in [start, end), one per window
+        :rtype: np.ndarray
+        """
+        start, end = self._check(start, end)
+        return self.conf_prefix[end] - self.conf_prefix[start]
+
+    def confusion_miou(self, start, end):
+        """
+        :return: The mIoU of the summed confusion matrices, same as np.nanmean(calculate_miou(sum, nan=True))
+        :rtype: float or np.ndarray
+        """
+        return miou_from_confusion(self.confusion_sum(start, end))
+
+    def mean(self, name, start, end):
+        """
+        :param name: mious or miou_mems
+        :return: The mean of the series over [start, end), NaN for windows with a NaN frame like np.mean
+        :rtype: float or np.ndarray
+        """
+        start, end = self._check(start, end)
+        prefix = self.series_prefix[name]
+        nans = self.series_nans[name]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(nans[end] - nans[start] > 0, np.nan, (prefix[end] - prefix[start]) / (end - start))[()]
+
+
+def horizon_diffs(pretrained, trained, t, k2s, fps):
+    """
+    Compares a trained run starting at time t with the pretrained run over the same windows, for all inference
+    horizons at once.
+
+    :param pretrained: Index of the pretrained run over the whole video
+    :param trained: Index of the trained run, whose first frame is at time t
+    :param t: Start of the windows in the pretrained run, in seconds
+    :param k2s: The inference horizons, in seconds
+    :param fps: Frame rate of the video
+    :type pretrained: HorizonIndex
+    :type trained: HorizonIndex
+    :type t: int
+    :type k2s: list of int
+    :type fps: int
+    :return: The differences of the confusion matrix-based mIoUs, average mIoUs and average mIoU memories, one per k2
+    :rtype: (np.ndarray, np.ndarray, np.ndarray)
+    """
+    lengths = np.asarray(k2s) * fps
+    starts = np.full_like(lengths, t * fps)
+    zeros = np.zeros_like(lengths)
+    diff_conf = trained.confusion_miou(zeros, lengths) - pretrained.confusion_miou(starts, starts + lengths)
+    diff_avg = trained.mean('mious', zeros, lengths) - pretrained.mean('mious', starts, starts + lengths)
+    diff_mem = trained.mean('miou_mems', zeros, lengths) - pretrained.mean('miou_mems', starts, starts + lengths)
+    return diff_conf, diff_avg, diff_mem
+
+
+def horizon_index_test():
+    num_classes = 6
+    fps = 30
+    frames = 300 * fps
+    confmats = np.random.randint(0, 50, size=(frames, num_classes, num_classes)).astype(np.float64)
+    confmats[:, 3, :] = 0
+    confmats[:, :, 3] = 0
+    mious = np.random.random(frames)
+    miou_mems = np.random.random(frames)
+    # Frames without any labeled class have a NaN mIoU, which makes every window holding one NaN
+    mious[200 * fps] = np.nan
+    miou_mems[:fps] = np.nan
+    ts = [10, 50, 120]
+    k2s = [4, 16, 64, 128]
+    trained = [(confmats[t * fps:], mious[t * fps:], miou_mems[t * fps:]) for t in ts]
+    t1 = time.time()
+    reference = []
+    for t, (trained_conf_mats, trained_mious, trained_miou_mems) in zip(ts, trained):
+        for k2 in k2s:
+            pretrained_conf_miou = np.nanmean(calculate_miou(np.sum(confmats[t * fps:(t + k2) * fps], axis=0),
+                                                             nan=True))
+            trained_conf_miou = np.nanmean(calculate_miou(np.sum(trained_conf_mats[:k2 * fps], axis=0), nan=True))
+            reference.append([trained_conf_miou - pretrained_conf_miou,
+                              np.mean(trained_mious[:k2 * fps]) - np.mean(mious[t * fps:(t + k2) * fps]),
+                              np.mean(trained_miou_mems[:k2 * fps]) - np.mean(miou_mems[t * fps:(t + k2) * fps])])
+    t2 = time.time()
+    pretrained = HorizonIndex(confmats, mious, miou_mems)
+    indexed = []
+    for t, run in zip(ts, trained):
+        indexed.extend(np.stack(horizon_diffs(pretrained, HorizonIndex(*run), t, k2s, fps), axis=1))
+    t3 = time.time()
+    assert np.allclose(np.array(indexed), np.array(reference), equal_nan=True), \
+        'Indexed windows differ from the direct sums'
+    index = HorizonIndex(miou_mems=miou_mems)
+    assert np.isnan(index.mean('miou_mems', 0, fps + 1)) and not np.isnan(index.mean('miou_mems', fps, 2 * fps))
+    print('Direct sums took %.1f ms, indexed windows %.1f ms' % ((t2 - t1) * 1000, (t3 - t2) * 1000))
+
+
+if __name__ == '__main__':
+    horizon_index_test()
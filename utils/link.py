@@ -0,0 +1,103 @@
+import numpy as np
+
+# Links are emulated in virtual time: sending a message returns the time it arrives, so the experiments stay
+# reproducible and run as fast as the training allows.
+
+
+def load_bandwidth_trace(path):
+    """
+    Loads a bandwidth trace, a text file with one "time_in_seconds bandwidth_in_kbps" pair per line. The bandwidth is
+    held constant until the next line, and the last value is kept until the end of the run.
+
+    :param path: Path of the trace
+    :type path: str
+    :return: Start times and bandwidths, in seconds and bits per second
+    :rtype: (np.ndarray, np.ndarray)
+    """
+    trace = np.loadtxt(path, ndmin=2, comments='#')
+    assert trace.shape[1] == 2, 'Each line of the trace must have a time and a bandwidth'
+    order = np.argsort(trace[:, 0], kind='stable')
+    times, bandwidths = trace[order, 0], trace[order, 1] * 1024
+    assert times[0] <= 0, 'The trace must start at time 0'
+    assert np.all(bandwidths >= 0)
+    return times, bandwidths
+
+
+class Link(object):
+    """
+    One direction of a link, emulated as a first-in first-out token bucket drained at the link's bandwidth. Messages
+    are split into MTU-sized packets, lost packets are retransmitted after a timeout, and each message arrives half an
+    RTT (plus jitter) after its last packet leaves.
+    """
+    MTU = 1500 * 8
+
+    def __init__(self, bandwidth_kbps, rtt_ms=0., jitter_ms=0., loss=0., trace=None, seed=None):
+        """
+        :param bandwidth_kbps: Bandwidth of the link, ignored when a trace is given
+        :param rtt_ms: Round trip time
+        :param jitter_ms: Standard deviation of the one-way delay
+        :param loss: Packet loss probability
+        :param trace: Path of a bandwidth trace, see load_bandwidth_trace
+        :param seed: Seed of the jitter and loss
+        :type bandwidth_kbps: float
+        :type rtt_ms: float
+        :type jitter_ms: float
+        :type loss: float
+        :type trace: str
+        :type seed: int
+        """
+        assert 0 <= loss < 1, 'Loss probability must be in [0, 1)'
+        if trace is not None:
+            self.times, self.bandwidths = load_bandwidth_trace(trace)
+        else:
+            assert bandwidth_kbps > 0, 'Bandwidth must be positive'
+            self.times, self.bandwidths = np.zeros(1), np.array([bandwidth_kbps * 1024.])
+        # Bits the link could have carried by the start of each trace segment
+        self.cumulative = np.concatenate([[0.], np.cumsum(np.diff(self.times) * self.bandwidths[:-1])])
+        assert self.bandwidths[-1] > 0, 'The last bandwidth of the trace must be positive'
+        self.delay = rtt_ms / 2000.
+        self.jitter = jitter_ms / 1000.
+        self.rto = max(2 * rtt_ms / 1000., 0.2)
+        self.loss = loss
+        self.random = np.random.RandomState(seed)
+        self.free_at = 0.
+        self.last_arrival = 0.
+        # Rows of (send time, size in bits, arrival time)
+        self.log = []
+
+    def _capacity(self, t):
+        # Bits the link could have carried from time 0 to t
+        segment = max(np.searchsorted(self.times, t, side='right') - 1, 0)
+        return self.cumulative[segment] + (t - self.times[segment]) * self.bandwidths[segment]
+
+    def _drain_time(self, start, bits):
+        # Time when the link, starting at start, has carried bits more
+        target = self._capacity(start) + bits
+        segment = max(np.searchsorted(self.cumulative, target, side='right') - 1, 0)
+        while self.bandwidths[segment] == 0:
+            segment += 1
+        return max(self.times[segment] + (target - self.cumulative[segment]) / self.bandwidths[segment], start)
+
+    def send(self, size_bits, time_send):
+        """
+        :param size_bits: Size of the message
+        :param time_send: Time the message is handed to the link, in seconds
+        :type size_bits: float
+        :type time_send: float
+        :return: Time the whole message is received, in seconds
+        :rtype: float
+        """
+        packets = max(int(np.ceil(size_bits / self.MTU)), 1)
+        lost = 0
+        if self.loss > 0:
+            # Each transmission of a packet is lost with probability loss, so retransmissions are geometric
+            lost = int(np.sum(self.random.geometric(1 - self.loss, size=packets) - 1))
+        start = max(time_send, self.free_at)
+        self.free_at = self._drain_time(start, size_bits + lost * min(self.MTU, size_bits))
+        jitter = abs(self.random.normal(0, self.jitter)) if self.jitter > 0 else 0.
+        # A loss at the end of the message costs a timeout before the retransmission, messages arrive in order
+        arrival = self.free_at + self.delay + jitter + (self.rto if lost > 0 else 0.)
+        arrival = max(arrival, self.last_arrival)
+        self.last_arrival = arrival
+        self.log.append((time_send, size_bits, arrival))
+        return arrival
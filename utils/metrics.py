@@ -0,0 +1,251 @@
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from ams.utils.utils import calculate_miou
+
+# Confusion matrices follow tf.metrics.mean_iou: rows are labels and columns are predictions
+
+
+def label_lookup(class_indices, total_classes):
+    """
+    Builds the lookup tables that map full-set labels to indices in the class subset.
+
+    :param class_indices: Indices of the classes in the subset
+    :param total_classes: Number of classes in the full label set
+    :type class_indices: np.ndarray or list
+    :type total_classes: int
+    :return: An int32 table of reduced labels and a boolean validity table, both with an extra last entry for the
+    out-of-range labels
+    :rtype: (np.ndarray, np.ndarray)
+    """
+    lut = np.zeros(total_classes + 1, dtype=np.int32)
+    lut[class_indices] = np.arange(len(class_indices), dtype=np.int32)
+    valid = np.zeros(total_classes + 1, dtype=bool)
+    valid[class_indices] = True
+    return lut, valid
+
+
+def reduce_labels(labels, lut, valid):
+    """
+    Host-side counterpart of graph_utils.reduce_labels.
+
+    :param labels: Full-set labels of any shape
+    :param lut: Reduced label table from label_lookup
+    :param valid: Validity table from label_lookup
+    :type labels: np.ndarray
+    :type lut: np.ndarray
+    :type valid: np.ndarray
+    :return: Reduced labels and the mask of pixels that belong to the subset
+    :rtype: (np.ndarray, np.ndarray)
+    """
+    total_classes = lut.size - 1
+    labels = np.asarray(labels)
+    if labels.dtype.kind == 'u':
+        labels = np.minimum(labels, total_classes)
+    else:
+        labels = np.where((labels < 0) | (labels > total_classes), total_classes, labels)
+    return lut[labels], valid[labels]
+
+
+def confusion_matrix(labels, predictions, num_classes, weights=None):
+    """
+    Computes the confusion matrix with a single bincount over label * num_classes + prediction.
+
+    :param labels: Ground truth labels in [0, num_classes), any shape
+    :param predictions: Predictions in [0, num_classes), same shape as labels
+    :param num_classes: Number of classes
+    :param weights: Optional per-pixel weights, pixels with zero weight are ignored
+    :type labels: np.ndarray
+    :type predictions: np.ndarray
+    :type num_classes: int
+    :type weights: np.ndarray
+    :return: num_classes x num_classes confusion matrix
+    :rtype: np.ndarray
+    """
+    index = labels.astype(np.int64, copy=False).ravel() * num_classes + predictions.ravel()
+    if weights is None:
+        counts = np.bincount(index, minlength=num_classes * num_classes)
+    elif weights.dtype == bool:
+        counts = np.bincount(index[weights.ravel()], minlength=num_classes * num_classes)
+    else:
+        counts = np.bincount(index, weights=weights.ravel(), minlength=num_classes * num_classes)
+    return counts.reshape(num_classes, num_classes).astype(np.float64)
+
+
+def batch_confusion_matrix(labels, predictions, num_classes, weights=None):
+    """
+    Computes one confusion matrix per element of the first dimension, still with a single bincount.
+
+    :param labels: Ground truth labels of shape [batch, ...]
+    :param predictions: Predictions, same shape as labels
+    :param num_classes: Number of classes
+    :param weights: Optional per-pixel weights, pixels with zero weight are ignored
+    :type labels: np.ndarray
+    :type predictions: np.ndarray
+    :type num_classes: int
+    :type weights: np.ndarray
+    :return: batch x num_classes x num_classes confusion matrices
+    :rtype: np.ndarray
+    """
+    batch = labels.shape[0]
+    area = num_classes * num_classes
+    offsets = np.arange(batch, dtype=np.int64).reshape((batch,) + (1,) * (labels.ndim - 1)) * area
+    index = offsets + labels.astype(np.int64, copy=False) * num_classes + predictions
+    if weights is None:
+        counts = np.bincount(index.ravel(), minlength=batch * area)
+    elif weights.dtype == bool:
+        counts = np.bincount(index[weights], minlength=batch * area)
+    else:
+        counts = np.bincount(index.ravel(), weights=weights.ravel(), minlength=batch * area)
+    return counts.reshape(batch, num_classes, num_classes).astype(np.float64)
+
+
+def iou_from_confusion(conf_matrix):
+    """
+    Vectorized calculate_miou(conf_matrix, nan=True), also works on stacks of confusion matrices.
+
+    :param conf_matrix: Confusion matrix or matrices of shape [..., num_classes, num_classes]
+    :type conf_matrix: np.ndarray
+    :return: Per class IoUs, NaN for classes that are neither present nor predicted
+    :rtype: np.ndarray
+    """
+    tp = np.diagonal(conf_matrix, axis1=-2, axis2=-1)
+    denominator = np.sum(conf_matrix, axis=-1) + np.sum(conf_matrix, axis=-2) - tp
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(denominator == 0, np.nan, tp / np.maximum(denominator, 1))
+
+
+def miou_from_confusion(conf_matrix):
+    """
+    :return: The mean of the per class IoUs ignoring NaNs, NaN if no class is present
+    :rtype: float or np.ndarray
+    """
+    iou = iou_from_confusion(conf_matrix)
+    present = np.sum(~np.isnan(iou), axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(present == 0, np.nan, np.nansum(iou, axis=-1) / np.maximum(present, 1))
+
+
+def cross_miou_series(labels, lut, valid, num_classes, pixel_budget=None, chunk_size=64, seed=None):
+    """
+    Computes the cross mIoU (phi-score) of every consecutive pair of a label sequence in one pass. For pair k, labels[k]
+    is used as ground truth and labels[k + 1] as the prediction, same as SemanticNetwork.calc_cross_miou.
+
+    :param labels: Sequence of N full-set label frames with the same shape
+    :param lut: Reduced label table from label_lookup
+    :param valid: Validity table from label_lookup
+    :param num_classes: Number of classes in the subset
+    :param pixel_budget: If given, the total number of pixels compared over all pairs. The same random pixels are used
+    for every pair
+    :param chunk_size: Number of pairs reduced at once, bounds the memory of the intermediates
+    :param seed: Seed of the pixel subsampling
+    :type labels: list of np.ndarray or np.ndarray
+    :type lut: np.ndarray
+    :type valid: np.ndarray
+    :type num_classes: int
+    :type pixel_budget: int
+    :type chunk_size: int
+    :return: N - 1 cross mIoUs
+    :rtype: np.ndarray
+    """
+    num_pairs = len(labels) - 1
+    if num_pairs < 1:
+        return np.empty(0)
+    pixels = None
+    num_pixels = np.size(labels[0])
+    if pixel_budget is not None and pixel_budget // num_pairs < num_pixels:
+        rng = np.random.RandomState(seed)
+        pixels = np.sort(rng.choice(num_pixels, max(1, pixel_budget // num_pairs), replace=False))
+    mious = np.empty(num_pairs)
+    for start in range(0, num_pairs, chunk_size):
+        end = min(start + chunk_size, num_pairs)
+        chunk = np.stack([np.ravel(labels[k]) for k in range(start, end + 1)])
+        if pixels is not None:
+            chunk = chunk[:, pixels]
+        reduced, weights = reduce_labels(chunk, lut, valid)
+        conf = batch_confusion_matrix(reduced[:-1], reduced[1:], num_classes,
+                                      np.logical_and(weights[:-1], weights[1:]))
+        mious[start:end] = miou_from_confusion(conf)
+    return mious
+
+
+def confusion_matrix_op(labels, predictions, num_classes, weights=None):
+    """
+    Stateless graph version of confusion_matrix, the result does not need to be reset between frames.
+
+    :param labels: Integer label tensor
+    :param predictions: Integer prediction tensor, same shape as labels
+    :param num_classes: Number of classes
+    :param weights: Optional weight tensor, same shape as labels
+    :return: float64 num_classes x num_classes confusion matrix tensor
+    """
+    index = tf.reshape(tf.cast(labels, tf.int32) * num_classes + tf.cast(predictions, tf.int32), [-1])
+    if weights is None:
+        weights = tf.ones_like(index, dtype=tf.float64)
+    else:
+        weights = tf.reshape(tf.cast(weights, tf.float64), [-1])
+    counts = tf.unsorted_segment_sum(weights, index, num_classes * num_classes)
+    return tf.reshape(counts, [num_classes, num_classes])
+
+
+def cross_miou_series_test():
+    total_classes = 19
+    class_indices = np.array([0, 2, 8, 10, 11, 13])
+    lut, valid = label_lookup(class_indices, total_classes)
+    labels = np.random.randint(0, total_classes, size=(150, 64, 128)).astype(np.uint8)
+    t1 = time.time()
+    reference = []
+    for k in range(len(labels) - 1):
+        before, weights_before = reduce_labels(labels[k], lut, valid)
+        after, weights_after = reduce_labels(labels[k + 1], lut, valid)
+        conf = confusion_matrix(before, after, len(class_indices), np.logical_and(weights_before, weights_after))
+        reference.append(np.nanmean(calculate_miou(conf, nan=True)))
+    t2 = time.time()
+    series = cross_miou_series(labels, lut, valid, len(class_indices), chunk_size=16)
+    t3 = time.time()
+    assert np.allclose(series, reference, equal_nan=True), 'Vectorized phi-scores differ from the pairwise ones'
+    sampled = cross_miou_series(labels, lut, valid, len(class_indices), pixel_budget=100000, seed=0)
+    print('Pairwise took %.1f ms, vectorized %.1f ms, max error of the sampled series %.4f'
+          % ((t2 - t1) * 1000, (t3 - t2) * 1000, np.max(np.abs(sampled - series))))
+
+
+def confusion_matrix_test():
+    num_classes = 6
+    shape = [4, 64, 128]
+    graph = tf.Graph()
+    with graph.as_default():
+        labels_pl = tf.placeholder(tf.int32, shape)
+        predictions_pl = tf.placeholder(tf.int32, shape)
+        weights_pl = tf.placeholder(tf.float32, shape)
+        _, update_op = tf.metrics.mean_iou(labels=labels_pl, predictions=predictions_pl, num_classes=num_classes,
+                                           weights=weights_pl)
+        conf_op = confusion_matrix_op(labels_pl, predictions_pl, num_classes, weights_pl)
+        reset = tf.initializers.local_variables()
+    with tf.Session(graph=graph) as sess:
+        for i in range(3):
+            labels = np.random.randint(0, num_classes, size=shape)
+            predictions = np.random.randint(0, num_classes, size=shape)
+            weights = np.random.random(shape) > 0.3
+            feed_dict = {labels_pl: labels, predictions_pl: predictions, weights_pl: weights}
+            sess.run(reset)
+            t1 = time.time()
+            conf_tf = sess.run(update_op, feed_dict=feed_dict)
+            t2 = time.time()
+            conf_np = confusion_matrix(labels, predictions, num_classes, weights)
+            t3 = time.time()
+            conf_graph = sess.run(conf_op, feed_dict=feed_dict)
+            conf_batch = batch_confusion_matrix(labels, predictions, num_classes, weights)
+            assert np.array_equal(conf_tf, conf_np), 'Host-side confusion matrix differs from tf.metrics.mean_iou'
+            assert np.array_equal(conf_tf, conf_graph), 'Graph confusion matrix differs from tf.metrics.mean_iou'
+            assert np.array_equal(conf_tf, np.sum(conf_batch, axis=0)), 'Batched confusion matrices differ'
+            iou_ref = np.array(calculate_miou(conf_tf, nan=True))
+            assert np.allclose(iou_from_confusion(conf_np), iou_ref, equal_nan=True)
+            print('Iteration %d: identical confusion matrices, tf.metrics took %.2f ms and bincount %.2f ms'
+                  % (i, (t2 - t1) * 1000, (t3 - t2) * 1000))
+
+
+if __name__ == '__main__':
+    confusion_matrix_test()
+    cross_miou_series_test()
@@ -0,0 +1,341 @@
+import os
+import zlib
+import resource
+import threading
+from collections import deque, OrderedDict
+
+import numpy as np
+
+# The server's replay memory keeps the newest samples uncompressed in RAM up to a byte budget. Older samples spill to a
+# second tier, either a memory-mapped ring file on disk (the kernel keeps only the pages in use resident) or zlib
+# compressed buffers in RAM. Samples past maxlen are dropped from the cold end, like a bounded deque.
+SPILL_MODES = ['memmap', 'zlib', 'none']
+ZLIB_LEVEL = 1
+
+
+def rss_bytes():
+    """
+    :return: The resident set size of this process, from /proc/self/statm or else the peak from getrusage
+    :rtype: int
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class _MemoryView(object):
+    # Sequence over one component (0 for frames, 1 for labels) of the samples, what mini_batch and the ASR index into
+    def __init__(self, memory, component):
+        self.memory = memory
+        self.component = component
+
+    def __len__(self):
+        return len(self.memory)
+
+    def __getitem__(self, index):
+        return self.memory.get_part(index, self.component)
+
+    @property
+    def pyramid(self):
+        return self.memory.pyramid
+
+
+class ScalePyramid(object):
+    """
+    Scaled copies of the samples of a ReplayMemory. mini_batch resizes a sample the first time it picks it at a scale
+    other than 1 and stores the result here, later picks reuse it until the sample leaves the memory. Over the byte cap,
+    the least recently used copies are evicted first.
+    """
+
+    def __init__(self, budget_bytes=0):
+        """
+        :param budget_bytes: Bytes of scaled samples kept, 0 for no cap
+        :type budget_bytes: int
+        """
+        self.budget_bytes = budget_bytes
+        self.memory = None
+        # (sample id, scale, width of the crop) -> (image, label, seconds the resize took)
+        self.entries = OrderedDict()
+        self.keys_of_sample = {}
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.resize_time = 0.
+        self.saved_time = 0.
+
+    def lookup(self, index, scale, width):
+        """
+        :param index: Index of the sample in the memory
+        :param scale: The scale mini_batch picked
+        :param width: Width of the crops, the scaled sizes depend on it
+        :type index: int
+        :type scale: float
+        :type width: int
+        :return: The scaled image and label, None if they are not cached
+        :rtype: (np.ndarray, np.ndarray)
+        """
+        key = (self.memory.sample_id(index), scale, width)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            self.saved_time += entry[2]
+            return entry[0], entry[1]
+
+    def store(self, index, scale, width, image, label, resize_time):
+        key = (self.memory.sample_id(index), scale, width)
+        nbytes = image.nbytes + label.nbytes
+        with self.lock:
+            self.resize_time += resize_time
+            if key in self.entries or 0 < self.budget_bytes < nbytes:
+                return
+            self.entries[key] = (image, label, resize_time)
+            self.keys_of_sample.setdefault(key[0], set()).add(key)
+            self.bytes += nbytes
+            while 0 < self.budget_bytes < self.bytes:
+                self._remove(next(iter(self.entries)))
+
+    def _remove(self, key):
+        image, label, _ = self.entries.pop(key)
+        self.bytes -= image.nbytes + label.nbytes
+        self.keys_of_sample[key[0]].discard(key)
+        if len(self.keys_of_sample[key[0]]) == 0:
+            del self.keys_of_sample[key[0]]
+
+    def evict_sample(self, sample_id):
+        with self.lock:
+            for key in list(self.keys_of_sample.get(sample_id, [])):
+                self._remove(key)
+
+    def round_stats(self):
+        """
+        :return: Hits, misses, the time spent resizing and the time the hits saved since the last call, and the bytes
+                 cached
+        :rtype: dict
+        """
+        with self.lock:
+            stats = {'hits': self.hits, 'misses': self.misses, 'resize_time': self.resize_time,
+                     'saved_time': self.saved_time, 'bytes': self.bytes, 'entries': len(self.entries)}
+            self.hits = 0
+            self.misses = 0
+            self.resize_time = 0.
+            self.saved_time = 0.
+        return stats
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.keys_of_sample.clear()
+            self.bytes = 0
+
+
+class ReplayMemory(object):
+    """
+    A bounded memory of (frame, label) samples with an explicit budget for the uncompressed, in-RAM samples. The
+    frames and labels views can be passed to SemanticNetwork.train_with_deque in place of the two deques.
+    """
+
+    def __init__(self, maxlen, budget_bytes=0, spill='memmap', spill_path=None, pyramid=None):
+        """
+        :param maxlen: Maximum number of samples kept
+        :param budget_bytes: Bytes of uncompressed samples kept in RAM, 0 for no budget
+        :param spill: Where samples over the budget go: memmap, zlib or none to drop them
+        :param spill_path: Path prefix of the ring files, needed by memmap
+        :param pyramid: Cache of the scaled samples, evicted with them
+        :type maxlen: int
+        :type budget_bytes: int
+        :type spill: str
+        :type spill_path: str
+        :type pyramid: ScalePyramid
+        """
+        assert spill in SPILL_MODES, 'Unknown spill mode %s' % spill
+        assert spill != 'memmap' or spill_path is not None, 'memmap spilling needs a path'
+        assert maxlen > 0, 'Replay memory must hold at least one sample'
+        self.maxlen = maxlen
+        self.budget_bytes = budget_bytes
+        self.spill = spill
+        self.spill_path = spill_path
+        # Samples are ordered oldest first: all the cold ones, then all the hot ones
+        self.hot = deque()
+        self.cold = deque()
+        self.hot_bytes = 0
+        self.cold_bytes = 0
+        self.ring = None
+        self.free_slots = []
+        # Samples are numbered in the order they are appended, the oldest one has number next_id - len(self)
+        self.next_id = 0
+        self.pyramid = pyramid
+        if pyramid is not None:
+            pyramid.memory = self
+        self.frames = _MemoryView(self, 0)
+        self.labels = _MemoryView(self, 1)
+
+    def __len__(self):
+        return len(self.cold) + len(self.hot)
+
+    def sample_id(self, index):
+        """
+        :return: The number of the index-th oldest sample, which does not change while it is in the memory
+        :rtype: int
+        """
+        if index < 0:
+            index += len(self)
+        return self.next_id - len(self) + index
+
+    def get(self, index):
+        """
+        :return: The index-th oldest sample, decompressed or read from the ring file if it was spilled
+        :rtype: (np.ndarray, np.ndarray)
+        """
+        return self.get_part(index, 0), self.get_part(index, 1)
+
+    def get_part(self, index, part):
+        """
+        :param part: 0 for the frame, 1 for the label
+        :type part: int
+        :return: The frame or label of the index-th oldest sample, only that one is decompressed
+        :rtype: np.ndarray
+        """
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('Replay memory index out of range')
+        if index >= len(self.cold):
+            return self.hot[index - len(self.cold)][part]
+        entry = self.cold[index]
+        if self.spill == 'memmap':
+            return self.ring[part][entry]
+        blob, dtype, shape = entry[part]
+        return np.frombuffer(zlib.decompress(blob), dtype=dtype).reshape(shape)
+
+    def append(self, frame, label):
+        if len(self) == self.maxlen:
+            self._drop_oldest()
+        self.hot.append((frame, label))
+        self.next_id += 1
+        self.hot_bytes += frame.nbytes + label.nbytes
+        while self.budget_bytes > 0 and self.hot_bytes > self.budget_bytes and len(self.hot) > 1:
+            self._spill_oldest_hot()
+
+    def extend(self, frames, labels):
+        for frame, label in zip(frames, labels):
+            self.append(frame, label)
+
+    def _drop_oldest(self):
+        if self.pyramid is not None:
+            self.pyramid.evict_sample(self.sample_id(0))
+        if len(self.cold) > 0:
+            entry = self.cold.popleft()
+            if self.spill == 'memmap':
+                self.free_slots.append(entry)
+                self.cold_bytes -= self.ring[0][entry].nbytes + self.ring[1][entry].nbytes
+            else:
+                self.cold_bytes -= sum(len(blob) for blob, _, _ in entry)
+        else:
+            frame, label = self.hot.popleft()
+            self.hot_bytes -= frame.nbytes + label.nbytes
+
+    def _spill_oldest_hot(self):
+        if self.spill == 'none' and self.pyramid is not None:
+            # The oldest hot sample is the oldest sample, as none are spilled
+            self.pyramid.evict_sample(self.sample_id(0))
+        frame, label = self.hot.popleft()
+        self.hot_bytes -= frame.nbytes + label.nbytes
+        if self.spill == 'none':
+            return
+        if self.spill == 'memmap':
+            if self.ring is None:
+                self._open_ring(frame, label)
+            slot = self.free_slots.pop()
+            self.ring[0][slot] = frame
+            self.ring[1][slot] = label
+            self.cold.append(slot)
+            self.cold_bytes += frame.nbytes + label.nbytes
+        else:
+            entry = tuple((zlib.compress(np.ascontiguousarray(array).tobytes(), ZLIB_LEVEL), array.dtype, array.shape)
+                          for array in (frame, label))
+            self.cold.append(entry)
+            self.cold_bytes += sum(len(blob) for blob, _, _ in entry)
+
+    def _open_ring(self, frame, label):
+        # One slot per sample the memory can hold, all samples have the shapes of the first one spilled
+        self.ring = tuple(np.memmap('%s.%s' % (self.spill_path, name), dtype=array.dtype, mode='w+',
+                                    shape=(self.maxlen,) + array.shape)
+                          for name, array in [('frames', frame), ('labels', label)])
+        self.free_slots = list(range(self.maxlen - 1, -1, -1))
+
+    def stats(self):
+        """
+        :return: Number and bytes of the samples in each tier, and the resident set size of the process
+        :rtype: dict
+        """
+        return {'hot': len(self.hot), 'hot_bytes': self.hot_bytes, 'cold': len(self.cold),
+                'cold_bytes': self.cold_bytes, 'rss_bytes': rss_bytes()}
+
+    def clear(self):
+        self.hot.clear()
+        self.cold.clear()
+        self.hot_bytes = 0
+        self.cold_bytes = 0
+        if self.pyramid is not None:
+            self.pyramid.clear()
+        if self.ring is not None:
+            self.ring = None
+            for name in ['frames', 'labels']:
+                os.remove('%s.%s' % (self.spill_path, name))
+        self.free_slots = []
+
+
+def replay_memory_test():
+    maxlen = 50
+    frames = [np.random.randint(0, 256, size=(16, 32, 3), dtype=np.uint8) for _ in range(120)]
+    labels = [np.random.randint(0, 19, size=(16, 32), dtype=np.uint8) for _ in range(120)]
+    sample_bytes = frames[0].nbytes + labels[0].nbytes
+    for spill in SPILL_MODES:
+        memory = ReplayMemory(maxlen, budget_bytes=10 * sample_bytes, spill=spill, spill_path='/tmp/replay_test')
+        reference_frames, reference_labels = deque(maxlen=maxlen), deque(maxlen=maxlen)
+        for k in range(0, 120, 7):
+            memory.extend(frames[k:k + 7], labels[k:k + 7])
+            reference_frames.extend(frames[k:k + 7])
+            reference_labels.extend(labels[k:k + 7])
+            assert memory.hot_bytes <= 10 * sample_bytes
+            if spill == 'none':
+                reference_frames = deque(list(reference_frames)[-10:], maxlen=maxlen)
+                reference_labels = deque(list(reference_labels)[-10:], maxlen=maxlen)
+            assert len(memory) == len(reference_frames)
+            for index in range(len(memory)):
+                assert np.array_equal(memory.frames[index], reference_frames[index])
+                assert np.array_equal(memory.labels[index], reference_labels[index])
+        print(spill, memory.stats())
+        memory.clear()
+
+
+def scale_pyramid_test():
+    frames = [np.random.randint(0, 256, size=(16, 32, 3), dtype=np.uint8) for _ in range(20)]
+    labels = [np.random.randint(0, 19, size=(16, 32), dtype=np.uint8) for _ in range(20)]
+    scaled_bytes = 24 * 48 * 4
+    pyramid = ScalePyramid(budget_bytes=5 * scaled_bytes)
+    memory = ReplayMemory(8, spill='none', pyramid=pyramid)
+    memory.extend(frames[:8], labels[:8])
+    for index in range(8):
+        pyramid.store(index, 1.5, 32, np.zeros((24, 48, 3), dtype=np.uint8), np.zeros((24, 48), dtype=np.uint8), 1.)
+    # Over the cap, the first stored are evicted
+    assert pyramid.bytes == 5 * scaled_bytes and pyramid.lookup(0, 1.5, 32) is None
+    assert pyramid.lookup(7, 1.5, 32) is not None
+    # Samples leaving the memory take their scaled copies with them, the others keep theirs at their new index
+    memory.extend(frames[8:12], labels[8:12])
+    assert pyramid.bytes == 4 * scaled_bytes and pyramid.lookup(3, 1.5, 32) is not None
+    stats = pyramid.round_stats()
+    assert stats['hits'] == 2 and stats['misses'] == 1 and stats['saved_time'] == 2.
+    print(stats)
+
+
+if __name__ == '__main__':
+    replay_memory_test()
+    scale_pyramid_test()
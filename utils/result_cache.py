@@ -0,0 +1,139 @@
+import fcntl
+import glob
+import hashlib
+import json
+import os
+from contextlib import contextmanager
+
+# Runs are keyed by a digest of everything that determines their results: the contents of the input files (video,
+# ground truth labels and checkpoint) and the flags that change the training or inference. File digests are memoized
+# by (size, mtime), so unchanged inputs are only read once. Runs sharing an output directory (e.g. a parallel sweep)
+# update the file under PATH.lock, merging their entries into the file's current contents.
+HASH_BLOCK = 1 << 20
+
+
+class ResultCache(object):
+    """
+    Remembers, for every run label, the digest of the inputs its stored results were computed from. A run can be
+    skipped when its current digest matches the remembered one.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: JSON file holding the cache, created on the first record
+        :type path: str
+        """
+        self.path = path
+        self.lock_path = path + '.lock'
+        self.entries = self._read()
+
+    @contextmanager
+    def _locked(self):
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return {'runs': {}, 'files': {}}
+        with open(self.path, 'r') as f:
+            return json.load(f)
+
+    def _save(self, runs=None, removed_run=None):
+        """
+        Merges this process' file memo and the given run changes into the file as other processes left it.
+
+        :param runs: Digests to record, by run label
+        :param removed_run: Label of a run to forget
+        :type runs: dict
+        :type removed_run: str
+        """
+        with self._locked():
+            entries = self._read()
+            entries['files'].update(self.entries['files'])
+            entries['runs'].update(runs or {})
+            if removed_run is not None:
+                entries['runs'].pop(removed_run, None)
+            tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump(entries, f)
+            os.replace(tmp_path, self.path)
+        self.entries = entries
+
+    def file_digest(self, path):
+        """
+        :return: SHA-1 of the file's contents, recomputed only if its size or modification time changed
+        :rtype: str
+        """
+        stat = os.stat(path)
+        path = os.path.abspath(path)
+        memo = self.entries['files'].get(path)
+        if memo is not None and memo[0] == stat.st_size and memo[1] == stat.st_mtime_ns:
+            return memo[2]
+        sha = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(HASH_BLOCK), b''):
+                sha.update(block)
+        self.entries['files'][path] = [stat.st_size, stat.st_mtime_ns, sha.hexdigest()]
+        return sha.hexdigest()
+
+    def paths_digest(self, paths):
+        """
+        :param paths: Files and directories, directories are hashed recursively
+        :type paths: list of str
+        :return: A digest of the names and contents of all the files
+        :rtype: str
+        """
+        sha = hashlib.sha1()
+        files = []
+        for path in paths:
+            if os.path.isdir(path):
+                for root, _, names in os.walk(path):
+                    files.extend(os.path.join(root, name) for name in names)
+            elif os.path.exists(path):
+                files.append(path)
+            else:
+                sha.update(('missing:%s\n' % path).encode())
+        for path in sorted(files):
+            sha.update(('%s:%s\n' % (os.path.basename(path), self.file_digest(path))).encode())
+        return sha.hexdigest()
+
+    def run_digest(self, run_label, input_paths, settings):
+        """
+        :param run_label: The run's label
+        :param input_paths: The files and directories the run reads
+        :param settings: The flags and other values the results depend on, must be JSON serializable
+        :type run_label: str
+        :type input_paths: list of str
+        :type settings: dict
+        :rtype: str
+        """
+        sha = hashlib.sha1()
+        sha.update(run_label.encode())
+        sha.update(json.dumps(settings, sort_keys=True).encode())
+        sha.update(self.paths_digest(input_paths).encode())
+        # Keep the file memo for the next runs, even if this one is never recorded
+        self._save()
+        return sha.hexdigest()
+
+    def is_valid(self, run_label, digest):
+        return self.entries['runs'].get(run_label) == digest
+
+    def record(self, run_label, digest):
+        self._save(runs={run_label: digest})
+
+    def invalidate(self, run_label):
+        self._save(removed_run=run_label)
+
+
+def checkpoint_files(checkpoint):
+    """
+    :param checkpoint: A checkpoint prefix, e.g. the student's meta_dir
+    :type checkpoint: str
+    :return: The files making up the checkpoint
+    :rtype: list of str
+    """
+    return sorted(glob.glob(glob.escape(checkpoint) + '.*'))
@@ -0,0 +1,133 @@
+import fcntl
+import json
+import os
+from contextlib import contextmanager
+
+import numpy as np
+
+# Layout of a store with prefix P:
+# P.dat:        the arrays' raw bytes, each starting at a multiple of ALIGNMENT, only ever appended to
+# P.index.json: {run label: {array name: [offset, dtype, shape]}}, replaced atomically after every append
+# P.lock:       lock file serializing appends from concurrent processes (e.g. the pipelined server and client)
+ALIGNMENT = 64
+
+
+class ResultsStore(object):
+    """
+    A single append-only, memory-mapped file holding the named result arrays of many runs. Reads are views into one
+    memory map and are cached, so repeatedly loading the same array costs a dictionary lookup.
+    """
+
+    def __init__(self, prefix):
+        """
+        :param prefix: Path prefix of the store's files, created on the first append
+        :type prefix: str
+        """
+        self.prefix = prefix
+        self.data_path = prefix + '.dat'
+        self.index_path = prefix + '.index.json'
+        self.lock_path = prefix + '.lock'
+        self.index = {}
+        self.index_mtime = None
+        self.memmap = None
+        self.cache = {}
+
+    @contextmanager
+    def _locked(self):
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _refresh(self):
+        # Reload the index if another process appended to the store
+        try:
+            mtime = os.stat(self.index_path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime != self.index_mtime:
+            with open(self.index_path, 'r') as f:
+                self.index = json.load(f)
+            self.index_mtime = mtime
+            self.memmap = None
+            self.cache.clear()
+
+    def append(self, run_label, name, array):
+        """
+        Appends an array, replacing any array previously stored under the same run label and name.
+
+        :param run_label: The run the array belongs to
+        :param name: Name of the array, e.g. mious
+        :param array: Any numeric array or a list convertible to one
+        :type run_label: str
+        :type name: str
+        :type array: np.ndarray or list
+        """
+        array = np.ascontiguousarray(array)
+        assert array.dtype != object, 'Only numeric arrays can be stored'
+        with self._locked():
+            self.index_mtime = None
+            self._refresh()
+            with open(self.data_path, 'ab') as f:
+                offset = f.tell()
+                padding = -offset % ALIGNMENT
+                f.write(b'\0' * padding)
+                f.write(array.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            self.index.setdefault(run_label, {})[name] = [offset + padding, array.dtype.str, list(array.shape)]
+            tmp_path = self.index_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self.index, f)
+            os.replace(tmp_path, self.index_path)
+        self.cache.pop((run_label, name), None)
+
+    def contains(self, run_label, name):
+        self._refresh()
+        return run_label in self.index and name in self.index[run_label]
+
+    def get(self, run_label, name):
+        """
+        :return: A read-only view of the stored array
+        :rtype: np.ndarray
+        :raises KeyError: If the array is not in the store
+        """
+        self._refresh()
+        key = (run_label, name)
+        if key not in self.cache:
+            offset, dtype, shape = self.index[run_label][name]
+            dtype = np.dtype(dtype)
+            count = int(np.prod(shape))
+            if count == 0:
+                array = np.empty(shape, dtype=dtype)
+            else:
+                if self.memmap is None or self.memmap.size < offset + count * dtype.itemsize:
+                    self.memmap = np.memmap(self.data_path, dtype=np.uint8, mode='r')
+                array = self.memmap[offset:offset + count * dtype.itemsize].view(dtype).reshape(shape)
+            self.cache[key] = array
+        return self.cache[key]
+
+    def runs(self):
+        self._refresh()
+        return list(self.index.keys())
+
+
+def load_result(store, run_label, name, legacy_prefix):
+    """
+    Loads an array from the store, falling back to the .npy file older runs wrote for it.
+
+    :param store: The results store, may be None to only read legacy files
+    :param run_label: The run the array belongs to
+    :param name: Name of the array
+    :param legacy_prefix: Path prefix of the legacy file, read from legacy_prefix_name.npy
+    :type store: ResultsStore
+    :type run_label: str
+    :type name: str
+    :type legacy_prefix: str
+    :rtype: np.ndarray
+    """
+    if store is not None and store.contains(run_label, name):
+        return store.get(run_label, name)
+    return np.load('%s_%s.npy' % (legacy_prefix, name))
@@ -0,0 +1,74 @@
+import numpy as np
+
+# Policies that decide which stream gets the next training slot:
+# round_robin: streams are served in a fixed cyclic order
+# phi_score: the stream whose scene changes the most (lowest phi-score, i.e. cross mIoU of its recent labels) first
+# staleness: the stream whose current model was trained on the oldest data first
+POLICIES = ['round_robin', 'phi_score', 'staleness']
+
+
+class TrainingScheduler(object):
+    """
+    Assigns a bounded number of training slots to the streams that request them. Each stream has at most one pending
+    request, a new request from a stream that is still waiting replaces the old one.
+    """
+
+    def __init__(self, policy, num_streams):
+        """
+        :param policy: One of POLICIES
+        :param num_streams: Number of streams, streams are identified by their index
+        :type policy: str
+        :type num_streams: int
+        """
+        assert policy in POLICIES, 'Unknown scheduling policy %s' % policy
+        self.policy = policy
+        self.num_streams = num_streams
+        self.pending = {}
+        self.last_served = -1
+        self.model_time = np.zeros(num_streams)
+
+    def request(self, stream_id, now, phi_score=None):
+        """
+        :param stream_id: The stream asking for a training slot
+        :param now: Video time of the request, in seconds
+        :param phi_score: The stream's latest phi-score, needed by the phi_score policy
+        :type stream_id: int
+        :type now: float
+        :type phi_score: float
+        """
+        assert self.policy != 'phi_score' or phi_score is not None, 'The phi_score policy needs phi-scores'
+        self.pending[stream_id] = {'time': now, 'phi_score': phi_score}
+
+    def has_pending(self):
+        return len(self.pending) > 0
+
+    def _priority(self, stream_id):
+        # Lower is served first, ties are broken by the request time and then the stream index
+        request = self.pending[stream_id]
+        if self.policy == 'round_robin':
+            key = (stream_id - self.last_served - 1) % self.num_streams
+        elif self.policy == 'phi_score':
+            key = request['phi_score']
+        else:
+            key = self.model_time[stream_id]
+        return key, request['time'], stream_id
+
+    def next(self):
+        """
+        Pops the pending request with the highest priority.
+
+        :return: The stream to train and the video time of its request, None if nothing is pending
+        :rtype: (int, float)
+        """
+        if not self.pending:
+            return None
+        stream_id = min(self.pending, key=self._priority)
+        request = self.pending.pop(stream_id)
+        self.last_served = stream_id
+        return stream_id, request['time']
+
+    def served(self, stream_id, data_time):
+        """
+        Records that the stream now runs a model trained on data up to data_time, used by the staleness policy.
+        """
+        self.model_time[stream_id] = data_time
@@ -0,0 +1,166 @@
+import os
+import time
+
+import numpy as np
+import cv2
+import tensorflow as tf
+
+from ams.utils.graph_utils import create_teacher
+from ams.utils.utils import SaveHelper
+from ams.utils.checkpoint import load_checkpoint
+
+LABEL_PATTERN = "%sgt_%06d.png"
+
+
+def write_image(path, image):
+    # Written under a temporary name and renamed when complete, so a partially written label is never read
+    tmp_path = path[:-len('.png')] + '.tmp.png'
+    cv2.imwrite(tmp_path, image)
+    os.replace(tmp_path, path)
+
+
+def teacher_input(frame, height=None):
+    """
+    :param frame: A BGR frame, as read from the video
+    :param height: Height the teacher labels the frame at, the frame's own if None
+    :type frame: np.ndarray
+    :type height: int
+    :return: The frame the way the teacher takes it: RGB, resized and padded by one pixel on the top and left
+    :rtype: np.ndarray
+    """
+    frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+    if height is not None:
+        frame = cv2.resize(frame, (height * 2, height))
+    return np.pad(frame, ((1, 0), (1, 0), (0, 0)), mode='symmetric')
+
+
+def load_teacher(teacher_checkpoint, gpu_id, mem_frac=1):
+    """
+    Builds the teacher and restores it from teacher_checkpoint.amsckpt or .npy.
+
+    :param teacher_checkpoint: Path prefix of the teacher's meta and npy or amsckpt files
+    :param gpu_id: GPU to run the teacher on
+    :param mem_frac: Fraction of the GPU memory to use
+    :type teacher_checkpoint: str
+    :type gpu_id: str
+    :type mem_frac: float
+    :return: The session and the teacher's tensors
+    :rtype: (tf.Session, dict)
+    """
+    config = tf.ConfigProto()
+    config.gpu_options.visible_device_list = "%s" % gpu_id
+    config.allow_soft_placement = True
+    config.gpu_options.allow_growth = False
+    if mem_frac != 1:
+        config.gpu_options.per_process_gpu_memory_fraction = mem_frac
+    with tf.device('/gpu:0'):
+        graph = tf.Graph()
+        with graph.as_default():
+            # The class subset metrics of the teacher are not used here, so no class weights are needed
+            teacher = create_teacher(teacher_checkpoint, test_mode=True)
+            reset_conf_mat = tf.initializers.local_variables()
+            init = tf.initializers.global_variables()
+    saver = SaveHelper(graph=graph, map_fun=lambda x: x)
+    sess = tf.Session(graph=graph, config=config)
+    sess.run([init, reset_conf_mat])
+    checkpoint = load_checkpoint(teacher_checkpoint)
+    checkpoint = {'teacher/%s' % k: checkpoint[k] for k in checkpoint}
+    saver.restore_vars(sess, checkpoint, lambda x: x if x not in ['global_step:0'] and 'Momentum' not in x else None)
+    return sess, teacher
+
+
+def run_teacher(sess, teacher, inputs):
+    """
+    :param inputs: Frames prepared by teacher_input, all of the same size
+    :type inputs: list of np.ndarray
+    :return: The teacher's labels, without the padding
+    :rtype: np.ndarray
+    """
+    predictions = sess.run(teacher['predictions'], feed_dict={teacher['images']: np.stack(inputs)})
+    return np.array(predictions[:, 1:, 1:], dtype=np.uint8)
+
+
+class OnlineTeacher(object):
+    """
+    Labels frames as they reach the server instead of reading labels extracted for the whole video beforehand. Labels
+    are memoized in label_dir by frame index, with the names extract_labels.py uses, so they are computed once across
+    runs and a directory of extracted labels is used as is. The teacher is only loaded once a label is missing.
+    """
+
+    def __init__(self, teacher_checkpoint, label_dir, gpu_id, height=None, batch_size=8, mem_frac=1):
+        """
+        :param teacher_checkpoint: Path prefix of the teacher's meta and npy or amsckpt files
+        :param label_dir: Directory the labels are read from and memoized in
+        :param gpu_id: GPU to run the teacher on
+        :param height: Height the teacher labels frames at, the video's if None
+        :param batch_size: Number of frames labeled per session run
+        :param mem_frac: Fraction of the GPU memory to use
+        :type teacher_checkpoint: str
+        :type label_dir: str
+        :type gpu_id: str
+        :type height: int
+        :type batch_size: int
+        :type mem_frac: float
+        """
+        self.teacher_checkpoint = teacher_checkpoint
+        self.label_dir = label_dir
+        self.gpu_id = gpu_id
+        self.height = height
+        self.batch_size = batch_size
+        self.mem_frac = mem_frac
+        self.sess = None
+        self.teacher = None
+        self.labeled = 0
+        self.memo_hits = 0
+        self.teacher_time = 0.
+        os.makedirs(label_dir, exist_ok=True)
+
+    def cached(self, index_frame):
+        """
+        :return: The memoized label of the frame, None if the teacher has not labeled it yet
+        :rtype: np.ndarray
+        """
+        label = cv2.imread(LABEL_PATTERN % (self.label_dir, index_frame), cv2.IMREAD_GRAYSCALE)
+        if label is not None:
+            self.memo_hits += 1
+        return label
+
+    def memoized(self, index_frame):
+        return os.path.exists(LABEL_PATTERN % (self.label_dir, index_frame))
+
+    def prepare(self, frame):
+        return teacher_input(frame, self.height)
+
+    def label(self, indices, inputs):
+        """
+        Labels the frames in batches and memoizes the labels.
+
+        :param indices: Indices of the frames in the video
+        :param inputs: The frames, prepared by prepare
+        :type indices: list of int
+        :type inputs: list of np.ndarray
+        :return: The labels, in the order of indices
+        :rtype: list of np.ndarray
+        """
+        if len(indices) == 0:
+            return []
+        if self.sess is None:
+            self.sess, self.teacher = load_teacher(self.teacher_checkpoint, self.gpu_id, self.mem_frac)
+        t1 = time.time()
+        labels = []
+        for start in range(0, len(inputs), self.batch_size):
+            labels.extend(run_teacher(self.sess, self.teacher, inputs[start:start + self.batch_size]))
+        for index_frame, label in zip(indices, labels):
+            write_image(LABEL_PATTERN % (self.label_dir, index_frame), label)
+        self.teacher_time += time.time() - t1
+        self.labeled += len(indices)
+        return labels
+
+    def summary(self):
+        return "Teacher labeled %d frames in %.1f s, %d labels were memoized" % (self.labeled, self.teacher_time,
+                                                                                  self.memo_hits)
+
+    def close(self):
+        if self.sess is not None:
+            self.sess.close()
+            self.sess = None
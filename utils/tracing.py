@@ -0,0 +1,149 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Phases of the server loop that are recorded by train_model and SemanticNetwork. mask_update is the recompute of the
+# coord_desc_auto mask after the first step, mask_selection the choice of the mask before training
+PHASES = ['decode', 'sampling', 'uplink_encode', 'replay_update', 'asr_scoring', 'restore', 'batch_wait',
+          'train_step', 'mask_selection', 'mask_update', 'export', 'downlink_encode']
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return {}
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Tracer(object):
+    """
+    Records timed spans into a fixed-size in-memory ring buffer. When disabled, span() costs a single attribute check,
+    so the instrumentation can stay in the hot loops.
+    """
+    DEFAULT_CAPACITY = 100000
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, enabled=False):
+        self.enabled = enabled
+        self.records = deque(maxlen=capacity)
+        self.profile_iters = set()
+        self.profile_prefix = None
+        self.profile_count = 0
+        self.pid = os.getpid()
+        self.t0 = time.perf_counter()
+
+    def enable(self, capacity=None, profile_iters=None, profile_prefix=None):
+        """
+        :param capacity: Number of records kept in the ring buffer, older records are dropped first
+        :param profile_iters: Training iterations to run with a full TF RunMetadata trace
+        :param profile_prefix: Path prefix of the step traces written for profile_iters
+        :type capacity: int
+        :type profile_iters: list of int
+        :type profile_prefix: str
+        """
+        if capacity is not None and capacity != self.records.maxlen:
+            self.records = deque(self.records, maxlen=capacity)
+        if profile_iters is not None:
+            self.profile_iters = set(profile_iters)
+        if profile_prefix is not None:
+            self.profile_prefix = profile_prefix
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    @contextmanager
+    def _span(self, name, args):
+        t1 = time.perf_counter()
+        try:
+            yield args
+        finally:
+            self.records.append((name, t1 - self.t0, time.perf_counter() - t1, threading.get_ident(), args))
+
+    def span(self, name, **args):
+        """
+        Times the enclosed block as phase name. The yielded dict can be filled with extra values (e.g. the loss) that
+        are stored alongside the record.
+        """
+        if not self.enabled:
+            return _NULL_SPAN
+        return self._span(name, args)
+
+    def add(self, name, start, duration, **args):
+        """
+        Adds a record for a span measured elsewhere, start is a time.perf_counter() value.
+        """
+        if self.enabled:
+            self.records.append((name, start - self.t0, duration, threading.get_ident(), args))
+
+    def should_profile(self, iteration):
+        return self.enabled and self.profile_prefix is not None and iteration in self.profile_iters
+
+    def next_profile_path(self, iteration):
+        self.profile_count += 1
+        return '%s_round%03d_iter%04d.json' % (self.profile_prefix, self.profile_count, iteration)
+
+    def summary(self):
+        """
+        :return: Per-phase count, total and mean duration in ms
+        :rtype: dict
+        """
+        stats = {}
+        for name, _, duration, _, _ in self.records:
+            count, total = stats.get(name, (0, 0.))
+            stats[name] = (count + 1, total + duration)
+        return {name: {'count': count, 'total_ms': total * 1000., 'mean_ms': total * 1000. / count}
+                for name, (count, total) in stats.items()}
+
+    def export_jsonl(self, path):
+        with open(path, 'w') as f:
+            for name, start, duration, tid, args in self.records:
+                f.write(json.dumps({'name': name, 'start_ms': start * 1000., 'duration_ms': duration * 1000.,
+                                    'tid': tid, 'args': args}, default=float) + '\n')
+
+    def export_chrome_trace(self, path):
+        """
+        Writes the records in the Chrome trace event format, viewable in chrome://tracing or Perfetto.
+        """
+        events = [{'name': name, 'cat': 'ams', 'ph': 'X', 'ts': start * 1e6, 'dur': duration * 1e6,
+                   'pid': self.pid, 'tid': tid, 'args': args}
+                  for name, start, duration, tid, args in self.records]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f, default=float)
+
+    def export(self, path):
+        if path.endswith('.jsonl'):
+            self.export_jsonl(path)
+        else:
+            self.export_chrome_trace(path)
+
+    def clear(self):
+        self.records.clear()
+
+    def reset(self):
+        # Back to the state of a new process: disabled, without records or profiled iterations
+        self.disable()
+        self.clear()
+        self.profile_iters = set()
+        self.profile_prefix = None
+        self.profile_count = 0
+        self.t0 = time.perf_counter()
+
+
+def save_run_metadata(run_metadata, path):
+    """
+    Dumps a TF RunMetadata step trace as a Chrome trace file.
+    """
+    from tensorflow.python.client import timeline
+    with open(path, 'w') as f:
+        f.write(timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format())
+
+
+# Shared tracer, disabled unless a run asks for tracing
+tracer = Tracer()
@@ -1,11 +1,22 @@
+import os
+import time
+import subprocess as sp
 import numpy as np
 import tensorflow as tf
 import cv2
 from collections import deque
 import random
 
+from ams.utils.checkpoint import Checkpoint, load_checkpoint
+
 # TODO: simplify code, remove the sys.append, test running it, merge with other profilers
 
+SAMPLING_POLICIES = ['uniform', 'content']
+# Size of the frames and labels compared by the content sampling policy, and the share of the mean change every frame
+# gets regardless of its own
+THUMBNAIL_SIZE = (32, 16)
+CONTENT_SCORE_FLOOR = 0.1
+
 
 class SaveHelper:
     def __init__(self, graph, map_fun):
@@ -16,6 +27,10 @@ class SaveHelper:
                 map_fun(v.name): tf.placeholder(dtype=v.dtype, shape=v.shape, name='pl_%s' % (v.name.strip(':0'))) for v
                 in variables}
             self.load_ops = {k: tf.assign(self.vars_dict[k], self.vars_pl[k], use_locking=True) for k in self.vars_dict}
+        self.graph = graph
+        # Flat layouts by the names of their variables, and the snapshots kept for rollback by slot name
+        self.layouts = {}
+        self.slots = {}
 
     def save_vars(self, sess, vars_list, map_fun, save_dir=None):
         vars_vals = sess.run(vars_list)
@@ -30,9 +45,13 @@ class SaveHelper:
     def restore_vars(self, sess, load_dir, map_fun):
         # TODO (Mehrdad --> Mehrdad) double check no redundant variables are transferred
         print('Trying to restore checkpoint')
+        if isinstance(load_dir, FlatSnapshot):
+            self.restore_flat(sess, load_dir)
+            print('Restored successfully')
+            return
         if isinstance(load_dir, str):
-            vars_list = np.load(load_dir, allow_pickle=True).item()
-        elif isinstance(load_dir, dict):
+            vars_list = load_checkpoint(load_dir)
+        elif isinstance(load_dir, (dict, Checkpoint)):
             vars_list = load_dir
         else:
             exit(1)
@@ -48,6 +67,124 @@ class SaveHelper:
         print('Restored successfully')
         return
 
+    def flat_layout(self, vars_list, map_fun):
+        """
+        Builds, once per set of variables, the ops that read the selected float32 variables as one contiguous buffer
+        and write them back from one. The other selected variables, e.g. global_step, go through the dict path.
+
+        :param vars_list: Variables to select from, in the order of the snapshot
+        :param map_fun: Selects a variable when it maps its name to something other than None
+        :type vars_list: list of tf.Variable
+        :return: The layout, with the offset and shape of each packed variable
+        :rtype: FlatLayout
+        """
+        selected = [v for v in vars_list if map_fun(v.name) is not None]
+        key = tuple(v.name for v in selected)
+        if key not in self.layouts:
+            packed = [v for v in selected if v.dtype.base_dtype == tf.float32]
+            extra = [v for v in selected if v.dtype.base_dtype != tf.float32]
+            assert all(v.shape.is_fully_defined() for v in packed), 'Packed variables need a static shape'
+            offsets = {}
+            start = 0
+            for v in packed:
+                size = v.shape.num_elements()
+                offsets[v.name] = (start, start + size, v.shape.as_list())
+                start += size
+            with self.graph.as_default():
+                with tf.name_scope('flat_snapshot'):
+                    fetch = tf.concat([tf.reshape(v, [-1]) for v in packed], axis=0)
+                    buffer_pl = tf.placeholder(dtype=tf.float32, shape=[start], name='buffer')
+                    parts = tf.split(buffer_pl, [v.shape.num_elements() for v in packed])
+                    restore_op = tf.group(*[tf.assign(v, tf.reshape(part, v.shape), use_locking=True)
+                                            for v, part in zip(packed, parts)])
+            self.layouts[key] = FlatLayout(list(key), offsets, [v.name for v in extra], fetch, buffer_pl, restore_op)
+        return self.layouts[key]
+
+    def save_flat(self, sess, vars_list, map_fun):
+        """
+        Reads the selected variables with a single fetch of one buffer, instead of one array per variable.
+
+        :rtype: FlatSnapshot
+        """
+        layout = self.flat_layout(vars_list, map_fun)
+        buffer, extra = sess.run([layout.fetch, [self.vars_dict[name] for name in layout.extra]])
+        return FlatSnapshot(layout, buffer, dict(zip(layout.extra, extra)))
+
+    def restore_flat(self, sess, snapshot):
+        """
+        Writes a snapshot back with a single feed of its buffer. A snapshot taken from another graph, e.g. one evicted
+        from a session pool, is written back variable by variable instead, its ops can't run in this session.
+
+        :type snapshot: FlatSnapshot
+        """
+        layout = snapshot.layout
+        if layout not in self.layouts.values():
+            self.restore_vars(sess, snapshot.to_dict(), lambda x: x)
+            return
+        feed_dict = {self.vars_pl[name]: snapshot.extra[name] for name in layout.extra}
+        feed_dict[layout.buffer_pl] = snapshot.buffer
+        sess.run([layout.restore_op] + [self.load_ops[name] for name in layout.extra], feed_dict=feed_dict)
+
+    def snapshot(self, sess, vars_list, map_fun, slot):
+        """
+        Keeps the selected variables in memory under slot, to be brought back by rollback.
+        """
+        self.slots[slot] = self.save_flat(sess, vars_list, map_fun)
+        return self.slots[slot]
+
+    def rollback(self, sess, slot):
+        assert slot in self.slots, 'No snapshot in slot %s' % slot
+        self.restore_flat(sess, self.slots[slot])
+
+    def drop(self, slot):
+        self.slots.pop(slot, None)
+
+
+class FlatLayout:
+    def __init__(self, names, offsets, extra, fetch, buffer_pl, restore_op):
+        self.names = names
+        self.offsets = offsets
+        self.extra = extra
+        self.fetch = fetch
+        self.buffer_pl = buffer_pl
+        self.restore_op = restore_op
+
+
+class FlatSnapshot:
+    """
+    Values of the variables of a FlatLayout. Indexing by variable name gives a view into the buffer, so a snapshot can
+    be used where the dicts of SaveHelper.save_vars are, without copying.
+    """
+
+    def __init__(self, layout, buffer, extra):
+        self.layout = layout
+        self.buffer = buffer
+        self.extra = extra
+
+    def __getitem__(self, name):
+        if name in self.extra:
+            return self.extra[name]
+        start, end, shape = self.layout.offsets[name]
+        return self.buffer[start:end].reshape(shape)
+
+    def __contains__(self, name):
+        return name in self.layout.offsets or name in self.extra
+
+    def __iter__(self):
+        return iter(self.layout.names)
+
+    def __len__(self):
+        return len(self.layout.names)
+
+    def keys(self):
+        return list(self.layout.names)
+
+    def copy(self):
+        return FlatSnapshot(self.layout, self.buffer.copy(), {k: np.copy(v) for k, v in self.extra.items()})
+
+    def to_dict(self):
+        return {name: np.copy(self[name]) for name in self.layout.names}
+
 
 def colormap(name='cityscapes'):
     if name == 'cityscapes':
@@ -126,8 +263,10 @@ def calculate_miou(conf_matrix, population=False, detailed=False, nan=False):
             return miou
 
 
-def mini_batch(deque_images, deque_labels, crop_size, scale, mini_batch_size, num_of_iterations, flip=False):
+def mini_batch(deque_images, deque_labels, crop_size, scale, mini_batch_size, num_of_iterations, flip=False,
+               cache=None):
     """
+    :param cache: Keeps the scaled samples across calls, the frames and labels must then be the views of its memory
     :type deque_images: deque or list
     :type deque_labels: deque or list
     :type crop_size: list
@@ -135,6 +274,7 @@ def mini_batch(deque_images, deque_labels, crop_size, scale, mini_batch_size, nu
     :type mini_batch_size: int
     :type num_of_iterations: int
     :type flip: bool
+    :type cache: ams.utils.replay_memory.ScalePyramid
     """
     dict_scaled_images = {scale_choice: {} for scale_choice in scale}
     dict_scaled_labels = {scale_choice: {} for scale_choice in scale}
@@ -147,30 +287,41 @@ def mini_batch(deque_images, deque_labels, crop_size, scale, mini_batch_size, nu
     for i in range(num_of_iterations):
         for j in range(mini_batch_size):
             pic_index = np.random.choice(total_size)
-            height_image = deque_list_images[pic_index].shape[0]
-            width_image = deque_list_images[pic_index].shape[1]
             chosen_scale = scale[random.randint(0, len(scale)-1)]
-            actual_scale = chosen_scale * crop_size[1] / width_image
-            max_h = int(height_image * actual_scale) - crop_size[0]
-            max_w = int(width_image * actual_scale) - crop_size[1]
+            if pic_index not in dict_scaled_images[chosen_scale]:
+                # Unit scales are not cached, the samples are already at the crop size
+                scaled = cache.lookup(pic_index, chosen_scale, crop_size[1]) \
+                    if cache is not None and chosen_scale != 1 else None
+                if scaled is not None:
+                    dict_scaled_images[chosen_scale][pic_index], dict_scaled_labels[chosen_scale][pic_index] = scaled
+                else:
+                    # Fetched once, the memory may have to decompress or read it from disk
+                    image = deque_list_images[pic_index]
+                    height_image = image.shape[0]
+                    width_image = image.shape[1]
+                    actual_scale = chosen_scale * crop_size[1] / width_image
+                    if actual_scale == 1 and chosen_scale == 1:
+                        dict_scaled_images[chosen_scale][pic_index] = image
+                        dict_scaled_labels[chosen_scale][pic_index] = deque_list_labels[pic_index]
+                    else:
+                        t_resize = time.perf_counter()
+                        scaled_size = (int(width_image * actual_scale), int(height_image * actual_scale))
+                        dict_scaled_images[chosen_scale][pic_index] = cv2.resize(image, scaled_size,
+                                                                                 interpolation=cv2.INTER_LINEAR)
+                        dict_scaled_labels[chosen_scale][pic_index] = cv2.resize(deque_list_labels[pic_index],
+                                                                                 scaled_size, fx=0, fy=0,
+                                                                                 interpolation=cv2.INTER_NEAREST)
+                        if cache is not None and chosen_scale != 1:
+                            cache.store(pic_index, chosen_scale, crop_size[1],
+                                        dict_scaled_images[chosen_scale][pic_index],
+                                        dict_scaled_labels[chosen_scale][pic_index], time.perf_counter() - t_resize)
+            scaled_image = dict_scaled_images[chosen_scale][pic_index]
+            max_h = scaled_image.shape[0] - crop_size[0]
+            max_w = scaled_image.shape[1] - crop_size[1]
             assert max_w >= 0
             assert max_h >= 0
             h = random.randint(0, max_h)
             w = random.randint(0, max_w)
-            if pic_index not in dict_scaled_images[chosen_scale]:
-                if actual_scale == 1 and chosen_scale == 1:
-                    dict_scaled_images[chosen_scale][pic_index] = deque_list_images[pic_index]
-                    dict_scaled_labels[chosen_scale][pic_index] = deque_list_labels[pic_index]
-                else:
-                    dict_scaled_images[chosen_scale][pic_index] = cv2.resize(deque_list_images[pic_index],
-                                                                             (int(width_image * actual_scale),
-                                                                              int(height_image * actual_scale)),
-                                                                             interpolation=cv2.INTER_LINEAR)
-                    dict_scaled_labels[chosen_scale][pic_index] = cv2.resize(deque_list_labels[pic_index],
-                                                                             (int(width_image * actual_scale),
-                                                                              int(height_image * actual_scale)),
-                                                                             fx=0, fy=0,
-                                                                             interpolation=cv2.INTER_NEAREST)
             w_end = w + crop_size[1]
             h_end = h + crop_size[0]
             if flip and np.random.random() > 0.5:
@@ -234,6 +385,83 @@ def prune(nodes, tag):
     return new_nodes
 
 
+def choose_indices(num_frames, sample_fraction):
+    """
+    Choose equally-distanced indices of frames based on the number of samples wanted, without needing the frames
+
+    :param num_frames: The number of frames to choose from
+    :type num_frames: int
+    :param sample_fraction: The fraction of samples wanted
+    :type sample_fraction: float
+    :return: sorted sample indices
+    :rtype: np.ndarray
+    """
+    samples = int(np.round(sample_fraction * num_frames))
+    indices = np.linspace(-1, num_frames-1, samples+1, endpoint=True)[1:]
+    indices = np.round(indices).astype(int)
+    assert indices.size == samples, f"indices had {indices.size} values but samples is {samples}"
+    return indices
+
+
+def frame_thumbnail(frame):
+    """
+    :param frame: A BGR frame, or a label if it has no channels
+    :type frame: np.ndarray
+    :return: A tiny version of the frame or label, used to score how much the content changes
+    :rtype: np.ndarray
+    """
+    if frame.ndim == 3:
+        return cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), THUMBNAIL_SIZE,
+                          interpolation=cv2.INTER_AREA).astype(np.float32)
+    return cv2.resize(frame, THUMBNAIL_SIZE, interpolation=cv2.INTER_NEAREST)
+
+
+def content_change(thumbnail, label_thumbnail, last_thumbnail, last_label_thumbnail):
+    """
+    Scores a frame by how much it changed from the previous one: the mean absolute difference of the frames' thumbnails,
+    scaled to [0, 1], plus the fraction of the labels' thumbnails that changed class if both labels are known.
+
+    :return: The frame's score, 1 if there is no previous frame
+    :rtype: float
+    """
+    if last_thumbnail is None:
+        return 1.
+    change = np.mean(np.abs(thumbnail - last_thumbnail)) / 255
+    if label_thumbnail is not None and last_label_thumbnail is not None:
+        change += np.mean(label_thumbnail != last_label_thumbnail)
+    return float(change)
+
+
+def choose_content_indices(scores, sample_fraction):
+    """
+    Choose as many frames as choose_indices, spread equally over the accumulated content change instead of over time:
+    static stretches get few samples and fast changes get many.
+
+    :param scores: The content_change of every frame
+    :type scores: list of float
+    :param sample_fraction: The fraction of samples wanted
+    :type sample_fraction: float
+    :return: sorted sample indices
+    :rtype: np.ndarray
+    """
+    num_frames = len(scores)
+    samples = int(np.round(sample_fraction * num_frames))
+    scores = np.asarray(scores, dtype=np.float64)
+    if samples == 0 or np.sum(scores) <= 0:
+        return choose_indices(num_frames, sample_fraction)
+    # The floor keeps a few samples in static stretches
+    change = np.cumsum(scores + CONTENT_SCORE_FLOOR * np.mean(scores))
+    targets = (np.arange(samples) + 1) / samples * change[-1]
+    indices = np.minimum(np.searchsorted(change, targets * (1 - 1e-9)), num_frames - 1)
+    # Bursts of change can pick the same frame several times, move them to the next frames while keeping the order
+    for k in range(1, samples):
+        indices[k] = max(indices[k], indices[k - 1] + 1)
+    indices[-1] = min(indices[-1], num_frames - 1)
+    for k in range(samples - 2, -1, -1):
+        indices[k] = min(indices[k], indices[k + 1] - 1)
+    return indices
+
+
 def choose_frames(frame_label_list, sample_fraction):
     """
     Choose equally-distanced frames based on the number of samples wanted
@@ -245,10 +473,45 @@ def choose_frames(frame_label_list, sample_fraction):
     :return: list of sample indices
     :rtype: np.ndarray
     """
-    samples = int(np.round(sample_fraction * len(frame_label_list)))
-    indices = np.linspace(-1, len(frame_label_list)-1, samples+1, endpoint=True)[1:]
-    indices = np.round(indices).astype(int)
-    assert indices.size == samples, f"indices had {indices.size} values but samples is {samples}"
+    indices = choose_indices(len(frame_label_list), sample_fraction)
     frames_chosen = [frame_label_list[chosen_index][0] for chosen_index in indices]
     labels_chosen = [frame_label_list[chosen_index][1] for chosen_index in indices]
     return frames_chosen, labels_chosen
+
+
+def pack_update(path, masks, params):
+    """
+    Writes a model update the way it is sent on the downlink: the bit-packed masks of all variables followed by the
+    masked parameters in float16.
+
+    :param path: File to write the update to
+    :param masks: Boolean mask of the updated entries of every variable
+    :param params: Values of every variable, same shapes as masks
+    :type path: str
+    :type masks: list of np.ndarray
+    :type params: list of np.ndarray
+    :return: The number of parameters of the model
+    :rtype: int
+    """
+    full_size = 0
+    with open(path, 'wb') as f:
+        for val in masks:
+            f.write(np.packbits(val.flatten()).tobytes())
+            full_size += val.size
+        for p_ind in range(len(params)):
+            assert params[p_ind].shape == masks[p_ind].shape
+            f.write(params[p_ind][masks[p_ind]].astype(np.float16).tobytes())
+    return full_size
+
+
+def compress_update(path):
+    """
+    Compresses an update written by pack_update with gzip, keeping the original.
+
+    :param path: The update's file, compressed to path.gz
+    :type path: str
+    :return: Size of the compressed update in bits
+    :rtype: int
+    """
+    sp.Popen(['gzip', '-9', '-f', '-k', path]).wait()
+    return os.path.getsize(path + '.gz') * 8
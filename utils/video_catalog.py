@@ -0,0 +1,136 @@
+import os
+import json
+import argparse
+
+# video_catalog.json maps each video number to its classes and length, the settings of exp_configs, and to the
+# metadata of the video file: fps, frame count and resolution. The file metadata is filled once by probing the videos
+# with this module, so the entry points read it without opening the container. Adding a video only adds an entry.
+CATALOG_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'video_catalog.json')
+PROBED_FIELDS = ['name', 'fps', 'frames', 'width', 'height', 'file_bytes']
+ENTRY_FIELDS = ['dataset', 'num_classes', 'classes', 'coco', 'test_length'] + PROBED_FIELDS
+
+_catalogs = {}
+_probes = {}
+
+
+def load_catalog(path=CATALOG_PATH):
+    """
+    :return: The entries by video number, read once per process
+    :rtype: dict
+    """
+    if path not in _catalogs:
+        with open(path, 'r') as f:
+            _catalogs[path] = {int(k): v for k, v in json.load(f).items()}
+    return _catalogs[path]
+
+
+def save_catalog(catalog, path=CATALOG_PATH):
+    # One line per video, in the order of ENTRY_FIELDS, so adding or probing a video is a one line diff
+    lines = ['  "%d": {%s}' % (k, ', '.join('"%s": %s' % (field, json.dumps(catalog[k].get(field)))
+                                            for field in ENTRY_FIELDS)) for k in sorted(catalog)]
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write('{\n' + ',\n'.join(lines) + '\n}\n')
+    os.replace(tmp_path, path)
+    _catalogs[path] = catalog
+
+
+def video_entry(experiment_number):
+    """
+    :param experiment_number: The video's number, e.g. 12 for 12-la.mp4
+    :type experiment_number: int
+    :return: The video's entry in the catalog
+    :rtype: dict
+    """
+    catalog = load_catalog()
+    if experiment_number not in catalog:
+        raise ValueError('Experiment %d not configured' % experiment_number)
+    return catalog[experiment_number]
+
+
+def video_number(video_path):
+    # Videos are named VIDEO_NUM-VIDEO_NAME.mp4
+    return int(os.path.basename(video_path).split('-')[0])
+
+
+def probe_video(video_path):
+    """
+    Opens the video and reads the metadata the catalog caches.
+
+    :rtype: dict
+    """
+    import cv2
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise IOError('Error opening video stream or file %s' % video_path)
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    probe = {'name': os.path.splitext(os.path.basename(video_path))[0].split('-', 1)[-1],
+             'fps': int(fps) if fps == int(fps) else round(fps, 3),
+             'frames': int(cap.get(cv2.CAP_PROP_FRAME_COUNT)),
+             'width': int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+             'height': int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+             'file_bytes': os.path.getsize(video_path)}
+    cap.release()
+    return probe
+
+
+def video_metadata(video_path):
+    """
+    :param video_path: The video, named VIDEO_NUM-VIDEO_NAME.mp4
+    :type video_path: str
+    :return: The video's catalog entry. If the entry was not probed from this file, judging by its size, the video is
+             probed once per process instead.
+    :rtype: dict
+    """
+    entry = dict(video_entry(video_number(video_path)))
+    if entry.get('file_bytes') != os.path.getsize(video_path):
+        if video_path not in _probes:
+            print('%s is not probed in the video catalog, run utils/video_catalog.py on it' % video_path)
+            _probes[video_path] = probe_video(video_path)
+        entry.update(_probes[video_path])
+    return entry
+
+
+def video_fps(video_path):
+    """
+    :return: The video's frame rate, rounded the way the frame indices are computed with it
+    :rtype: int
+    """
+    return int(round(video_metadata(video_path)['fps']))
+
+
+def video_catalog_test():
+    catalog = load_catalog()
+    for k in catalog:
+        entry = catalog[k]
+        assert sorted(entry) == sorted(ENTRY_FIELDS), 'Video %d has fields %s' % (k, sorted(entry))
+        assert entry['num_classes'] in [19, 21]
+        assert all(0 <= c < entry['num_classes'] for c in entry['classes'])
+        assert entry['coco'] == (entry['num_classes'] == 21)
+    print('Video catalog has %d valid entries' % len(catalog))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Probes videos and caches their metadata in the video catalog')
+    parser.add_argument('videos', type=str, nargs='*', help='Videos to probe, named VIDEO_NUM-VIDEO_NAME.mp4')
+    parser.add_argument('--dataset', type=str, default=None, help='Dataset of videos not in the catalog yet')
+    parser.add_argument('--classes', type=str, default=None,
+                        help='Comma separated chosen classes of videos not in the catalog yet')
+    parser.add_argument('--num_classes', type=int, default=19, help='Number of classes of the teacher\'s labels')
+    parser.add_argument('--test_length', type=int, default=None, help='Seconds of the video used in experiments')
+    parser.add_argument('--test', action='store_true', help='Validate the catalog')
+    args = parser.parse_args()
+    catalog = load_catalog()
+    for video in args.videos:
+        k = video_number(video)
+        if k not in catalog:
+            assert args.classes is not None, 'Video %d is not in the catalog, its --classes are needed' % k
+            catalog[k] = {'dataset': args.dataset, 'num_classes': args.num_classes,
+                          'classes': [int(c) for c in args.classes.split(',')], 'coco': args.num_classes == 21,
+                          'test_length': args.test_length}
+        catalog[k].update(probe_video(video))
+        print('Probed video %d: %s' % (k, ', '.join('%s=%s' % (f, catalog[k][f]) for f in PROBED_FIELDS)))
+    if args.videos:
+        save_catalog(catalog)
+    if args.test:
+        video_catalog_test()
@@ -0,0 +1,182 @@
+import threading
+from queue import Queue
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import cv2
+
+from ams.utils.utils import colormap
+
+# The images saved for every visualized frame, written as NAME.png or as one video per image
+VIS_STREAMS = ['cross_mask', 'ignore_mask', 'overlay_teacher', 'output_teacher', 'output_student', 'overlay_student',
+               'frame', 'label_student']
+VIS_FORMATS = ['png', 'video']
+
+
+class Colorizer(object):
+    """
+    Builds the images of SemanticNetwork.cross_ignore, colorize_teacher and colorize with one table lookup per image.
+    The tables are in BGR, so the images are written without converting them.
+    """
+
+    def __init__(self, semantic_network):
+        """
+        :param semantic_network: The network whose reduced classes are colored
+        :type semantic_network: ams.SemanticNetwork.SemanticNetwork
+        """
+        take_array = np.zeros(256, dtype=np.int64)
+        take_array[:len(semantic_network.take_array)] = semantic_network.take_array
+        self.take_array = take_array
+        self.teacher_colors = np.ascontiguousarray(colormap()[:, ::-1])
+        reduced_colors = semantic_network.color_map_reduced_[:, ::-1]
+        self.student_colors = np.ascontiguousarray(reduced_colors)
+        # The last row is black, for the pixels that are not wrongly predicted
+        self.cross_colors = np.concatenate([reduced_colors, np.zeros((1, 3), dtype=np.uint8)])
+        self.ignore_colors = np.where(np.expand_dims(take_array == 0, axis=-1), semantic_network.WHITE,
+                                      semantic_network.BLACK).astype(np.uint8)
+
+    def images(self, frame, label_teacher, label_student):
+        """
+        :param frame: The RGB frame
+        :param label_teacher: The teacher's label, with all classes
+        :param label_student: The student's label, with the reduced classes
+        :type frame: np.ndarray
+        :type label_teacher: np.ndarray
+        :type label_student: np.ndarray
+        :return: The BGR images, or grayscale for label_student, of all VIS_STREAMS
+        :rtype: dict
+        """
+        frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+        label_teacher_reduced = self.take_array[label_teacher]
+        cross_cond = np.logical_and(label_teacher_reduced != 0, label_teacher_reduced != label_student)
+        colored_teacher = self.teacher_colors[label_teacher]
+        colored_student = self.student_colors[label_student]
+        # Named like the values returned by colorize_teacher and colorize, which return the colored label first
+        cross_index = np.where(cross_cond, label_teacher_reduced, len(self.cross_colors) - 1)
+        return {'cross_mask': self.cross_colors[cross_index],
+                'ignore_mask': self.ignore_colors[label_teacher],
+                'overlay_teacher': colored_teacher,
+                'output_teacher': cv2.addWeighted(frame, 0.5, colored_teacher, 0.5, 0),
+                'output_student': cv2.addWeighted(frame, 0.5, colored_student, 0.5, 0),
+                'overlay_student': colored_student,
+                'frame': frame,
+                'label_student': label_student.astype(np.uint8)}
+
+
+class VisualizationWriter(object):
+    """
+    Colors and writes the visualizations of infer_output on a pool of worker threads. The inference thread only hands
+    over the frame and the labels, and waits when more than max_pending frames are queued. Images are written as PNGs
+    named PREFIX_FRAME_NAME.png, or appended in order to one video per image.
+    """
+
+    def __init__(self, colorizer, prefix, vis_format='png', workers=4, max_pending=32, fps=30):
+        """
+        :param colorizer: Builds the images
+        :param prefix: Path prefix of the PNGs or videos
+        :param vis_format: png or video
+        :param workers: Number of threads building and writing the images
+        :param max_pending: Number of frames queued before submit blocks
+        :param fps: Frame rate of the videos
+        :type colorizer: Colorizer
+        :type prefix: str
+        :type vis_format: str
+        :type workers: int
+        :type max_pending: int
+        :type fps: float
+        """
+        assert vis_format in VIS_FORMATS, 'Unknown visualization format %s' % vis_format
+        self.colorizer = colorizer
+        self.prefix = prefix
+        self.vis_format = vis_format
+        self.fps = fps
+        self.videos = {}
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        # Futures in submission order, the writer thread waits on them in order so videos get the frames in order
+        self.pending = Queue(maxsize=max_pending)
+        self.writer = threading.Thread(target=self._write_in_order, daemon=True)
+        self.writer.start()
+        self.error = None
+
+    def _build(self, index_frame, frame, label_teacher, label_student):
+        images = self.colorizer.images(frame, label_teacher, label_student)
+        if self.vis_format == 'png':
+            for name in VIS_STREAMS:
+                cv2.imwrite("%s_%06d_%s.png" % (self.prefix, index_frame, name), images[name])
+            return None
+        return images
+
+    def _write_in_order(self):
+        while True:
+            future = self.pending.get()
+            if future is None:
+                break
+            try:
+                images = future.result()
+                if images is not None:
+                    self._append_to_videos(images)
+            except Exception as e:
+                self.error = e
+
+    def _append_to_videos(self, images):
+        for name in VIS_STREAMS:
+            if name not in self.videos:
+                height, width = images[name].shape[:2]
+                self.videos[name] = cv2.VideoWriter("%s_%s.mp4" % (self.prefix, name),
+                                                    cv2.VideoWriter_fourcc(*'mp4v'), self.fps, (width, height),
+                                                    images[name].ndim == 3)
+            self.videos[name].write(images[name])
+
+    def submit(self, index_frame, frame, label_teacher, label_student):
+        """
+        Queues the visualization of a frame, the arrays must not be modified afterwards.
+        """
+        if self.error is not None:
+            raise self.error
+        self.pending.put(self.pool.submit(self._build, index_frame, frame, label_teacher, label_student))
+
+    def close(self):
+        self.pending.put(None)
+        self.writer.join()
+        self.pool.shutdown()
+        for video in self.videos.values():
+            video.release()
+        if self.error is not None:
+            raise self.error
+
+
+def colorizer_test():
+    # Checks the table lookups against the network's own methods, with a stand-in for the network's class tables
+    class Network(object):
+        WHITE = np.array([255, 255, 255], dtype=np.uint8)
+        BLACK = np.array([0, 0, 0], dtype=np.uint8)
+        height = 16
+        class_weights = np.zeros(19)
+        class_weights[[0, 1, 2, 8, 10, 13]] = 1
+        take_array = np.cumsum(class_weights).astype(int)
+        take_array = np.where(take_array != 0, take_array - 1, take_array)
+        color_map_reduced_ = np.take(colormap(), np.where(class_weights == 1)[0], axis=0)
+
+    network = Network()
+    frame = np.random.randint(0, 256, size=(16, 32, 3), dtype=np.uint8)
+    label_teacher = np.random.randint(0, 19, size=(16, 32))
+    label_student = np.random.randint(0, 6, size=(16, 32))
+    images = Colorizer(network).images(frame, label_teacher, label_student)
+    label_teacher_reduced = network.take_array[label_teacher]
+    ignore_mask = np.where(np.expand_dims(label_teacher_reduced, axis=-1) == 0, network.WHITE, network.BLACK)
+    cross_cond = np.logical_and(np.logical_not(ignore_mask[:, :, :1]),
+                                np.expand_dims(np.not_equal(label_teacher_reduced, label_student), axis=-1))
+    cross_mask = np.where(cross_cond, network.color_map_reduced_[label_teacher_reduced], network.BLACK)
+    colored_teacher = colormap()[label_teacher]
+    colored_student = network.color_map_reduced_[label_student]
+    expected = {'cross_mask': cross_mask, 'ignore_mask': ignore_mask, 'overlay_teacher': colored_teacher,
+                'output_teacher': cv2.addWeighted(frame, 0.5, colored_teacher, 0.5, 0),
+                'output_student': cv2.addWeighted(frame, 0.5, colored_student, 0.5, 0),
+                'overlay_student': colored_student, 'frame': frame}
+    for name in expected:
+        assert np.array_equal(cv2.cvtColor(images[name], cv2.COLOR_BGR2RGB), expected[name]), name
+    print('Colorizer matches the network\'s colorization')
+
+
+if __name__ == '__main__':
+    colorizer_test()